@@ -1,18 +1,37 @@
 # app.py - SISTEMA COMPLETO LIVRO CAIXA COM AGENDA DE CONTATOS
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date, time, timedelta
 import io
 import base64
 import os
 import zipfile
 import hashlib
+import gzip
+import secrets
+import json
 import calendar
+import csv
+import tempfile
+import re
+import functools
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 import shutil
+import threading
+from time import monotonic, sleep
 from dateutil.relativedelta import relativedelta
+from dateutil.rrule import rrulestr
 import pymysql
 from pymysql import Error
+from pymysql.constants import FIELD_TYPE
+from pymysql.converters import escape_item
 from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
 import requests
 from io import BytesIO
 
@@ -31,6 +50,11 @@ PERMISSOES = {
     'visualizador': 'Apenas Visualização'
 }
 
+MESES = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
+         "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
+
+TAMANHOS_PAGINA = [10, 25, 50, 100]
+
 # =============================================================================
 # INICIALIZAÇÃO DO SESSION STATE
 # =============================================================================
@@ -54,6 +78,12 @@ def init_session_state():
     # Variáveis para gerenciamento de lançamentos
     if 'editing_lancamento' not in st.session_state:
         st.session_state.editing_lancamento = None
+    if 'pagina_lancamentos' not in st.session_state:
+        st.session_state.pagina_lancamentos = {'periodo': None, 'pilha': [None]}
+    
+    # Tarefas em segundo plano da sessão (backups, exportações)
+    if 'tarefas' not in st.session_state:
+        st.session_state.tarefas = {}
     
     # Variáveis para navegação
     if 'current_page' not in st.session_state:
@@ -176,10 +206,167 @@ def gerenciar_logo():
                 st.error(f"❌ Erro ao processar imagem: {e}")
 
 # =============================================================================
-# CONEXÃO COM PLANETSCALE
+# CONEXÃO COM PLANETSCALE (POOL DE CONEXÕES)
 # =============================================================================
+
+# Parâmetros do pool de conexões
+POOL_TAMANHO_MAXIMO = 8        # conexões abertas simultaneamente (em uso + livres)
+POOL_TEMPO_ESPERA = 15         # segundos aguardando uma conexão livre
+POOL_OCIOSIDADE_MAXIMA = 300   # segundos ociosa antes de ser descartada
+POOL_PING_APOS = 5             # segundos ociosa antes de verificar com ping
+
+class PoolConexoes:
+    """
+    Pool de conexões PyMySQL compartilhado por todo o processo.
+
+    Cada thread do Streamlit recebe uma única conexão por vez: chamadas
+    aninhadas na mesma thread reutilizam a conexão já emprestada, e ela só
+    volta ao pool quando o último close() é chamado.
+    """
+
+    def __init__(self, parametros, tamanho_maximo=POOL_TAMANHO_MAXIMO,
+                 tempo_espera=POOL_TEMPO_ESPERA, ociosidade_maxima=POOL_OCIOSIDADE_MAXIMA,
+                 ping_apos=POOL_PING_APOS):
+        self.parametros = parametros
+        self.tamanho_maximo = tamanho_maximo
+        self.tempo_espera = tempo_espera
+        self.ociosidade_maxima = ociosidade_maxima
+        self.ping_apos = ping_apos
+        self._livres = []  # pilha de (conexao, instante_devolucao)
+        self._total = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _abrir(self):
+        return pymysql.connect(**self.parametros)
+
+    @staticmethod
+    def _descartar(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _liberar_vaga(self):
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def _remover_ociosas(self):
+        """Fecha conexões ociosas há mais tempo que o limite (chamar com o lock)"""
+        limite = monotonic() - self.ociosidade_maxima
+        expiradas = [c for c, devolvida_em in self._livres if devolvida_em < limite]
+        if expiradas:
+            self._livres = [(c, t) for c, t in self._livres if t >= limite]
+            self._total -= len(expiradas)
+            for conn in expiradas:
+                self._descartar(conn)
+
+    def _retirar(self):
+        """Retira uma conexão livre, abre uma nova ou aguarda uma devolução"""
+        prazo = monotonic() + self.tempo_espera
+        with self._cond:
+            while True:
+                self._remover_ociosas()
+                if self._livres:
+                    conn, devolvida_em = self._livres.pop()
+                    break
+                if self._total < self.tamanho_maximo:
+                    self._total += 1
+                    conn, devolvida_em = None, None
+                    break
+                restante = prazo - monotonic()
+                if restante <= 0:
+                    raise TimeoutError("Nenhuma conexão livre no pool")
+                self._cond.wait(restante)
+
+        # Abertura e ping ficam fora do lock para não bloquear outras threads
+        if conn is not None and monotonic() - devolvida_em > self.ping_apos:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._descartar(conn)
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self._abrir()
+            except Exception:
+                self._liberar_vaga()
+                raise
+        return conn
+
+    def obter(self):
+        """Empresta uma conexão para a thread atual"""
+        local = self._local
+        if getattr(local, 'conexao', None) is not None:
+            local.profundidade += 1
+        else:
+            local.conexao = self._retirar()
+            local.profundidade = 1
+        return ConexaoPool(self, local.conexao)
+
+    def devolver(self):
+        """Devolve a conexão da thread atual quando o último uso termina"""
+        local = self._local
+        local.profundidade -= 1
+        if local.profundidade > 0:
+            return
+        conn = local.conexao
+        local.conexao = None
+
+        # Descarta transação pendente para a próxima leitura ver dados atuais
+        try:
+            conn.rollback()
+        except Exception:
+            self._descartar(conn)
+            self._liberar_vaga()
+            return
+
+        with self._cond:
+            self._livres.append((conn, monotonic()))
+            self._cond.notify()
+
+    def estatisticas(self):
+        """Retorna (abertas, livres, em_uso) para exibição"""
+        with self._cond:
+            return self._total, len(self._livres), self._total - len(self._livres)
+
+class ConexaoPool:
+    """Conexão emprestada do pool: close() devolve ao pool em vez de fechar"""
+
+    def __init__(self, pool, conexao):
+        self._pool = pool
+        self._conexao = conexao
+        self._devolvida = False
+
+    def __getattr__(self, nome):
+        return getattr(self._conexao, nome)
+
+    def close(self):
+        if not self._devolvida:
+            self._devolvida = True
+            self._pool.devolver()
+
+    def descartar(self):
+        """Fecha a conexão física: com estado de sessão incerto, ela não volta ao pool"""
+        PoolConexoes._descartar(self._conexao)
+        self.close()
+
+@st.cache_resource(show_spinner=False)
+def get_pool_conexoes(host, user, password, database):
+    """Cria um único pool por processo (compartilhado entre sessões e reruns)"""
+    return PoolConexoes({
+        'host': host,
+        'user': user,
+        'password': password,
+        'database': database,
+        'ssl': {'ca': '/etc/ssl/certs/ca-certificates.crt'},
+        'connect_timeout': 10
+    })
+
 def get_db_connection():
-    """Cria conexão com o PlanetScale usando PyMySQL"""
+    """Obtém uma conexão do pool do PlanetScale (close() devolve ao pool)"""
     try:
         if "planetscale" not in st.secrets:
             st.error("❌ Secrets do PlanetScale não encontrados")
@@ -194,17 +381,13 @@ def get_db_connection():
                 st.error(f"❌ Campo '{field}' não encontrado ou vazio")
                 return None
 
-        # Tentar conexão
-        connection = pymysql.connect(
-            host=secrets["host"],
-            user=secrets["user"],
-            password=secrets["password"],
-            database=secrets["database"],
-            ssl={'ca': '/etc/ssl/certs/ca-certificates.crt'},
-            connect_timeout=10
+        pool = get_pool_conexoes(
+            secrets["host"],
+            secrets["user"],
+            secrets["password"],
+            secrets["database"]
         )
-
-        return connection
+        return pool.obter()
 
     except pymysql.MySQLError as e:
         error_code = e.args[0] if len(e.args) > 0 else None
@@ -217,87 +400,657 @@ def get_db_connection():
         else:
             st.error(f"❌ Erro MySQL {error_code}: {e}")
         return None
+    except TimeoutError:
+        st.error(f"❌ Tempo esgotado aguardando conexão livre ({POOL_TAMANHO_MAXIMO} em uso)")
+        return None
     except Exception as e:
         st.error(f"❌ Erro de conexão: {e}")
         return None
 
 # =============================================================================
-# FUNÇÕES DE AUTENTICAÇÃO E TABELA USUARIOS (COM EXPANSÃO DE CAMPOS)
+# CACHE DE CONSULTAS (INVALIDADO PELAS FUNÇÕES DE ESCRITA)
+# =============================================================================
+
+CACHE_TTL_PADRAO = 120                  # segundos até um resultado expirar
+CACHE_MEMORIA_MAXIMA = 64 * 1024 * 1024  # bytes estimados antes de descartar (LRU)
+
+def _tamanho_estimado(valor, profundidade=2):
+    """Estimativa barata do tamanho em memória de um resultado de consulta"""
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(index=True, deep=True).sum())
+    tamanho = sys.getsizeof(valor)
+    if profundidade > 0 and isinstance(valor, (list, tuple)):
+        tamanho += sum(_tamanho_estimado(item, profundidade - 1) for item in valor)
+    return tamanho
+
+class CacheConsultas:
+    """
+    Cache LRU de resultados por (consulta, parâmetros), limitado por memória e
+    TTL. Cada entrada pertence a tabelas; gravar numa tabela incrementa sua
+    geração e descarta as entradas dependentes.
+    """
+
+    def __init__(self, memoria_maxima=CACHE_MEMORIA_MAXIMA):
+        self.memoria_maxima = memoria_maxima
+        self._entradas = OrderedDict()  # chave -> (valor, tabelas, expira_em, tamanho)
+        self._geracoes = {}
+        self._memoria = 0
+        self._lock = threading.Lock()
+
+    def geracoes(self, tabelas):
+        with self._lock:
+            return tuple(self._geracoes.get(tabela, 0) for tabela in tabelas)
+
+    def obter(self, chave):
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None:
+                return False, None
+            if entrada[2] < monotonic():
+                self._remover(chave)
+                return False, None
+            self._entradas.move_to_end(chave)
+            return True, entrada[0]
+
+    def guardar(self, chave, valor, tabelas, geracoes, ttl):
+        tamanho = _tamanho_estimado(valor)
+        if tamanho > self.memoria_maxima:
+            return
+        with self._lock:
+            # Uma escrita ocorreu durante a leitura: o resultado já nasceu velho
+            if geracoes != tuple(self._geracoes.get(tabela, 0) for tabela in tabelas):
+                return
+            if chave in self._entradas:
+                self._remover(chave)
+            self._entradas[chave] = (valor, tabelas, monotonic() + ttl, tamanho)
+            self._memoria += tamanho
+            while self._memoria > self.memoria_maxima:
+                self._remover(next(iter(self._entradas)))
+
+    def invalidar(self, *tabelas):
+        with self._lock:
+            for tabela in tabelas:
+                self._geracoes[tabela] = self._geracoes.get(tabela, 0) + 1
+            for chave in [c for c, e in self._entradas.items() if set(e[1]) & set(tabelas)]:
+                self._remover(chave)
+
+    def _remover(self, chave):
+        self._memoria -= self._entradas.pop(chave)[3]
+
+    def estatisticas(self):
+        """Retorna (entradas, bytes estimados) para exibição"""
+        with self._lock:
+            return len(self._entradas), self._memoria
+
+@st.cache_resource(show_spinner=False)
+def get_cache_consultas():
+    """Cache único por processo, compartilhado entre sessões"""
+    return CacheConsultas()
+
+def cache_consulta(*tabelas, ttl=CACHE_TTL_PADRAO):
+    """
+    Decorador que guarda o resultado da função por argumentos. Resultados
+    vazios não são guardados, pois as funções também retornam vazio em erro.
+    """
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def wrapper(*args, **kwargs):
+            cache = get_cache_consultas()
+            chave = (funcao.__name__, args, tuple(sorted(kwargs.items())))
+            encontrado, valor = cache.obter(chave)
+            if not encontrado:
+                geracoes = cache.geracoes(tabelas)
+                valor = funcao(*args, **kwargs)
+                if len(valor) > 0:
+                    cache.guardar(chave, valor, tabelas, geracoes, ttl)
+            # DataFrames são mutáveis: cada chamador recebe sua cópia
+            return valor.copy() if isinstance(valor, pd.DataFrame) else valor
+        return wrapper
+    return decorador
+
+def invalidar_cache(*tabelas):
+    """Descarta resultados em cache que dependem das tabelas informadas"""
+    get_cache_consultas().invalidar(*tabelas)
+
+# =============================================================================
+# FORMATAÇÃO MONETÁRIA (VETORIZADA)
+# =============================================================================
+
+RE_MILHAR = r'\B(?=(\d{3})+(?!\d))'  # posições que recebem o separador de milhar
+
+def formatar_moeda(valores, vazio_se_zero=False):
+    """
+    Formata valores como moeda brasileira ("R$ 1.234,56") com operações
+    vetorizadas sobre a coluna inteira. Aceita Series, listas ou um valor
+    único (float, Decimal ou texto numérico); nulos viram texto vazio.
+    """
+    escalar = not isinstance(valores, (pd.Series, np.ndarray, list, tuple))
+    numeros = pd.to_numeric(pd.Series([valores] if escalar else valores), errors='coerce')
+    nulos = numeros.isna().to_numpy()
+
+    centavos = np.rint(np.abs(numeros.fillna(0).to_numpy(dtype=float)) * 100).astype(np.int64)
+    inteiros = pd.Series(centavos // 100, index=numeros.index).astype(str).str.replace(RE_MILHAR, '.', regex=True)
+    fracoes = pd.Series(centavos % 100, index=numeros.index).astype(str).str.zfill(2)
+    sinais = np.where((numeros.to_numpy() < 0) & (centavos > 0), '-', '')
+
+    texto = sinais + 'R$ ' + inteiros + ',' + fracoes
+    texto[nulos | ((centavos == 0) if vazio_se_zero else False)] = ''
+    return texto.iloc[0] if escalar else texto
+
+def formatar_lancamentos(df):
+    """Acrescenta as colunas de exibição (data_fmt, entrada_fmt, saida_fmt, saldo_fmt)"""
+    df = df.copy()
+    df['data_fmt'] = pd.to_datetime(df['data']).dt.strftime('%d/%m/%Y')
+    df['entrada_fmt'] = formatar_moeda(df['entrada'], vazio_se_zero=True)
+    df['saida_fmt'] = formatar_moeda(df['saida'], vazio_se_zero=True)
+    df['saldo_fmt'] = formatar_moeda(df['saldo'])
+    return df
+
+@cache_consulta('lancamentos')
+def get_pagina_lancamentos_formatada(ano, mes, limite, apos=None):
+    """Página de lançamentos já formatada, guardada enquanto os dados não mudam"""
+    df = get_pagina_lancamentos(ano, mes, limite, apos)
+    return formatar_lancamentos(df) if not df.empty else df
+
+# =============================================================================
+# TAREFAS EM SEGUNDO PLANO (BACKUPS E EXPORTAÇÕES)
+# =============================================================================
+
+@st.cache_resource(show_spinner=False)
+def get_executor_tarefas():
+    """Executor do processo para tarefas longas, fora da thread do script"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='tarefa')
+
+def iniciar_tarefa(chave, funcao, *args, **kwargs):
+    """
+    Submete a função ao executor e guarda o Future na sessão do usuário.
+    Recusa (retorna False) enquanto a tarefa anterior da mesma chave roda:
+    trocar o Future deixaria a execução em andamento órfã.
+    """
+    tarefa = st.session_state.tarefas.get(chave)
+    if tarefa and not tarefa['future'].done():
+        st.warning("⚠️ Já existe uma execução desta tarefa em andamento; aguarde a conclusão.")
+        return False
+    st.session_state.tarefas[chave] = {
+        'future': get_executor_tarefas().submit(funcao, *args, **kwargs),
+        'inicio': datetime.now()
+    }
+    return True
+
+def show_andamento_tarefa(chave, descricao):
+    """
+    Exibe a situação da tarefa da sessão. Retorna o resultado quando ela
+    terminou com sucesso; None enquanto ainda roda ou se falhou. Concluída,
+    a tarefa sai da sessão: o resultado (às vezes um ZIP inteiro) é entregue
+    uma única vez em vez de ficar na memória até o fim da sessão.
+    """
+    tarefa = st.session_state.tarefas.get(chave)
+    if not tarefa:
+        return None
+
+    future = tarefa['future']
+    if not future.done():
+        decorrido = int((datetime.now() - tarefa['inicio']).total_seconds())
+        st.info(f"⏳ {descricao} em andamento ({decorrido}s). Você pode continuar usando o sistema.")
+        if st.button("🔄 Verificar andamento", key=f"verificar_{chave}", use_container_width=True):
+            st.rerun()
+        return None
+
+    erro = future.exception()
+    if erro:
+        st.error(f"❌ Erro em {descricao.lower()}: {erro}")
+        st.session_state.tarefas.pop(chave, None)
+        return None
+    st.session_state.tarefas.pop(chave, None)
+    return future.result()
+
+# =============================================================================
+# MIGRAÇÕES DO BANCO DE DADOS (VERSIONADAS, UMA VEZ POR PROCESSO)
 # =============================================================================
 
-def init_auth_db():
+def _migracao_tabela_usuarios(cursor):
+    """Cria a tabela base de usuários (compatível com instalações novas)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(100) UNIQUE,
+            password_hash VARCHAR(255) NOT NULL,
+            permissao VARCHAR(20) NOT NULL DEFAULT 'visualizador',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migracao_campos_usuarios(cursor):
+    """Adiciona os campos opcionais de usuários que ainda não existirem"""
+    campos_adicionais = [
+        ('nome_completo', 'VARCHAR(200)'),
+        ('telefone', 'VARCHAR(50)'),
+        ('endereco', 'TEXT'),
+        ('data_aniversario', 'DATE'),
+        ('data_iniciacao', 'DATE'),
+        ('data_elevacao', 'DATE'),
+        ('data_exaltacao', 'DATE'),
+        ('data_instalacao_posse', 'DATE'),
+        ('observacoes', 'TEXT'),
+        ('redes_sociais', 'VARCHAR(500)')
+    ]
+
+    # Instalações antigas podem já ter parte das colunas
+    cursor.execute("SHOW COLUMNS FROM usuarios")
+    colunas_existentes = [coluna[0] for coluna in cursor.fetchall()]
+
+    for campo, tipo in campos_adicionais:
+        if campo not in colunas_existentes:
+            cursor.execute(f'ALTER TABLE usuarios ADD COLUMN {campo} {tipo}')
+
+def _migracao_usuarios_padrao(cursor):
+    """Insere os usuários padrão se ainda não existirem"""
+    cursor.execute('SELECT COUNT(*) FROM usuarios WHERE username = "admin"')
+    if cursor.fetchone()[0] == 0:
+        # Senha padrão: "admin123" (hash SHA256)
+        password_hash = hashlib.sha256('admin123'.encode()).hexdigest()
+        cursor.execute(
+            'INSERT INTO usuarios (username, password_hash, permissao) VALUES (%s, %s, %s)',
+            ('admin', password_hash, 'admin')
+        )
+
+        password_hash_viewer = hashlib.sha256('visual123'.encode()).hexdigest()
+        cursor.execute(
+            'INSERT INTO usuarios (username, password_hash, permissao) VALUES (%s, %s, %s)',
+            ('visual', password_hash_viewer, 'visualizador')
+        )
+
+def _migracao_tabelas_sistema(cursor):
+    """Cria as tabelas de lançamentos, contas e eventos"""
+    # Tabela de lançamentos
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lancamentos (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            mes VARCHAR(50) NOT NULL,
+            data DATE NOT NULL,
+            historico TEXT NOT NULL,
+            complemento TEXT,
+            entrada DECIMAL(15,2) DEFAULT 0.00,
+            saida DECIMAL(15,2) DEFAULT 0.00,
+            saldo DECIMAL(15,2) DEFAULT 0.00,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tabela de contas
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS contas (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            nome VARCHAR(100) UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tabela de eventos
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS eventos_calendario (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            titulo VARCHAR(200) NOT NULL,
+            descricao TEXT,
+            data_evento DATE NOT NULL,
+            hora_evento TIME,
+            tipo_evento VARCHAR(50),
+            cor_evento VARCHAR(20),
+            created_by VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _criar_indice_se_ausente(cursor, tabela, nome_indice, colunas):
+    """Cria um índice secundário apenas se ainda não existir"""
+    cursor.execute(f'SHOW INDEX FROM {tabela} WHERE Key_name = %s', (nome_indice,))
+    if not cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {tabela} ADD INDEX {nome_indice} ({colunas})')
+
+def _migracao_indices_consultas(cursor):
+    """Índices compostos para as consultas mais frequentes"""
+    # get_lancamentos_mes e recálculo de saldo: WHERE mes = ? ORDER BY data, id
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_mes_data', 'mes, data, id')
+    # get_eventos_mes: faixa de data_evento ORDER BY data_evento, hora_evento
+    _criar_indice_se_ausente(cursor, 'eventos_calendario', 'idx_eventos_data_hora', 'data_evento, hora_evento')
+    # criar_backup_incremental: WHERE created_at >= ?
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_created_at', 'created_at')
+    _criar_indice_se_ausente(cursor, 'eventos_calendario', 'idx_eventos_created_at', 'created_at')
+
+def _migracao_ano_lancamentos(cursor):
+    """
+    Adiciona a dimensão ano aos lançamentos (preenchida a partir da data),
+    troca o índice por período e recalcula o saldo de cada (ano, mês), já que
+    antes todos os anos de um mesmo mês compartilhavam um único saldo.
+    """
+    cursor.execute("SHOW COLUMNS FROM lancamentos LIKE 'ano'")
+    if not cursor.fetchall():
+        cursor.execute('ALTER TABLE lancamentos ADD COLUMN ano SMALLINT NULL')
+    cursor.execute('UPDATE lancamentos SET ano = YEAR(data) WHERE ano IS NULL')
+    cursor.execute('ALTER TABLE lancamentos MODIFY COLUMN ano SMALLINT NOT NULL')
+
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_periodo', 'ano, mes, data, id')
+    cursor.execute("SHOW INDEX FROM lancamentos WHERE Key_name = 'idx_lancamentos_mes_data'")
+    if cursor.fetchall():
+        cursor.execute('ALTER TABLE lancamentos DROP INDEX idx_lancamentos_mes_data')
+
+    cursor.execute('SELECT DISTINCT ano, mes FROM lancamentos')
+    for ano, mes in cursor.fetchall():
+        _recalcular_saldos_a_partir(cursor, ano, mes, date(1900, 1, 1), 0)
+
+def _migracao_resumo_lancamentos(cursor):
+    """Tabela materializada com os totais de cada período (ano, mês)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumo_lancamentos (
+            ano SMALLINT NOT NULL,
+            mes VARCHAR(50) NOT NULL,
+            total_entradas DECIMAL(15,2) NOT NULL DEFAULT 0.00,
+            total_saidas DECIMAL(15,2) NOT NULL DEFAULT 0.00,
+            saldo_final DECIMAL(15,2) NOT NULL DEFAULT 0.00,
+            quantidade INT NOT NULL DEFAULT 0,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (ano, mes)
+        )
+    ''')
+    _reconstruir_resumos(cursor)
+
+# Tabelas com rastreamento de alterações (updated_at + exclusões) e sua chave
+TABELAS_RASTREADAS = {
+    'lancamentos': 'id',
+    'eventos_calendario': 'id',
+    'contas': 'id',
+    'usuarios': 'username',
+    'lancamentos_recorrentes': 'id',
+    'recorrencias_materializadas': 'id',
+}
+
+def _adicionar_rastreamento(cursor, tabela):
+    """Coluna updated_at (atualizada pelo banco) e seu índice para o incremental"""
+    cursor.execute(f"SHOW COLUMNS FROM {tabela} LIKE 'updated_at'")
+    if not cursor.fetchall():
+        cursor.execute(f'''
+            ALTER TABLE {tabela} ADD COLUMN updated_at TIMESTAMP NOT NULL
+            DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ''')
+        cursor.execute(f'UPDATE {tabela} SET updated_at = COALESCE(created_at, updated_at)')
+    _criar_indice_se_ausente(cursor, tabela, f'idx_{tabela}_updated_at', 'updated_at')
+
+def _migracao_rastreamento_alteracoes(cursor):
+    """
+    updated_at nas tabelas de dados, registro de exclusões (tombstones) e
+    marcos (watermarks) das cadeias de backup incremental.
+    """
+    # Lista fixa: tabelas criadas depois ganham rastreamento na própria migração
+    for tabela in ('lancamentos', 'eventos_calendario', 'contas', 'usuarios'):
+        _adicionar_rastreamento(cursor, tabela)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS registro_exclusoes (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            tabela VARCHAR(50) NOT NULL,
+            chave VARCHAR(100) NOT NULL,
+            excluido_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_exclusoes_excluido_em (excluido_em)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_marcos (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            cadeia VARCHAR(50) NOT NULL,
+            sequencia INT NOT NULL,
+            tipo VARCHAR(20) NOT NULL,
+            marca TIMESTAMP NOT NULL,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uk_backup_marcos_cadeia (cadeia, sequencia)
+        )
+    ''')
+
+def _migracao_indices_relatorios(cursor):
+    """Índice de cobertura para os totais diários dos relatórios anuais"""
+    # get_totais_diarios: WHERE ano BETWEEN ? AND ? GROUP BY ano, data somando entrada/saida
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_ano_data', 'ano, data, entrada, saida')
+
+def _garantir_fk_conta(cursor):
+    """
+    Foreign key lancamentos.conta_id -> contas.id; recriada se faltar ou se
+    apontar para outra tabela (a troca de tabelas da restauração renomeia contas)
+    """
+    cursor.execute('''
+        SELECT REFERENCED_TABLE_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'lancamentos'
+          AND CONSTRAINT_NAME = 'fk_lancamentos_conta'
+    ''')
+    atual = cursor.fetchone()
+    if atual and atual[0] == 'contas':
+        return
+    try:
+        if atual:
+            cursor.execute('ALTER TABLE lancamentos DROP FOREIGN KEY fk_lancamentos_conta')
+        cursor.execute('''
+            ALTER TABLE lancamentos ADD CONSTRAINT fk_lancamentos_conta
+            FOREIGN KEY (conta_id) REFERENCES contas (id) ON DELETE SET NULL
+        ''')
+    except Error:
+        # Bancos sem suporte a foreign keys (ex.: branch do PlanetScale sem a
+        # opção habilitada) ficam só com o índice; a aplicação mantém conta_id
+        pass
+
+def _migracao_conta_lancamentos(cursor):
+    """Chave conta_id nos lançamentos (FK para contas) e vínculo inicial pelo histórico"""
+    cursor.execute("SHOW COLUMNS FROM lancamentos LIKE 'conta_id'")
+    if not cursor.fetchone():
+        cursor.execute('ALTER TABLE lancamentos ADD COLUMN conta_id INT NULL')
+    # FK exige índice começando pela coluna; relatórios agrupam por conta dentro do ano
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_conta', 'conta_id')
+    _criar_indice_se_ausente(cursor, 'lancamentos', 'idx_lancamentos_ano_conta', 'ano, conta_id, entrada, saida')
+    _garantir_fk_conta(cursor)
+    _vincular_contas(cursor)
+
+def _migracao_lancamentos_recorrentes(cursor):
+    """Definições de lançamentos recorrentes e registro das ocorrências já geradas"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lancamentos_recorrentes (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            historico TEXT NOT NULL,
+            complemento TEXT,
+            entrada DECIMAL(15,2) DEFAULT 0.00,
+            saida DECIMAL(15,2) DEFAULT 0.00,
+            regra VARCHAR(500) NOT NULL,
+            inicio DATE NOT NULL,
+            fim DATE NULL,
+            ativo BOOLEAN DEFAULT TRUE,
+            created_by VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Uma linha por ocorrência gerada: a chave impede gerar a mesma data duas vezes,
+    # mesmo com duas sessões abrindo o período ao mesmo tempo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recorrencias_materializadas (
+            recorrente_id INT NOT NULL,
+            data DATE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (recorrente_id, data)
+        )
+    ''')
+
+def _migracao_origem_marcos_backup(cursor):
+    """Origem dos marcos: downloads manuais e agendador mantêm cadeias independentes"""
+    cursor.execute("SHOW COLUMNS FROM backup_marcos LIKE 'origem'")
+    if not cursor.fetchone():
+        cursor.execute("ALTER TABLE backup_marcos ADD COLUMN origem VARCHAR(20) NOT NULL DEFAULT 'manual' AFTER id")
+    cursor.execute("SHOW INDEX FROM backup_marcos WHERE Key_name = 'uk_backup_marcos_cadeia'")
+    if cursor.fetchall():
+        cursor.execute('''
+            ALTER TABLE backup_marcos DROP INDEX uk_backup_marcos_cadeia,
+            ADD UNIQUE KEY uk_backup_marcos_origem (origem, cadeia, sequencia)
+        ''')
+
+def _migracao_lote_recorrencias(cursor):
+    """Lote das reivindicações: um INSERT IGNORE multi-linha e uma leitura das datas obtidas"""
+    cursor.execute("SHOW COLUMNS FROM recorrencias_materializadas LIKE 'lote'")
+    if not cursor.fetchone():
+        cursor.execute('ALTER TABLE recorrencias_materializadas ADD COLUMN lote CHAR(32) NULL')
+    _criar_indice_se_ausente(cursor, 'recorrencias_materializadas', 'idx_recorrencias_lote', 'lote')
+
+def _migracao_rastreamento_recorrencias(cursor):
+    """
+    Recorrências no backup incremental: updated_at nas duas tabelas e chave
+    simples (id) nas ocorrências, exigida pelo registro de exclusões. A
+    unicidade de (recorrente_id, data) continua garantida pela chave única.
+    """
+    cursor.execute("SHOW COLUMNS FROM recorrencias_materializadas LIKE 'id'")
+    if not cursor.fetchone():
+        cursor.execute('''
+            ALTER TABLE recorrencias_materializadas DROP PRIMARY KEY,
+            ADD COLUMN id BIGINT AUTO_INCREMENT PRIMARY KEY FIRST,
+            ADD UNIQUE KEY uk_recorrencias_data (recorrente_id, data)
+        ''')
+    for tabela in ('lancamentos_recorrentes', 'recorrencias_materializadas'):
+        _adicionar_rastreamento(cursor, tabela)
+
+# Lista ordenada de migrações: (versão, descrição, função).
+# Novas alterações de schema entram SEMPRE no final, com a próxima versão.
+# Cada passo deve ser idempotente, pois DDL no MySQL faz commit implícito.
+MIGRACOES = [
+    (1, "Tabela de usuários", _migracao_tabela_usuarios),
+    (2, "Campos adicionais de usuários", _migracao_campos_usuarios),
+    (3, "Usuários padrão", _migracao_usuarios_padrao),
+    (4, "Tabelas de lançamentos, contas e eventos", _migracao_tabelas_sistema),
+    (5, "Índices de lançamentos e eventos", _migracao_indices_consultas),
+    (6, "Ano nos lançamentos e saldo por período", _migracao_ano_lancamentos),
+    (7, "Resumo materializado por período", _migracao_resumo_lancamentos),
+    (8, "Rastreamento de alterações para backup incremental", _migracao_rastreamento_alteracoes),
+    (9, "Índices para relatórios agregados", _migracao_indices_relatorios),
+    (10, "Conta dos lançamentos (chave estrangeira para contas)", _migracao_conta_lancamentos),
+    (11, "Lançamentos recorrentes", _migracao_lancamentos_recorrentes),
+    (12, "Origem dos marcos de backup", _migracao_origem_marcos_backup),
+    (13, "Lote das ocorrências de recorrências", _migracao_lote_recorrencias),
+    (14, "Rastreamento de alterações das recorrências", _migracao_rastreamento_recorrencias),
+]
+
+def aplicar_migracoes():
     """
-    Inicializa a tabela de usuarios (cria se não existir) e aplica ALTER TABLE
-    para adicionar os novos campos opcionais quando necessário.
+    Aplica as migrações pendentes, registrando cada versão em schema_version.
+    Retorna True quando o schema está na versão mais recente.
     """
     conn = get_db_connection()
     if not conn:
-        return
+        return False
 
     try:
         cursor = conn.cursor()
-
-        # Criar tabela base (compatível com instalações novas)
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                email VARCHAR(100) UNIQUE,
-                password_hash VARCHAR(255) NOT NULL,
-                permissao VARCHAR(20) NOT NULL DEFAULT 'visualizador',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_version (
+                versao INT PRIMARY KEY,
+                descricao VARCHAR(200) NOT NULL,
+                aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        cursor.execute('SELECT COALESCE(MAX(versao), 0) FROM schema_version')
+        versao_atual = cursor.fetchone()[0]
 
-        # VERIFICAR E ADICIONAR CAMPOS OPCIONAIS - método mais compatível
-        campos_adicionais = [
-            ('nome_completo', 'VARCHAR(200)'),
-            ('telefone', 'VARCHAR(50)'),
-            ('endereco', 'TEXT'),
-            ('data_aniversario', 'DATE'),
-            ('data_iniciacao', 'DATE'),
-            ('data_elevacao', 'DATE'),
-            ('data_exaltacao', 'DATE'),
-            ('data_instalacao_posse', 'DATE'),
-            ('observacoes', 'TEXT'),
-            ('redes_sociais', 'VARCHAR(500)')
-        ]
-
-        # Verificar quais colunas já existem
-        cursor.execute("SHOW COLUMNS FROM usuarios")
-        colunas_existentes = [coluna[0] for coluna in cursor.fetchall()]
-
-        # Adicionar colunas que não existem
-        for campo, tipo in campos_adicionais:
-            if campo not in colunas_existentes:
-                try:
-                    cursor.execute(f'ALTER TABLE usuarios ADD COLUMN {campo} {tipo}')
-                except Exception as e:
-                    st.warning(f"⚠️ Não foi possível adicionar a coluna '{campo}': {e}")
-
-        # Inserir usuários padrão se não existirem
-        cursor.execute('SELECT COUNT(*) FROM usuarios WHERE username = "admin"')
-        if cursor.fetchone()[0] == 0:
-            # Senha padrão: "admin123" (hash SHA256)
-            password_hash = hashlib.sha256('admin123'.encode()).hexdigest()
+        for versao, descricao, migracao in MIGRACOES:
+            if versao <= versao_atual:
+                continue
+            migracao(cursor)
+            # INSERT IGNORE: outro processo pode ter aplicado a mesma versão em paralelo
             cursor.execute(
-                'INSERT INTO usuarios (username, password_hash, permissao) VALUES (%s, %s, %s)',
-                ('admin', password_hash, 'admin')
+                'INSERT IGNORE INTO schema_version (versao, descricao) VALUES (%s, %s)',
+                (versao, descricao)
             )
+            conn.commit()
 
-            password_hash_viewer = hashlib.sha256('visual123'.encode()).hexdigest()
-            cursor.execute(
-                'INSERT INTO usuarios (username, password_hash, permissao) VALUES (%s, %s, %s)',
-                ('visual', password_hash_viewer, 'visualizador')
-            )
+        return True
+    except Error as e:
+        st.error(f"❌ Erro ao aplicar migrações do banco de dados: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
 
-        conn.commit()
+# Consultas críticas e o índice que cada uma deve usar: (descrição, sql, parâmetros, índice)
+CONSULTAS_INDEXADAS = [
+    ("Lançamentos do mês",
+     'SELECT * FROM lancamentos WHERE ano = %s AND mes = %s ORDER BY data, id',
+     (2024, 'Janeiro'), 'idx_lancamentos_periodo'),
+    ("Página de lançamentos (keyset)",
+     'SELECT * FROM lancamentos WHERE ano = %s AND mes = %s AND (data > %s OR (data = %s AND id > %s)) ORDER BY data, id LIMIT 26',
+     (2024, 'Janeiro', '2024-01-15', '2024-01-15', 0), 'idx_lancamentos_periodo'),
+    ("Eventos do mês",
+     'SELECT * FROM eventos_calendario WHERE data_evento >= %s AND data_evento < %s ORDER BY data_evento, hora_evento',
+     ('2024-01-01', '2024-02-01'), 'idx_eventos_data_hora'),
+    ("Relatório - totais diários",
+     'SELECT data, SUM(entrada), SUM(saida) FROM lancamentos WHERE ano BETWEEN %s AND %s GROUP BY ano, data',
+     (2015, 2024), 'idx_lancamentos_ano_data'),
+    ("Relatório - totais mensais (resumo)",
+     'SELECT ano, mes, total_entradas, total_saidas FROM resumo_lancamentos WHERE ano BETWEEN %s AND %s',
+     (2015, 2024), 'PRIMARY'),
+    ("Relatório - totais por conta",
+     'SELECT conta_id, SUM(entrada), SUM(saida) FROM lancamentos WHERE ano BETWEEN %s AND %s GROUP BY conta_id',
+     (2015, 2024), 'idx_lancamentos_ano_conta'),
+    ("Backup incremental - lançamentos",
+     'SELECT * FROM lancamentos WHERE updated_at >= %s AND updated_at < %s',
+     ('2024-01-01', '2024-01-02'), 'idx_lancamentos_updated_at'),
+    ("Backup incremental - eventos",
+     'SELECT * FROM eventos_calendario WHERE updated_at >= %s AND updated_at < %s',
+     ('2024-01-01', '2024-01-02'), 'idx_eventos_calendario_updated_at'),
+    ("Backup incremental - exclusões",
+     'SELECT * FROM registro_exclusoes WHERE excluido_em >= %s AND excluido_em < %s',
+     ('2024-01-01', '2024-01-02'), 'idx_exclusoes_excluido_em'),
+]
+
+def verificar_uso_indices():
+    """
+    Executa EXPLAIN nas consultas críticas e retorna um DataFrame indicando
+    qual índice o otimizador escolheu para cada uma.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return pd.DataFrame()
+
+    try:
+        cursor = conn.cursor(pymysql.cursors.DictCursor)
+        resultados = []
+        for descricao, sql, parametros, indice_esperado in CONSULTAS_INDEXADAS:
+            cursor.execute(f'EXPLAIN {sql}', parametros)
+            plano = cursor.fetchone() or {}
+            indice_usado = plano.get('key')
+            resultados.append({
+                'Consulta': descricao,
+                'Índice esperado': indice_esperado,
+                'Índice usado': indice_usado or '(nenhum - full scan)',
+                'Tipo de acesso': plano.get('type'),
+                'Linhas estimadas': plano.get('rows'),
+                'OK': '✅' if indice_usado == indice_esperado else '⚠️'
+            })
+        return pd.DataFrame(resultados)
     except Error as e:
-        st.error(f"❌ Erro ao inicializar banco de autenticação: {e}")
+        st.error(f"❌ Erro ao verificar índices: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
+@st.cache_resource(show_spinner=False)
+def _estado_schema():
+    """Estado compartilhado pelo processo indicando se o schema já foi verificado"""
+    return {'atualizado': False, 'lock': threading.Lock()}
+
+def garantir_schema():
+    """Executa as migrações uma única vez por processo (reruns não fazem DDL)"""
+    estado = _estado_schema()
+    if estado['atualizado']:
+        return
+    with estado['lock']:
+        if not estado['atualizado']:
+            estado['atualizado'] = aplicar_migracoes()
+
+# =============================================================================
+# FUNÇÕES DE AUTENTICAÇÃO E TABELA USUARIOS (COM EXPANSÃO DE CAMPOS)
+# =============================================================================
+
 def login_user(username, password):
     """Autentica usuário"""
     conn = get_db_connection()
@@ -394,6 +1147,7 @@ def criar_usuario(username, password, permissao, email=None,
         ))
 
         conn.commit()
+        invalidar_cache('usuarios')
         return True, f"Usuário '{username}' criado com sucesso!"
 
     except Error as e:
@@ -406,28 +1160,10 @@ def get_all_users():
     """Busca todos os usuários (apenas admin) com campos expandidos"""
     if not user_is_admin():
         return []
+    # Mesma consulta da agenda: compartilha o resultado em cache
+    return get_all_users_for_agenda()
 
-    conn = get_db_connection()
-    if not conn:
-        return []
-
-    try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT username, email, permissao, created_at,
-                   nome_completo, telefone, endereco,
-                   data_aniversario, data_iniciacao, data_elevacao,
-                   data_exaltacao, data_instalacao_posse, observacoes, redes_sociais
-            FROM usuarios
-            ORDER BY nome_completo, username
-        ''')
-        return cursor.fetchall()
-    except Error:
-        return []
-    finally:
-        if conn:
-            conn.close()
-
+@cache_consulta('usuarios')
 def get_all_users_for_agenda():
     """Busca todos os usuários para a agenda de contatos (todos podem acessar)"""
     conn = get_db_connection()
@@ -537,6 +1273,7 @@ def update_user(username, email=None, permissao=None, nome_completo=None,
         
         cursor.execute(query, values)
         conn.commit()
+        invalidar_cache('usuarios')
         return True, "Usuário atualizado com sucesso"
         
     except Error as e:
@@ -565,6 +1302,7 @@ def update_user_permission(username, nova_permissao):
             (nova_permissao, username)
         )
         conn.commit()
+        invalidar_cache('usuarios')
         return True, "Permissão atualizada com sucesso"
     except Error as e:
         return False, f"Erro ao atualizar: {e}"
@@ -587,7 +1325,9 @@ def delete_user(username):
     try:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM usuarios WHERE username = %s', (username,))
+        _registrar_exclusao(cursor, 'usuarios', [username])
         conn.commit()
+        invalidar_cache('usuarios')
         return True, "Usuário excluído com sucesso"
     except Error as e:
         return False, f"Erro ao excluir: {e}"
@@ -620,71 +1360,80 @@ def change_password(username, new_password):
 # FUNÇÕES PRINCIPAIS (LANCAMENTOS, CONTAS, EVENTOS...)
 # =============================================================================
 
-def init_db():
-    """Inicializa as demais tabelas do sistema"""
+def _registrar_exclusao(cursor, tabela, chaves):
+    """Grava tombstones das chaves excluídas (consumidos pelo backup incremental)"""
+    if chaves:
+        cursor.executemany(
+            'INSERT INTO registro_exclusoes (tabela, chave) VALUES (%s, %s)',
+            [(tabela, str(chave)) for chave in chaves]
+        )
+
+@cache_consulta('contas')
+def get_contas():
     conn = get_db_connection()
     if not conn:
-        return
-
+        return []
     try:
         cursor = conn.cursor()
-
-        # Tabela de lançamentos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS lancamentos (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                mes VARCHAR(50) NOT NULL,
-                data DATE NOT NULL,
-                historico TEXT NOT NULL,
-                complemento TEXT,
-                entrada DECIMAL(15,2) DEFAULT 0.00,
-                saida DECIMAL(15,2) DEFAULT 0.00,
-                saldo DECIMAL(15,2) DEFAULT 0.00,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Tabela de contas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contas (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                nome VARCHAR(100) UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Tabela de eventos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS eventos_calendario (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                titulo VARCHAR(200) NOT NULL,
-                descricao TEXT,
-                data_evento DATE NOT NULL,
-                hora_evento TIME,
-                tipo_evento VARCHAR(50),
-                cor_evento VARCHAR(20),
-                created_by VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        conn.commit()
-    except Error as e:
-        st.error(f"❌ Erro ao criar tabelas: {e}")
+        cursor.execute('SELECT nome FROM contas ORDER BY nome')
+        return [row[0] for row in cursor.fetchall()]
+    except Error:
+        return []
     finally:
         if conn:
             conn.close()
 
-def get_contas():
+# Nome da conta correspondente a um histórico (contas.nome é VARCHAR(100));
+# a collation padrão já ignora maiúsculas e acentos na comparação
+CONTA_DO_HISTORICO = 'LEFT(TRIM({}), 100)'
+
+def _vincular_contas(cursor, ano=None, mes=None):
+    """
+    Preenche conta_id dos lançamentos ainda sem conta cujo histórico é o
+    nome de uma conta, numa única UPDATE com junção (opcionalmente só no
+    período). Retorna a quantidade de lançamentos vinculados.
+    """
+    filtro = ' AND l.ano = %s AND l.mes = %s' if ano is not None else ''
+    cursor.execute(f'''
+        UPDATE lancamentos l
+        JOIN contas c ON c.nome = {CONTA_DO_HISTORICO.format('l.historico')}
+        SET l.conta_id = c.id
+        WHERE l.conta_id IS NULL{filtro}
+    ''', (ano, mes) if ano is not None else ())
+    return cursor.rowcount
+
+def vincular_lancamentos_contas(criar_contas=False):
+    """
+    Vínculo em massa dos lançamentos existentes às contas pelo histórico,
+    um período por vez (transações curtas). Com criar_contas, cada histórico
+    ainda sem conta vira uma conta nova antes do vínculo.
+    """
     conn = get_db_connection()
     if not conn:
-        return []
+        return None
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT nome FROM contas ORDER BY nome')
-        return [row[0] for row in cursor.fetchall()]
-    except Error:
-        return []
+        contas_criadas = 0
+        if criar_contas:
+            cursor.execute(f'''
+                INSERT IGNORE INTO contas (nome)
+                SELECT DISTINCT {CONTA_DO_HISTORICO.format('historico')} FROM lancamentos
+                WHERE conta_id IS NULL AND TRIM(historico) <> ''
+            ''')
+            contas_criadas = cursor.rowcount
+            conn.commit()
+
+        vinculados = 0
+        for ano, mes in get_periodos_lancamentos():
+            vinculados += _vincular_contas(cursor, ano, mes)
+            conn.commit()
+
+        invalidar_cache('lancamentos', 'contas')
+        return contas_criadas, vinculados
+    except Error as e:
+        conn.rollback()
+        st.error(f"❌ Erro ao vincular lançamentos às contas: {e}")
+        return None
     finally:
         if conn:
             conn.close()
@@ -697,6 +1446,7 @@ def adicionar_conta(nome_conta):
         cursor = conn.cursor()
         cursor.execute('INSERT INTO contas (nome) VALUES (%s)', (nome_conta,))
         conn.commit()
+        invalidar_cache('contas')
         st.success(f"✅ Conta '{nome_conta}' adicionada com sucesso!")
         return True
     except Error as e:
@@ -706,13 +1456,14 @@ def adicionar_conta(nome_conta):
         if conn:
             conn.close()
 
-def get_lancamentos_mes(mes):
+@cache_consulta('lancamentos')
+def get_lancamentos_mes(ano, mes):
     conn = get_db_connection()
     if not conn:
         return pd.DataFrame()
     try:
-        query = 'SELECT * FROM lancamentos WHERE mes = %s ORDER BY data, id'
-        df = pd.read_sql(query, conn, params=[mes])
+        query = 'SELECT * FROM lancamentos WHERE ano = %s AND mes = %s ORDER BY data, id'
+        df = pd.read_sql(query, conn, params=[ano, mes])
         return df
     except Exception as e:
         st.error(f"Erro ao buscar lançamentos: {e}")
@@ -721,110 +1472,494 @@ def get_lancamentos_mes(mes):
         if conn:
             conn.close()
 
-def get_lancamento_by_id(lancamento_id):
-    """Busca um lançamento específico pelo ID"""
+@cache_consulta('lancamentos')
+def get_pagina_lancamentos(ano, mes, limite, apos=None):
+    """
+    Busca uma página do período por keyset em (data, id): apos é a posição
+    (data, id) da última linha da página anterior, ou None para a primeira.
+    Retorna até limite + 1 linhas; a linha extra indica que há próxima página.
+    """
     conn = get_db_connection()
     if not conn:
-        return None
+        return pd.DataFrame()
     try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM lancamentos WHERE id = %s', (lancamento_id,))
-        result = cursor.fetchone()
-        return result
-    except Error:
-        return None
+        if apos is None:
+            query = 'SELECT * FROM lancamentos WHERE ano = %s AND mes = %s ORDER BY data, id LIMIT %s'
+            params = [ano, mes, limite + 1]
+        else:
+            data_apos, id_apos = apos
+            query = '''
+                SELECT * FROM lancamentos
+                WHERE ano = %s AND mes = %s AND (data > %s OR (data = %s AND id > %s))
+                ORDER BY data, id LIMIT %s
+            '''
+            params = [ano, mes, data_apos, data_apos, id_apos, limite + 1]
+        df = pd.read_sql(query, conn, params=params)
+        return df
+    except Exception as e:
+        st.error(f"Erro ao buscar lançamentos: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
-def salvar_lancamento(mes, data, historico, complemento, entrada, saida, saldo):
+def get_periodos_lancamentos():
+    """Lista os períodos (ano, mês) que possuem lançamentos, em ordem cronológica"""
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT ano, mes FROM lancamentos')
+        periodos = cursor.fetchall()
+        return sorted(periodos, key=lambda p: (p[0], MESES.index(p[1]) if p[1] in MESES else 12))
+    except Error:
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def _ajustar_resumo(cursor, ano, mes, delta_entrada, delta_saida, delta_quantidade):
+    """
+    Aplica a variação de um lançamento ao resumo do período. Deve rodar na
+    mesma transação da escrita em lancamentos para os totais não divergirem.
+    """
+    cursor.execute('''
+        INSERT INTO resumo_lancamentos (ano, mes, total_entradas, total_saidas, saldo_final, quantidade)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            total_entradas = total_entradas + VALUES(total_entradas),
+            total_saidas = total_saidas + VALUES(total_saidas),
+            saldo_final = saldo_final + VALUES(saldo_final),
+            quantidade = quantidade + VALUES(quantidade)
+    ''', (ano, mes, delta_entrada, delta_saida, delta_entrada - delta_saida, delta_quantidade))
+
+def _reconstruir_resumos(cursor):
+    """Recalcula todos os resumos a partir dos lançamentos (um GROUP BY)"""
+    cursor.execute('DELETE FROM resumo_lancamentos')
+    cursor.execute('''
+        INSERT INTO resumo_lancamentos (ano, mes, total_entradas, total_saidas, saldo_final, quantidade)
+        SELECT ano, mes, COALESCE(SUM(entrada), 0), COALESCE(SUM(saida), 0),
+               COALESCE(SUM(entrada - saida), 0), COUNT(*)
+        FROM lancamentos
+        GROUP BY ano, mes
+    ''')
+
+def reconstruir_resumos():
+    """Comando de reparo: reconstrói a tabela resumo_lancamentos"""
     conn = get_db_connection()
     if not conn:
         return False
     try:
         cursor = conn.cursor()
+        _reconstruir_resumos(cursor)
+        conn.commit()
+        invalidar_cache('lancamentos')
+        st.success("✅ Resumos por período reconstruídos com sucesso!")
+        return True
+    except Error as e:
+        conn.rollback()
+        st.error(f"❌ Erro ao reconstruir resumos: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def reconciliar_saldos(reparar=False):
+    """
+    Confere o saldo gravado de todos os lançamentos numa única passada: lê os
+    valores em centavos na ordem (ano, mes, data, id) e calcula o saldo esperado
+    de todos os períodos com um só np.cumsum, descontando o acumulado no início
+    de cada período. Com `reparar`, os períodos divergentes são recalculados
+    (com bloqueio das linhas e UPDATE em lote) e os resumos reconstruídos.
+    Retorna (lançamentos conferidos, DataFrame das divergências por período).
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        colunas = ['id', 'ano', 'mes', 'entrada', 'saida', 'saldo', 'nulo']
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute(f'''
+                SELECT id, ano, mes, {CENTAVOS_SQL.format('entrada')}, {CENTAVOS_SQL.format('saida')},
+                       {CENTAVOS_SQL.format('saldo')}, saldo IS NULL
+                FROM lancamentos ORDER BY ano, mes, data, id
+            ''')
+            blocos = []
+            while True:
+                linhas = cursor.fetchmany(EXPORTACAO_BLOCO)
+                if not linhas:
+                    break
+                blocos.append(pd.DataFrame(linhas, columns=colunas))
+        finally:
+            cursor.close()
+        df = pd.concat(blocos, ignore_index=True) if blocos else pd.DataFrame(columns=colunas)
+
+        # Acumulado global menos o acumulado antes da primeira linha de cada período
+        movimento = df['entrada'].to_numpy(dtype=np.int64) - df['saida'].to_numpy(dtype=np.int64)
+        acumulado = np.cumsum(movimento, dtype=np.int64)
+        inicio_periodo = ((df['ano'] != df['ano'].shift()) | (df['mes'] != df['mes'].shift())).to_numpy()
+        primeira_linha = np.maximum.accumulate(np.where(inicio_periodo, np.arange(len(df)), 0))
+        esperado = acumulado - (acumulado - movimento)[primeira_linha]
+
+        df['diferenca'] = esperado - df['saldo'].to_numpy(dtype=np.int64)
+        divergentes = df[(df['diferenca'] != 0) | (df['nulo'] == 1)]
+        relatorio = divergentes.groupby(['ano', 'mes'], sort=False).agg(
+            divergentes=('id', 'size'),
+            maior_diferenca=('diferenca', lambda d: np.abs(d).max() / 100)
+        ).reset_index()
+
+        if reparar and not relatorio.empty:
+            cursor = conn.cursor()
+            for ano, mes in zip(relatorio['ano'], relatorio['mes']):
+                _recalcular_saldos_a_partir(cursor, int(ano), mes, date(1900, 1, 1), 0)
+                conn.commit()
+            _reconstruir_resumos(cursor)
+            conn.commit()
+            invalidar_cache('lancamentos')
+        relatorio['corrigido'] = reparar
+        return len(df), relatorio
+    except Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+@cache_consulta('lancamentos')
+def get_resumo_mes(ano, mes):
+    """Totais do período lidos da tabela de resumo (uma linha)"""
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        cursor = conn.cursor(pymysql.cursors.DictCursor)
         cursor.execute('''
-            INSERT INTO lancamentos (mes, data, historico, complemento, entrada, saida, saldo)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (mes, data, historico, complemento, entrada, saida, saldo))
+            SELECT total_entradas, total_saidas, saldo_final, quantidade
+            FROM resumo_lancamentos WHERE ano = %s AND mes = %s
+        ''', (ano, mes))
+        return cursor.fetchone() or {}
+    except Error:
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+@cache_consulta('lancamentos')
+def get_resumo_ano(ano):
+    """Resumo de todos os meses do ano (no máximo 12 linhas)"""
+    conn = get_db_connection()
+    if not conn:
+        return pd.DataFrame()
+    try:
+        query = '''
+            SELECT mes, total_entradas, total_saidas, saldo_final, quantidade
+            FROM resumo_lancamentos WHERE ano = %s
+        '''
+        df = pd.read_sql(query, conn, params=[ano])
+        df['ordem'] = df['mes'].map({nome: i for i, nome in enumerate(MESES)})
+        return df.sort_values('ordem').drop(columns='ordem').reset_index(drop=True)
+    except Exception as e:
+        st.error(f"Erro ao buscar resumo do ano: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+def _consultar_relatorio(query, params, colunas_valor):
+    """Executa uma consulta agregada e converte os totais (DECIMAL) para float"""
+    conn = get_db_connection()
+    if not conn:
+        return pd.DataFrame()
+    try:
+        df = pd.read_sql(query, conn, params=params)
+        for coluna in colunas_valor:
+            df[coluna] = df[coluna].astype(float)
+        return df
+    except Exception as e:
+        st.error(f"Erro ao gerar relatório: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+@cache_consulta('lancamentos')
+def get_totais_anuais(ano_inicio, ano_fim):
+    """Totais por ano somados da tabela de resumo (no máximo 12 linhas por ano lidas)"""
+    return _consultar_relatorio('''
+        SELECT ano, SUM(total_entradas) AS entradas, SUM(total_saidas) AS saidas,
+               SUM(total_entradas) - SUM(total_saidas) AS resultado, SUM(quantidade) AS quantidade
+        FROM resumo_lancamentos WHERE ano BETWEEN %s AND %s
+        GROUP BY ano ORDER BY ano
+    ''', [ano_inicio, ano_fim], ['entradas', 'saidas', 'resultado'])
+
+@cache_consulta('lancamentos')
+def get_totais_mensais(ano_inicio, ano_fim):
+    """Totais de cada período (ano, mês) da tabela de resumo, em ordem cronológica"""
+    df = _consultar_relatorio('''
+        SELECT ano, mes, total_entradas AS entradas, total_saidas AS saidas, saldo_final, quantidade
+        FROM resumo_lancamentos WHERE ano BETWEEN %s AND %s
+    ''', [ano_inicio, ano_fim], ['entradas', 'saidas', 'saldo_final'])
+    if df.empty:
+        return df
+    df['numero_mes'] = df['mes'].map({nome: i + 1 for i, nome in enumerate(MESES)})
+    return df.sort_values(['ano', 'numero_mes']).reset_index(drop=True)
+
+@cache_consulta('lancamentos')
+def get_totais_diarios(ano_inicio, ano_fim):
+    """Entradas e saídas por dia, agregadas no banco pelo índice (ano, data, entrada, saida)"""
+    return _consultar_relatorio('''
+        SELECT data, SUM(entrada) AS entradas, SUM(saida) AS saidas, COUNT(*) AS quantidade
+        FROM lancamentos WHERE ano BETWEEN %s AND %s
+        GROUP BY ano, data ORDER BY ano, data
+    ''', [ano_inicio, ano_fim], ['entradas', 'saidas'])
+
+@cache_consulta('lancamentos', 'contas')
+def get_totais_por_conta(ano_inicio, ano_fim, mes=None):
+    """
+    Entradas e saídas por conta: o GROUP BY usa a chave inteira conta_id
+    (índice (ano, conta_id, entrada, saida)) e só o resultado é unido aos nomes.
+    """
+    filtro = 'ano BETWEEN %s AND %s' + (' AND mes = %s' if mes else '')
+    params = [ano_inicio, ano_fim] + ([mes] if mes else [])
+    return _consultar_relatorio(f'''
+        SELECT COALESCE(c.nome, '(sem conta)') AS conta, t.entradas, t.saidas, t.quantidade
+        FROM (
+            SELECT conta_id, SUM(entrada) AS entradas, SUM(saida) AS saidas, COUNT(*) AS quantidade
+            FROM lancamentos WHERE {filtro}
+            GROUP BY conta_id
+        ) t
+        LEFT JOIN contas c ON c.id = t.conta_id
+        ORDER BY t.saidas DESC
+    ''', params, ['entradas', 'saidas'])
+
+@cache_consulta('lancamentos')
+def get_maiores_saidas(ano_inicio, ano_fim, limite=10):
+    """Históricos com maior total de saídas no intervalo de anos"""
+    return _consultar_relatorio('''
+        SELECT historico, SUM(saida) AS saidas, COUNT(*) AS quantidade
+        FROM lancamentos WHERE ano BETWEEN %s AND %s AND saida > 0
+        GROUP BY historico ORDER BY saidas DESC LIMIT %s
+    ''', [ano_inicio, ano_fim, limite], ['saidas'])
+
+def get_lancamento_by_id(lancamento_id):
+    """Busca um lançamento específico pelo ID"""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM lancamentos WHERE id = %s', (lancamento_id,))
+        result = cursor.fetchone()
+        return result
+    except Error:
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def _valor_decimal(valor):
+    """Converte valores do formulário (float) para Decimal com 2 casas"""
+    return Decimal(str(valor or 0)).quantize(Decimal('0.01'))
+
+def salvar_lancamento(ano, mes, data, historico, complemento, entrada, saida):
+    """
+    Insere um lançamento no período (ano, mês) calculando o saldo no banco,
+    dentro de uma transação. O saldo vem do lançamento imediatamente anterior,
+    e lançamentos com data posterior no mesmo período (inclusão retroativa)
+    são deslocados pelo valor líquido.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        entrada = _valor_decimal(entrada)
+        saida = _valor_decimal(saida)
+        cursor = conn.cursor()
+
+        # FOR UPDATE trava a posição no índice (ano, mes, data, id) e serializa
+        # inclusões concorrentes no mesmo período
+        cursor.execute('''
+            SELECT saldo FROM lancamentos
+            WHERE ano = %s AND mes = %s AND data <= %s
+            ORDER BY data DESC, id DESC LIMIT 1
+            FOR UPDATE
+        ''', (ano, mes, data))
+        anterior = cursor.fetchone()
+        saldo_anterior = anterior[0] if anterior and anterior[0] is not None else Decimal('0.00')
+
+        cursor.execute(f'''
+            INSERT INTO lancamentos (ano, mes, data, historico, complemento, entrada, saida, saldo, conta_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s,
+                    (SELECT id FROM contas WHERE nome = {CONTA_DO_HISTORICO.format('%s')}))
+        ''', (ano, mes, data, historico, complemento, entrada, saida, saldo_anterior + entrada - saida, historico))
+        _ajustar_resumo(cursor, ano, mes, entrada, saida, 1)
+
+        # Lançamento retroativo: desloca o saldo de quem vem depois
+        cursor.execute(
+            'UPDATE lancamentos SET saldo = saldo + %s WHERE ano = %s AND mes = %s AND data > %s',
+            (entrada - saida, ano, mes, data)
+        )
         conn.commit()
+        invalidar_cache('lancamentos')
         st.success("✅ Lançamento salvo com sucesso!")
         return True
     except Error as e:
+        conn.rollback()
         st.error(f"❌ Erro ao salvar lançamento: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
-def atualizar_lancamento(lancamento_id, mes, data, historico, complemento, entrada, saida):
+# Quantidade de saldos gravados por UPDATE no recálculo
+RECALCULO_LOTE = 500
+
+# Valor DECIMAL(15,2) em centavos inteiros, convertido no próprio banco (exato)
+CENTAVOS_SQL = 'CAST(COALESCE({0}, 0) * 100 AS SIGNED)'
+
+def _saldos_em_centavos(saldo_inicial, entradas, saidas):
+    """
+    Saldo corrido em centavos (int64): saldo inicial mais a soma acumulada de
+    entradas - saídas. Inteiros não acumulam erro de arredondamento.
+    """
+    movimento = np.asarray(entradas, dtype=np.int64) - np.asarray(saidas, dtype=np.int64)
+    return saldo_inicial + np.cumsum(movimento, dtype=np.int64)
+
+def _decimal_de_centavos(centavos):
+    """Centavos inteiros de volta para o DECIMAL(15,2) gravado"""
+    return Decimal(int(centavos)).scaleb(-2)
+
+def _gravar_saldos(cursor, saldos):
+    """Grava [(id, saldo), ...] com um UPDATE ... CASE por lote"""
+    for inicio in range(0, len(saldos), RECALCULO_LOTE):
+        lote = saldos[inicio:inicio + RECALCULO_LOTE]
+        casos = ' '.join(['WHEN %s THEN %s'] * len(lote))
+        marcadores = ', '.join(['%s'] * len(lote))
+        parametros = [valor for par in lote for valor in par] + [id_ for id_, _ in lote]
+        cursor.execute(
+            f'UPDATE lancamentos SET saldo = CASE id {casos} END WHERE id IN ({marcadores})',
+            parametros
+        )
+
+def _recalcular_saldos_a_partir(cursor, ano, mes, data_inicio, id_inicio):
+    """
+    Recalcula o saldo apenas das linhas do período na posição (data, id) ou depois
+    dela, partindo do saldo da linha imediatamente anterior. Somente as linhas
+    cujo saldo mudou são regravadas. Deve rodar dentro da transação do chamador.
+    """
+    cursor.execute(f'''
+        SELECT {CENTAVOS_SQL.format('saldo')} FROM lancamentos
+        WHERE ano = %s AND mes = %s AND (data < %s OR (data = %s AND id < %s))
+        ORDER BY data DESC, id DESC LIMIT 1
+    ''', (ano, mes, data_inicio, data_inicio, id_inicio))
+    anterior = cursor.fetchone()
+    saldo_inicial = anterior[0] if anterior else 0
+
+    cursor.execute(f'''
+        SELECT id, {CENTAVOS_SQL.format('entrada')}, {CENTAVOS_SQL.format('saida')},
+               {CENTAVOS_SQL.format('saldo')}, saldo IS NULL
+        FROM lancamentos
+        WHERE ano = %s AND mes = %s AND (data > %s OR (data = %s AND id >= %s))
+        ORDER BY data, id
+        FOR UPDATE
+    ''', (ano, mes, data_inicio, data_inicio, id_inicio))
+    linhas = cursor.fetchall()
+    if not linhas:
+        return 0
+
+    ids, entradas, saidas, gravados, nulos = np.array(linhas, dtype=np.int64).T
+    saldos = _saldos_em_centavos(saldo_inicial, entradas, saidas)
+    diferentes = (saldos != gravados) | (nulos == 1)
+    alterados = [(int(id_), _decimal_de_centavos(saldo)) for id_, saldo in zip(ids[diferentes], saldos[diferentes])]
+
+    _gravar_saldos(cursor, alterados)
+    return len(alterados)
+
+def atualizar_lancamento(lancamento_id, data, historico, complemento, entrada, saida):
     conn = get_db_connection()
     if not conn:
         return False
     try:
+        entrada = _valor_decimal(entrada)
+        saida = _valor_decimal(saida)
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM lancamentos WHERE id = %s', (lancamento_id,))
+        cursor.execute(
+            'SELECT ano, mes, data, entrada, saida FROM lancamentos WHERE id = %s FOR UPDATE',
+            (lancamento_id,)
+        )
         lancamento_antigo = cursor.fetchone()
         if not lancamento_antigo:
             st.error("❌ Lançamento não encontrado")
             return False
-        cursor.execute('''
-            UPDATE lancamentos 
-            SET data = %s, historico = %s, complemento = %s, entrada = %s, saida = %s
+        # O saldo corre dentro do período gravado no próprio lançamento
+        ano, mes, data_antiga, entrada_antiga, saida_antiga = lancamento_antigo
+        cursor.execute(f'''
+            UPDATE lancamentos
+            SET data = %s, historico = %s, complemento = %s, entrada = %s, saida = %s,
+                conta_id = (SELECT id FROM contas WHERE nome = {CONTA_DO_HISTORICO.format('%s')})
             WHERE id = %s
-        ''', (data, historico, complemento, entrada, saida, lancamento_id))
-        cursor.execute('SELECT * FROM lancamentos WHERE mes = %s ORDER BY data, id', (mes,))
-        lancamentos = cursor.fetchall()
-        saldo_atual = 0.0
-        for lanc in lancamentos:
-            entrada_val = float(lanc[5]) if lanc[5] else 0.0
-            saida_val = float(lanc[6]) if lanc[6] else 0.0
-            saldo_atual += entrada_val - saida_val
-            cursor.execute('UPDATE lancamentos SET saldo = %s WHERE id = %s', (saldo_atual, lanc[0]))
+        ''', (data, historico, complemento, entrada, saida, historico, lancamento_id))
+        # Só o trecho a partir da posição mais antiga (antes/depois da edição) muda
+        _recalcular_saldos_a_partir(cursor, ano, mes, min(data_antiga, data), lancamento_id)
+        _ajustar_resumo(cursor, ano, mes, entrada - (entrada_antiga or 0), saida - (saida_antiga or 0), 0)
         conn.commit()
+        invalidar_cache('lancamentos')
         st.success("✅ Lançamento atualizado com sucesso!")
         return True
     except Error as e:
+        conn.rollback()
         st.error(f"❌ Erro ao atualizar lançamento: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
-def excluir_lancamento(lancamento_id, mes):
+def excluir_lancamento(lancamento_id):
     conn = get_db_connection()
     if not conn:
         return False
     try:
         cursor = conn.cursor()
+        cursor.execute(
+            'SELECT ano, mes, data, entrada, saida FROM lancamentos WHERE id = %s FOR UPDATE',
+            (lancamento_id,)
+        )
+        lancamento = cursor.fetchone()
+        if not lancamento:
+            st.error("❌ Lançamento não encontrado")
+            return False
+        ano, mes, data_lancamento, entrada, saida = lancamento
         cursor.execute('DELETE FROM lancamentos WHERE id = %s', (lancamento_id,))
-        cursor.execute('SELECT * FROM lancamentos WHERE mes = %s ORDER BY data, id', (mes,))
-        lancamentos = cursor.fetchall()
-        saldo_atual = 0.0
-        for lanc in lancamentos:
-            entrada_val = float(lanc[5]) if lanc[5] else 0.0
-            saida_val = float(lanc[6]) if lanc[6] else 0.0
-            saldo_atual += entrada_val - saida_val
-            cursor.execute('UPDATE lancamentos SET saldo = %s WHERE id = %s', (saldo_atual, lanc[0]))
+        _registrar_exclusao(cursor, 'lancamentos', [lancamento_id])
+        _recalcular_saldos_a_partir(cursor, ano, mes, data_lancamento, lancamento_id)
+        _ajustar_resumo(cursor, ano, mes, -(entrada or 0), -(saida or 0), -1)
         conn.commit()
+        invalidar_cache('lancamentos')
         st.success("✅ Lançamento excluído com sucesso!")
         return True
     except Error as e:
+        conn.rollback()
         st.error(f"❌ Erro ao excluir: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
-def limpar_lancamentos_mes(mes):
+def limpar_lancamentos_mes(ano, mes):
     conn = get_db_connection()
     if not conn:
         return False
     try:
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM lancamentos WHERE mes = %s', (mes,))
+        cursor.execute('SELECT id FROM lancamentos WHERE ano = %s AND mes = %s FOR UPDATE', (ano, mes))
+        _registrar_exclusao(cursor, 'lancamentos', [linha[0] for linha in cursor.fetchall()])
+        cursor.execute('DELETE FROM lancamentos WHERE ano = %s AND mes = %s', (ano, mes))
+        cursor.execute('DELETE FROM resumo_lancamentos WHERE ano = %s AND mes = %s', (ano, mes))
         conn.commit()
-        st.success(f"✅ Todos os lançamentos de {mes} foram excluídos!")
+        invalidar_cache('lancamentos')
+        st.success(f"✅ Todos os lançamentos de {mes}/{ano} foram excluídos!")
         return True
     except Error as e:
         st.error(f"❌ Erro ao limpar lançamentos: {e}")
@@ -833,292 +1968,2170 @@ def limpar_lancamentos_mes(mes):
         if conn:
             conn.close()
 
-def get_eventos_mes(ano, mes):
+@cache_consulta('eventos_calendario')
+def get_eventos_mes(ano, mes):
+    conn = get_db_connection()
+    if not conn:
+        return pd.DataFrame()
+    try:
+        data_inicio = f"{ano}-{mes:02d}-01"
+        if mes == 12:
+            data_fim = f"{ano+1}-01-01"
+        else:
+            data_fim = f"{ano}-{mes+1:02d}-01"
+        query = '''
+            SELECT * FROM eventos_calendario 
+            WHERE data_evento >= %s AND data_evento < %s 
+            ORDER BY data_evento, hora_evento
+        '''
+        df = pd.read_sql(query, conn, params=[data_inicio, data_fim])
+        return df
+    except Exception as e:
+        st.error(f"Erro ao buscar eventos: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+@cache_consulta('eventos_calendario')
+def get_indice_eventos_mes(ano, mes):
+    """
+    Eventos do mês agrupados por dia: {date: [evento, ...]}, na ordem de
+    get_eventos_mes. Montado uma vez por versão dos dados (o cache é descartado
+    quando eventos_calendario muda); a grade do calendário só consulta o dicionário.
+    """
+    df_eventos = get_eventos_mes(ano, mes)
+    if df_eventos.empty:
+        return {}
+    dias = pd.to_datetime(df_eventos['data_evento']).dt.date
+    return {dia: grupo.to_dict('records') for dia, grupo in df_eventos.groupby(dias, sort=False)}
+
+def get_evento_by_id(evento_id):
+    """Busca um evento específico pelo ID"""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM eventos_calendario WHERE id = %s', (evento_id,))
+        result = cursor.fetchone()
+        return result
+    except Error:
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def gerar_calendario(ano, mes):
+    cal = calendar.Calendar(firstweekday=6)  # Domingo como primeiro dia
+    return cal.monthdatescalendar(ano, mes)
+
+def salvar_evento(titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento):
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO eventos_calendario (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, created_by)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, st.session_state.username))
+        conn.commit()
+        invalidar_cache('eventos_calendario')
+        st.success("✅ Evento salvo com sucesso!")
+        return True
+    except Error as e:
+        st.error(f"❌ Erro ao salvar evento: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def atualizar_evento(evento_id, titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento):
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE eventos_calendario 
+            SET titulo = %s, descricao = %s, data_evento = %s, hora_evento = %s, tipo_evento = %s, cor_evento = %s
+            WHERE id = %s
+        ''', (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, evento_id))
+        conn.commit()
+        invalidar_cache('eventos_calendario')
+        st.success("✅ Evento atualizado com sucesso!")
+        return True
+    except Error as e:
+        st.error(f"❌ Erro ao atualizar evento: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def excluir_evento(evento_id):
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM eventos_calendario WHERE id = %s', (evento_id,))
+        _registrar_exclusao(cursor, 'eventos_calendario', [evento_id])
+        conn.commit()
+        invalidar_cache('eventos_calendario')
+        st.success("✅ Evento excluído com sucesso!")
+        return True
+    except Error as e:
+        st.error(f"❌ Erro ao excluir: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def download_csv_mes(ano, mes):
+    df = get_lancamentos_mes(ano, mes)
+    if df.empty:
+        return None
+    return df.to_csv(index=False, encoding='utf-8')
+
+# Leitura em blocos do cursor sem buffer e limite do arquivo em memória
+EXPORTACAO_BLOCO = 1000
+EXPORTACAO_MEMORIA_MAXIMA = 8 * 1024 * 1024  # acima disso o ZIP vai para disco
+
+def _stream_csv_para_zip(zip_file, cursor, nome_membro):
+    """
+    Escreve as linhas de um cursor já executado (SSCursor) como CSV dentro do
+    ZIP, sem montar DataFrames. nome_membro(linha) escolhe o arquivo de cada
+    linha; linhas consecutivas com o mesmo nome vão para o mesmo membro.
+    Retorna o total de linhas escritas.
+    """
+    colunas = [descricao[0] for descricao in cursor.description]
+    membro_atual = None
+    saida = None
+    escritor = None
+    total = 0
+    try:
+        while True:
+            linhas = cursor.fetchmany(EXPORTACAO_BLOCO)
+            if not linhas:
+                break
+            for linha in linhas:
+                nome = nome_membro(linha)
+                if nome != membro_atual:
+                    if saida:
+                        saida.close()
+                    saida = io.TextIOWrapper(zip_file.open(nome, 'w', force_zip64=True), encoding='utf-8', newline='')
+                    escritor = csv.writer(saida, lineterminator='\n')
+                    escritor.writerow(colunas)
+                    membro_atual = nome
+                escritor.writerow(linha)
+            total += len(linhas)
+    finally:
+        if saida:
+            saida.close()
+    return total
+
+# Colunas de usuários exportadas em backups (nunca a senha)
+COLUNAS_USUARIOS_BACKUP = '''username, email, permissao, nome_completo, telefone, endereco,
+    data_aniversario, data_iniciacao, data_elevacao, data_exaltacao,
+    data_instalacao_posse, observacoes, redes_sociais, created_at, updated_at'''
+
+def _exportar_tabelas_zip(conn, zip_file, prefixo=''):
+    """
+    Grava lançamentos (um CSV por período), contas, eventos e usuários (sem
+    senha) no ZIP, lendo cada tabela uma única vez com cursor sem buffer.
+    """
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        # Lançamentos: uma leitura ordenada pelo índice de período, um CSV por (ano, mês)
+        cursor.execute('SELECT * FROM lancamentos ORDER BY ano, mes, data, id')
+        colunas = [descricao[0] for descricao in cursor.description]
+        pos_ano, pos_mes = colunas.index('ano'), colunas.index('mes')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}lancamentos_{linha[pos_ano]}_{linha[pos_mes]}.csv")
+
+        cursor.execute('SELECT * FROM contas')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}contas.csv")
+
+        cursor.execute('SELECT * FROM eventos_calendario')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}eventos.csv")
+
+        cursor.execute(f'SELECT {COLUNAS_USUARIOS_BACKUP} FROM usuarios')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}usuarios.csv")
+
+        # Recorrências e o registro do que já foi gerado (evita gerar de novo após restaurar)
+        cursor.execute('SELECT * FROM lancamentos_recorrentes')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}recorrentes.csv")
+
+        cursor.execute('SELECT * FROM recorrencias_materializadas')
+        _stream_csv_para_zip(zip_file, cursor, lambda linha: f"{prefixo}recorrencias_materializadas.csv")
+    finally:
+        cursor.close()
+
+def exportar_para_csv(compressao=zipfile.ZIP_DEFLATED, nivel=None):
+    """
+    Exporta todas as tabelas para um ZIP de CSVs em uma única passada por
+    tabela, lendo com cursor sem buffer (SSCursor) e escrevendo direto nos
+    membros do ZIP, que fica num arquivo temporário (vai para disco se crescer).
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_MEMORIA_MAXIMA) as arquivo_zip:
+            with _abrir_zip(arquivo_zip, compressao, nivel) as zip_file:
+                _exportar_tabelas_zip(conn, zip_file)
+            # O download do Streamlit exige bytes: única cópia do ZIP em memória
+            arquivo_zip.seek(0)
+            return arquivo_zip.read()
+    finally:
+        conn.close()
+
+# =============================================================================
+# EXPORTAÇÃO COLUNAR (PARQUET)
+# =============================================================================
+
+PARQUET_GRUPO_LINHAS = 50000  # linhas por row group (e por escrita no arquivo)
+
+def _importar_pyarrow():
+    """Importa o pyarrow sob demanda: dependência opcional, usada só nesta exportação"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError(f"A exportação Parquet requer o pacote pyarrow (pip install pyarrow): {e}")
+    return pa, pq
+
+def _tipo_arrow(pa, descricao):
+    """Tipo Arrow equivalente a uma coluna do cursor (cursor.description)"""
+    tipo_mysql, tamanho, escala = descricao[1], descricao[3], descricao[5]
+    if tipo_mysql in (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL):
+        return pa.decimal128(min(max(tamanho or 38, 1), 38), escala or 0)
+    if tipo_mysql == FIELD_TYPE.DATE:
+        return pa.date32()
+    if tipo_mysql in (FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP):
+        return pa.timestamp('s')
+    if tipo_mysql == FIELD_TYPE.TIME:
+        return pa.time32('s')
+    if tipo_mysql == FIELD_TYPE.LONGLONG:
+        return pa.int64()
+    if tipo_mysql in (FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.INT24, FIELD_TYPE.YEAR):
+        return pa.int32()
+    if tipo_mysql in (FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE):
+        return pa.float64()
+    return pa.string()
+
+def _numero_mes(mes, data_lancamento):
+    """Número do mês de um período (nome em MESES; a data como reserva)"""
+    return MESES.index(mes) + 1 if mes in MESES else data_lancamento.month
+
+def _tabela_arrow(pa, esquema, linhas):
+    """Monta uma tabela Arrow tipada a partir de linhas do cursor"""
+    colunas = [list(valores) for valores in zip(*linhas)]
+    for j, campo in enumerate(esquema):
+        if pa.types.is_time(campo.type):
+            # pymysql devolve TIME como timedelta; o Arrow espera hora do dia
+            colunas[j] = [None if v is None else (datetime.min + v).time() for v in colunas[j]]
+    return pa.Table.from_arrays(
+        [pa.array(valores, type=campo.type) for valores, campo in zip(colunas, esquema)],
+        schema=esquema
+    )
+
+def _stream_parquet_para_zip(pa, pq, zip_file, cursor, particao, descartar=()):
+    """
+    Escreve as linhas de um cursor já executado (SSCursor) como Parquet dentro
+    do ZIP, com tipos preservados (DECIMAL, DATE, TIME, TIMESTAMP). particao(linha)
+    escolhe o diretório (estilo Hive, ex.: ano=2024/mes=01); linhas consecutivas
+    da mesma partição vão para o mesmo arquivo, em row groups de até
+    PARQUET_GRUPO_LINHAS. Uma partição que reaparece depois de outra (ordem do
+    cursor diferente da chave da partição) ganha um novo part-N, sem repetir
+    nomes no ZIP. Colunas em `descartar` já estão no caminho da partição.
+    Retorna o total de linhas escritas.
+    """
+    descricao = cursor.description
+    manter = [i for i, d in enumerate(descricao) if d[0] not in descartar]
+    esquema = pa.schema([(descricao[i][0], _tipo_arrow(pa, descricao[i])) for i in manter])
+
+    particao_atual = None
+    destino = None
+    escritor = None
+    pendentes = []
+    total = 0
+    arquivos_por_particao = {}
+
+    def fechar_particao():
+        escritor.close()
+        numero = arquivos_por_particao.get(particao_atual, 0)
+        arquivos_por_particao[particao_atual] = numero + 1
+        # Parquet já é comprimido: o membro vai sem recompressão
+        zip_file.writestr(f"{particao_atual}/part-{numero}.parquet", destino.getvalue().to_pybytes(),
+                          compress_type=zipfile.ZIP_STORED)
+
+    while True:
+        linhas = cursor.fetchmany(EXPORTACAO_BLOCO)
+        if not linhas:
+            break
+        for linha in linhas:
+            nome = particao(linha)
+            if pendentes and (nome != particao_atual or len(pendentes) >= PARQUET_GRUPO_LINHAS):
+                escritor.write_table(_tabela_arrow(pa, esquema, pendentes))
+                pendentes = []
+            if nome != particao_atual:
+                if escritor:
+                    fechar_particao()
+                destino = pa.BufferOutputStream()
+                escritor = pq.ParquetWriter(destino, esquema, compression='zstd')
+                particao_atual = nome
+            pendentes.append([linha[i] for i in manter])
+        total += len(linhas)
+
+    if pendentes:
+        escritor.write_table(_tabela_arrow(pa, esquema, pendentes))
+    if escritor:
+        fechar_particao()
+    return total
+
+def exportar_para_parquet():
+    """
+    Exporta lançamentos, eventos e contas em Parquet: um ZIP com diretórios
+    particionados por ano/mês, legível por pyarrow.dataset, pandas, DuckDB etc.
+    Lê cada tabela uma única vez com cursor sem buffer (SSCursor).
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    pa, pq = _importar_pyarrow()
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_MEMORIA_MAXIMA) as arquivo_zip:
+            with zipfile.ZipFile(arquivo_zip, 'w') as zip_file:
+                cursor = conn.cursor(pymysql.cursors.SSCursor)
+                try:
+                    cursor.execute('SELECT * FROM lancamentos ORDER BY ano, mes, data, id')
+                    colunas = [descricao[0] for descricao in cursor.description]
+                    pos_ano, pos_mes, pos_data = colunas.index('ano'), colunas.index('mes'), colunas.index('data')
+                    _stream_parquet_para_zip(
+                        pa, pq, zip_file, cursor,
+                        lambda linha: f"lancamentos/ano={linha[pos_ano]}/mes={_numero_mes(linha[pos_mes], linha[pos_data]):02d}",
+                        descartar=('ano', 'mes')
+                    )
+
+                    cursor.execute('SELECT * FROM eventos_calendario ORDER BY data_evento, hora_evento, id')
+                    pos_evento = [descricao[0] for descricao in cursor.description].index('data_evento')
+                    _stream_parquet_para_zip(
+                        pa, pq, zip_file, cursor,
+                        lambda linha: f"eventos_calendario/ano={linha[pos_evento].year}/mes={linha[pos_evento].month:02d}"
+                    )
+
+                    cursor.execute('SELECT * FROM contas ORDER BY id')
+                    _stream_parquet_para_zip(pa, pq, zip_file, cursor, lambda linha: "contas")
+                finally:
+                    cursor.close()
+            arquivo_zip.seek(0)
+            return arquivo_zip.read()
+    finally:
+        conn.close()
+
+# =============================================================================
+# RELATÓRIOS MENSAIS EM PDF
+# =============================================================================
+
+PDF_MARGEM = 40
+PDF_ALTURA_LINHA = 14
+PDF_TTL = 3600  # PDFs são caros de gerar e só mudam com os dados do período
+# Colunas da tabela: (título, posição x, alinhada à direita)
+PDF_COLUNAS = [("Data", 40, False), ("Histórico", 100, False), ("Entrada", 385, True),
+               ("Saída", 465, True), ("Saldo", 555, True)]
+PDF_HISTORICO_MAXIMO = 48  # caracteres do histórico que cabem na coluna
+
+def _versoes_periodos(cursor, ano, meses=None):
+    """
+    Versão dos dados de cada período do ano: {mes: (quantidade, impressão)}.
+    Qualquer inclusão, alteração ou exclusão muda a impressão (CRC32 das linhas),
+    inclusive alterações feitas por outros processos.
+    """
+    filtro = f" AND mes IN ({', '.join(['%s'] * len(meses))})" if meses else ''
+    linha = _texto_linha_sql(['id', 'data', 'historico', 'complemento', 'entrada', 'saida', 'saldo'])
+    cursor.execute(f'''
+        SELECT mes, COUNT(*), COALESCE(BIT_XOR(CRC32({linha})), 0)
+        FROM lancamentos WHERE ano = %s{filtro}
+        GROUP BY mes
+    ''', [ano] + list(meses or []))
+    return {mes: (int(quantidade), int(impressao)) for mes, quantidade, impressao in cursor.fetchall()}
+
+def _pdf_cabecalho(pdf, ano, mes, resumo):
+    """Título e totais do período; retorna a altura onde a tabela começa"""
+    largura, altura = A4
+    y = altura - PDF_MARGEM
+    pdf.setFont("Helvetica-Bold", 16)
+    pdf.drawString(PDF_MARGEM, y, f"Livro Caixa - {mes}/{ano}")
+    pdf.setFont("Helvetica", 8)
+    pdf.drawRightString(largura - PDF_MARGEM, y, f"Gerado em {datetime.now().strftime('%d/%m/%Y %H:%M')}")
+
+    y -= 30
+    totais = [("Total Entradas", resumo[0]), ("Total Saídas", resumo[1]),
+              ("Saldo Final", resumo[2]), ("Lançamentos", resumo[3])]
+    largura_caixa = (largura - 2 * PDF_MARGEM) / len(totais)
+    for posicao, (rotulo, valor) in enumerate(totais):
+        x = PDF_MARGEM + posicao * largura_caixa
+        pdf.rect(x + 2, y - 22, largura_caixa - 4, 34)
+        pdf.setFont("Helvetica", 8)
+        pdf.drawString(x + 8, y, rotulo)
+        pdf.setFont("Helvetica-Bold", 11)
+        pdf.drawString(x + 8, y - 15, str(valor) if rotulo == "Lançamentos" else formatar_moeda(valor))
+    return y - 45
+
+def _pdf_titulos_tabela(pdf, y):
+    pdf.setFont("Helvetica-Bold", 9)
+    for titulo, x, direita in PDF_COLUNAS:
+        (pdf.drawRightString if direita else pdf.drawString)(x, y, titulo)
+    pdf.line(PDF_MARGEM, y - 4, A4[0] - PDF_MARGEM, y - 4)
+    pdf.setFont("Helvetica", 9)
+    return y - PDF_ALTURA_LINHA - 2
+
+def _pdf_fechar_pagina(pdf, pagina):
+    """Numera e fecha a página atual; retorna o topo útil da próxima"""
+    pdf.setFont("Helvetica", 8)
+    pdf.drawRightString(A4[0] - PDF_MARGEM, PDF_MARGEM / 2, f"Página {pagina}")
+    pdf.showPage()
+    return A4[1] - PDF_MARGEM
+
+def _pdf_grafico_saldo(pdf, y, saldos_diarios, dias_no_mes):
+    """Gráfico de linha do saldo de fechamento de cada dia com movimento"""
+    largura_grafico = A4[0] - 2 * PDF_MARGEM - 60
+    altura_grafico = 160
+    x0, y0 = PDF_MARGEM + 60, y - altura_grafico
+
+    pdf.setFont("Helvetica-Bold", 11)
+    pdf.drawString(PDF_MARGEM, y + 12, "Evolução do Saldo")
+    pdf.rect(x0, y0, largura_grafico, altura_grafico)
+
+    valores = [0.0] + list(saldos_diarios.values())
+    minimo, maximo = min(valores), max(valores)
+    faixa = (maximo - minimo) or 1.0
+    escala_x = lambda dia: x0 + (dia - 1) / max(dias_no_mes - 1, 1) * largura_grafico
+    escala_y = lambda valor: y0 + (valor - minimo) / faixa * altura_grafico
+
+    pdf.setFont("Helvetica", 7)
+    for valor in (minimo, maximo):
+        pdf.drawRightString(x0 - 4, escala_y(valor) - 2, formatar_moeda(valor))
+    for dia in (1, dias_no_mes):
+        pdf.drawCentredString(escala_x(dia), y0 - 10, f"{dia:02d}")
+    if minimo < 0 < maximo:
+        pdf.setDash(2, 2)
+        pdf.line(x0, escala_y(0), x0 + largura_grafico, escala_y(0))
+        pdf.setDash()
+
+    if saldos_diarios:
+        caminho = pdf.beginPath()
+        for posicao, (dia, saldo) in enumerate(saldos_diarios.items()):
+            if posicao == 0:
+                caminho.moveTo(escala_x(dia), escala_y(saldo))
+            else:
+                caminho.lineTo(escala_x(dia), escala_y(saldo))
+        pdf.setLineWidth(1.5)
+        pdf.drawPath(caminho, stroke=1, fill=0)
+        pdf.setLineWidth(1)
+
+def _desenhar_relatorio_mes(pdf, cursor, ano, mes):
+    """
+    Desenha o relatório de um período no canvas. As linhas chegam do banco em
+    blocos (cursor sem buffer) e são formatadas bloco a bloco, sem DataFrame do
+    mês inteiro. O reportlab, porém, guarda as páginas fechadas (comprimidas)
+    até o save(): o PDF de um mês fica todo em memória.
+    """
+    cursor.execute('''
+        SELECT total_entradas, total_saidas, saldo_final, quantidade
+        FROM resumo_lancamentos WHERE ano = %s AND mes = %s
+    ''', (ano, mes))
+    resumo = cursor.fetchone() or (0, 0, 0, 0)
+    y = _pdf_titulos_tabela(pdf, _pdf_cabecalho(pdf, ano, mes, resumo))
+    pagina = 1
+
+    cursor.execute('''
+        SELECT data, historico, entrada, saida, saldo FROM lancamentos
+        WHERE ano = %s AND mes = %s ORDER BY data, id
+    ''', (ano, mes))
+    saldos_diarios = {}
+    dias_no_mes = None
+    while True:
+        linhas = cursor.fetchmany(EXPORTACAO_BLOCO)
+        if not linhas:
+            break
+        bloco = pd.DataFrame(linhas, columns=['data', 'historico', 'entrada', 'saida', 'saldo'])
+        # Formatação vetorizada do bloco inteiro
+        textos = zip(pd.to_datetime(bloco['data']).dt.strftime('%d/%m/%Y'),
+                     bloco['historico'].fillna('').str.slice(0, PDF_HISTORICO_MAXIMO),
+                     formatar_moeda(bloco['entrada'], vazio_se_zero=True),
+                     formatar_moeda(bloco['saida'], vazio_se_zero=True),
+                     formatar_moeda(bloco['saldo']))
+        for texto in textos:
+            if y < PDF_MARGEM + PDF_ALTURA_LINHA:
+                y = _pdf_titulos_tabela(pdf, _pdf_fechar_pagina(pdf, pagina))
+                pagina += 1
+            for valor, (_, x, direita) in zip(texto, PDF_COLUNAS):
+                (pdf.drawRightString if direita else pdf.drawString)(x, y, valor)
+            y -= PDF_ALTURA_LINHA
+        for data_linha, saldo in zip(bloco['data'], bloco['saldo']):
+            saldos_diarios[data_linha.day] = float(saldo)
+            dias_no_mes = dias_no_mes or calendar.monthrange(data_linha.year, data_linha.month)[1]
+
+    if not saldos_diarios:
+        pdf.drawString(PDF_MARGEM, y, "Nenhum lançamento no período.")
+    else:
+        # O gráfico vai abaixo da tabela ou numa página nova se não couber
+        if y < PDF_MARGEM + 220:
+            y = _pdf_fechar_pagina(pdf, pagina) + 20
+            pagina += 1
+        _pdf_grafico_saldo(pdf, y - 40, saldos_diarios, dias_no_mes)
+    _pdf_fechar_pagina(pdf, pagina)
+
+@cache_consulta(ttl=PDF_TTL)
+def _pdf_periodo(ano, mes, versao):
+    """
+    PDF de um período. A versão dos dados faz parte da chave do cache, então
+    o cache não depende da tabela: gravar em um mês não descarta os PDFs dos
+    outros, e o PDF antigo do próprio mês só sai por TTL/LRU.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        # O PDF já fica inteiro em memória (canvas e cache): um buffer basta
+        arquivo = io.BytesIO()
+        pdf = canvas.Canvas(arquivo, pagesize=A4, pageCompression=1)
+        pdf.setTitle(f"Livro Caixa - {mes}/{ano}")
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            _desenhar_relatorio_mes(pdf, cursor, ano, mes)
+        finally:
+            cursor.close()
+        pdf.save()
+        return arquivo.getvalue()
+    finally:
+        conn.close()
+
+def _versoes_relatorios(ano, meses=None):
+    """Versões dos períodos lidas com uma conexão própria (ver _versoes_periodos)"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        return _versoes_periodos(conn.cursor(), ano, meses)
+    finally:
+        conn.close()
+
+def gerar_relatorios_pdf(ano, meses=None):
+    """
+    Relatórios em PDF de um ou vários meses do ano (todos com lançamentos se
+    `meses` não for informado). Retorna {mes: bytes do PDF}, em ordem, com
+    todos os PDFs em memória: para o ano inteiro use gerar_relatorios_pdf_ano.
+    Períodos sem alteração desde a última geração saem do cache.
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    versoes = _versoes_relatorios(ano, meses)
+    return {mes: _pdf_periodo(ano, mes, versoes.get(mes, (0, 0)))
+            for mes in (meses or MESES) if meses or mes in versoes}
+
+def gerar_relatorios_pdf_ano(ano):
+    """
+    Relatórios de todos os meses do ano num ZIP (um PDF por mês). Cada PDF é
+    gerado (ou lido do cache) e gravado no ZIP antes do próximo; o ZIP vai
+    para disco acima de EXPORTACAO_MEMORIA_MAXIMA. O resultado é devolvido
+    em bytes para o download.
+    """
+    versoes = _versoes_relatorios(ano)
+    if not versoes:
+        raise ValueError(f"Nenhum lançamento em {ano}")
+    with tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_MEMORIA_MAXIMA) as arquivo_zip:
+        # PDFs já são comprimidos: guardados sem nova compressão
+        with zipfile.ZipFile(arquivo_zip, 'w', zipfile.ZIP_STORED) as zip_file:
+            for mes in MESES:
+                if mes in versoes:
+                    zip_file.writestr(f"livro_caixa_{ano}_{MESES.index(mes) + 1:02d}_{mes}.pdf",
+                                      _pdf_periodo(ano, mes, versoes[mes]))
+        arquivo_zip.seek(0)
+        return arquivo_zip.read()
+
+# =============================================================================
+# FUNÇÕES DE BACKUP
+# =============================================================================
+
+# Codecs de compressão disponíveis (nome exibido -> método do zipfile)
+CODECS_COMPRESSAO = {
+    'Deflate': zipfile.ZIP_DEFLATED,
+    'BZIP2': zipfile.ZIP_BZIP2,
+    'LZMA': zipfile.ZIP_LZMA,
+    'Sem compressão': zipfile.ZIP_STORED,
+}
+NIVEL_COMPRESSAO_PADRAO = 6
+
+def _abrir_zip(arquivo, compressao=zipfile.ZIP_DEFLATED, nivel=None):
+    """Abre um ZIP para escrita com o codec e nível escolhidos"""
+    if nivel is None:
+        nivel = NIVEL_COMPRESSAO_PADRAO
+    if compressao == zipfile.ZIP_BZIP2:
+        nivel = max(1, nivel)  # bz2 aceita apenas 1-9
+    elif compressao in (zipfile.ZIP_STORED, zipfile.ZIP_LZMA):
+        nivel = None  # zipfile não aplica nível a esses métodos
+    return zipfile.ZipFile(arquivo, 'w', compression=compressao, compresslevel=nivel)
+
+def relatorio_compressao(dados_zip):
+    """Tamanho original, tamanho compactado e razão de um ZIP (lê só o diretório central)"""
+    with zipfile.ZipFile(io.BytesIO(dados_zip)) as zip_file:
+        tamanho_original = sum(info.file_size for info in zip_file.infolist())
+    tamanho_compactado = len(dados_zip)
+    return {
+        'tamanho_original': tamanho_original,
+        'tamanho_compactado': tamanho_compactado,
+        'razao': tamanho_original / tamanho_compactado if tamanho_compactado else 0
+    }
+
+DUMP_LINHAS_POR_INSERT = 500           # linhas por INSERT multi-linha no dump SQL
+DUMP_TAMANHO_MAXIMO_INSERT = 1024 * 1024  # bytes por INSERT (abaixo do max_allowed_packet padrão)
+
+def _iniciar_snapshot(conn):
+    """Transação REPEATABLE READ com snapshot consistente para todas as leituras seguintes"""
+    # SET TRANSACTION falha com uma transação (mesmo implícita) em andamento
+    conn.commit()
+    cursor = conn.cursor()
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+def _stream_dump_sql_para_zip(conn, zip_file, nome_membro, linhas_por_insert=DUMP_LINHAS_POR_INSERT):
+    """
+    Grava no ZIP um dump SQL reexecutável com o cliente mysql: estrutura de
+    todas as tabelas e os dados em INSERTs multi-linha (até linhas_por_insert
+    linhas ou DUMP_TAMANHO_MAXIMO_INSERT bytes cada), lidos com cursor sem
+    buffer e escapados pelo pymysql. Inclui os hashes das senhas e a versão
+    do schema, para o banco recriado aceitar login e não reaplicar migrações
+    (o backup completo é restrito ao admin). Retorna o total de linhas por tabela.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SHOW TABLES")
+    tabelas = [linha[0] for linha in cursor.fetchall()]
+
+    totais = {}
+    with io.TextIOWrapper(zip_file.open(nome_membro, 'w', force_zip64=True), encoding='utf-8', newline='') as saida:
+        saida.write(f"-- Dump do sistema Livro Caixa - {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n"
+                    "SET NAMES utf8mb4;\n"
+                    "SET FOREIGN_KEY_CHECKS = 0;\n"
+                    "SET UNIQUE_CHECKS = 0;\n"
+                    "SET AUTOCOMMIT = 0;\n\n")
+
+        cursor_stream = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            for tabela in tabelas:
+                cursor.execute(f"SHOW CREATE TABLE `{tabela}`")
+                saida.write(f"-- Tabela {tabela}\nDROP TABLE IF EXISTS `{tabela}`;\n{cursor.fetchone()[1]};\n\n")
+
+                cursor_stream.execute(f"SELECT * FROM `{tabela}`")
+                colunas = ', '.join(f"`{descricao[0]}`" for descricao in cursor_stream.description)
+                prefixo = f"INSERT INTO `{tabela}` ({colunas}) VALUES\n"
+
+                total = 0
+                valores = []
+                tamanho = 0
+                while True:
+                    linhas = cursor_stream.fetchmany(EXPORTACAO_BLOCO)
+                    for linha in linhas:
+                        tupla = '(' + ','.join(escape_item(valor, 'utf8mb4') for valor in linha) + ')'
+                        if valores and (len(valores) >= linhas_por_insert or tamanho + len(tupla) > DUMP_TAMANHO_MAXIMO_INSERT):
+                            saida.write(prefixo + ',\n'.join(valores) + ';\n')
+                            valores = []
+                            tamanho = 0
+                        valores.append(tupla)
+                        tamanho += len(tupla) + 2
+                    total += len(linhas)
+                    if not linhas:
+                        break
+                if valores:
+                    saida.write(prefixo + ',\n'.join(valores) + ';\n')
+                saida.write("\n")
+                totais[tabela] = total
+        finally:
+            cursor_stream.close()
+
+        saida.write("COMMIT;\nSET UNIQUE_CHECKS = 1;\nSET FOREIGN_KEY_CHECKS = 1;\n")
+    return totais
+
+def _marca_atual(cursor):
+    """Instante do servidor usado como watermark (evita diferença de relógio)"""
+    cursor.execute('SELECT CURRENT_TIMESTAMP')
+    return cursor.fetchone()[0]
+
+# Origem dos marcos: cada destino de backup mantém sua própria cadeia, para um
+# download manual não mover o watermark dos arquivos gravados pelo agendador
+ORIGEM_BACKUP_MANUAL = 'manual'
+ORIGEM_BACKUP_AGENDADO = 'agendado'
+# Marcos do estado restaurado: não geram arquivos, só delimitam as cadeias
+ORIGEM_BACKUP_RESTAURACAO = 'restauracao'
+
+def _registrar_marco_backup(cursor, origem, cadeia, tipo, marca):
+    """Grava o próximo marco da cadeia da origem e retorna sua sequência"""
+    cursor.execute(
+        'SELECT COALESCE(MAX(sequencia), 0) + 1 FROM backup_marcos WHERE origem = %s AND cadeia = %s',
+        (origem, cadeia)
+    )
+    sequencia = cursor.fetchone()[0]
+    cursor.execute(
+        'INSERT INTO backup_marcos (origem, cadeia, sequencia, tipo, marca) VALUES (%s, %s, %s, %s, %s)',
+        (origem, cadeia, sequencia, tipo, marca)
+    )
+    return sequencia
+
+def _ultimo_marco_backup(cursor, origem):
+    """Último marco gravado pela origem: (cadeia, sequencia, marca) ou None"""
+    cursor.execute(
+        'SELECT cadeia, sequencia, marca FROM backup_marcos WHERE origem = %s ORDER BY id DESC LIMIT 1',
+        (origem,)
+    )
+    return cursor.fetchone()
+
+# Recuo do início da janela do incremental em relação ao marco anterior. Uma
+# transação que gravou updated_at antes do marco mas só confirmou depois dele
+# ficou invisível ao incremental anterior; reaplicar as mesmas linhas (upsert)
+# e exclusões é inofensivo, então a janela se sobrepõe à anterior.
+INCREMENTAL_SOBREPOSICAO = timedelta(minutes=5)
+
+def _limpar_registro_exclusoes(cursor):
+    """
+    Remove os registros de exclusão que nenhum incremental vai mais ler:
+    anteriores ao marco mais antigo entre os últimos de cada origem de backup
+    (menos a sobreposição da janela). Retorna a quantidade removida.
+    """
+    cursor.execute('''
+        DELETE FROM registro_exclusoes
+        WHERE excluido_em < (
+            SELECT MIN(ultima) FROM (
+                SELECT MAX(marca) AS ultima FROM backup_marcos WHERE origem <> %s GROUP BY origem
+            ) ultimos
+        ) - INTERVAL %s SECOND
+    ''', (ORIGEM_BACKUP_RESTAURACAO, int(INCREMENTAL_SOBREPOSICAO.total_seconds())))
+    return cursor.rowcount
+
+def criar_backup_completo(usuario, permissao, compressao=zipfile.ZIP_DEFLATED, nivel=None,
+                          linhas_por_insert=DUMP_LINHAS_POR_INSERT, origem=ORIGEM_BACKUP_MANUAL):
+    """
+    Cria um backup completo de todos os dados do sistema (CSVs e dump SQL,
+    lidos do mesmo snapshot consistente) e inicia uma nova cadeia de backups
+    incrementais da origem, com watermark no instante do início.
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        # Marca antes do snapshot: o que mudar entre os dois vai para o próximo
+        # incremental também (reaplicar é inofensivo); nada fica de fora
+        marca = _marca_atual(conn.cursor())
+        cadeia = marca.strftime('%Y%m%d_%H%M%S')
+        _iniciar_snapshot(conn)
+        with tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_MEMORIA_MAXIMA) as arquivo_zip:
+            with _abrir_zip(arquivo_zip, compressao, nivel) as zip_file:
+                # Backup de todas as tabelas (lançamentos por período)
+                _exportar_tabelas_zip(conn, zip_file, prefixo='backup_')
+
+                # Backup de estrutura das tabelas
+                cursor = conn.cursor()
+                cursor.execute("SHOW TABLES")
+                tables = cursor.fetchall()
+
+                estrutura_sql = ""
+                for table in tables:
+                    table_name = table[0]
+                    cursor.execute(f"SHOW CREATE TABLE {table_name}")
+                    create_table = cursor.fetchone()
+                    if create_table:
+                        estrutura_sql += f"-- Estrutura da tabela {table_name}\n"
+                        estrutura_sql += create_table[1] + ";\n\n"
+
+                zip_file.writestr("estrutura_tabelas.sql", estrutura_sql)
+
+                # Dump SQL completo (estrutura + dados), do mesmo snapshot dos CSVs
+                _stream_dump_sql_para_zip(conn, zip_file, "dump_completo.sql", linhas_por_insert)
+
+                # Adicionar informações do backup
+                info_backup = f"""
+                BACKUP DO SISTEMA LIVRO CAIXA
+                Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
+                Usuário: {usuario}
+                Permissão: {permissao}
+                
+                Conteúdo do backup:
+                - Lançamentos por período (ano/mês)
+                - Contas cadastradas
+                - Eventos do calendário
+                - Usuários (CSV sem senhas)
+                - Estrutura das tabelas
+                - dump_completo.sql: estrutura e dados em INSERTs multi-linha,
+                  com os hashes das senhas dos usuários
+                  (mysql -u usuario -p banco < dump_completo.sql)
+                
+                Este arquivo contém todos os dados do sistema para restauração.
+                Guarde-o com segurança: o dump SQL contém os hashes das senhas.
+                """
+                zip_file.writestr("INFO_BACKUP.txt", info_backup)
+                zip_file.writestr("marco.json", json.dumps({
+                    'tipo': 'completo', 'origem': origem, 'cadeia': cadeia, 'sequencia': 1,
+                    'desde': None, 'ate': marca.isoformat()
+                }))
+
+            cursor = conn.cursor()
+            _registrar_marco_backup(cursor, origem, cadeia, 'completo', marca)
+            _limpar_registro_exclusoes(cursor)
+            conn.commit()
+
+            arquivo_zip.seek(0)
+            return arquivo_zip.read()
+    finally:
+        conn.close()
+
+def criar_backup_incremental(usuario, compressao=zipfile.ZIP_DEFLATED, nivel=None, origem=ORIGEM_BACKUP_MANUAL):
+    """
+    Cria um backup incremental com apenas o que mudou desde o último marco da
+    cadeia atual da origem: linhas inseridas/alteradas (updated_at) e exclusões
+    (registro_exclusoes), na janela [marco anterior - sobreposição, agora),
+    lidas todas do mesmo snapshot consistente.
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        cursor = conn.cursor()
+        ultimo = _ultimo_marco_backup(cursor, origem)
+        if not ultimo:
+            raise RuntimeError("Nenhum backup completo registrado. Crie um backup completo para iniciar a cadeia.")
+        cadeia, sequencia_anterior, marco_anterior = ultimo
+        cursor.execute('''
+            SELECT COUNT(*) FROM backup_marcos
+            WHERE origem = %s AND id > (SELECT MAX(id) FROM backup_marcos WHERE origem = %s)
+        ''', (ORIGEM_BACKUP_RESTAURACAO, origem))
+        if cursor.fetchone()[0]:
+            # Linhas restauradas mantêm o updated_at do arquivo e as removidas
+            # pela restauração não têm registro de exclusão: a cadeia não serve mais
+            raise RuntimeError("Houve uma restauração depois do último backup desta cadeia. "
+                               "Crie um backup completo para iniciar uma nova cadeia.")
+        # Como no completo: marca antes do snapshot, e o que confirmar entre os
+        # dois com updated_at anterior à marca entra pela sobreposição do próximo
+        ate = _marca_atual(cursor)
+        desde = marco_anterior - INCREMENTAL_SOBREPOSICAO
+        _iniciar_snapshot(conn)
+
+        colunas_por_tabela = {tabela: '*' for tabela in TABELAS_RASTREADAS}
+        colunas_por_tabela['usuarios'] = COLUNAS_USUARIOS_BACKUP
+
+        with tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_MEMORIA_MAXIMA) as arquivo_zip:
+            with _abrir_zip(arquivo_zip, compressao, nivel) as zip_file:
+                totais = {}
+                cursor_stream = conn.cursor(pymysql.cursors.SSCursor)
+                try:
+                    for tabela, colunas in colunas_por_tabela.items():
+                        cursor_stream.execute(
+                            f'SELECT {colunas} FROM {tabela} WHERE updated_at >= %s AND updated_at < %s',
+                            (desde, ate)
+                        )
+                        totais[tabela] = _stream_csv_para_zip(
+                            zip_file, cursor_stream, lambda linha, tabela=tabela: f"incremental_{tabela}.csv"
+                        )
+
+                    cursor_stream.execute('''
+                        SELECT tabela, chave, excluido_em FROM registro_exclusoes
+                        WHERE excluido_em >= %s AND excluido_em < %s
+                        ORDER BY id
+                    ''', (desde, ate))
+                    totais['exclusoes'] = _stream_csv_para_zip(zip_file, cursor_stream, lambda linha: "exclusoes.csv")
+                finally:
+                    cursor_stream.close()
+
+                sequencia = sequencia_anterior + 1
+                info_backup = f"""
+                BACKUP INCREMENTAL - SISTEMA LIVRO CAIXA
+                Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
+                Cadeia: {cadeia} | Sequência: {sequencia}
+                Alterações desde: {desde.strftime('%d/%m/%Y %H:%M:%S')}
+                Alterações até: {ate.strftime('%d/%m/%Y %H:%M:%S')}
+                Usuário: {usuario}
+                
+                Conteúdo (linhas inseridas ou alteradas):
+                """ + "".join(f"\n                - {tabela}: {total}" for tabela, total in totais.items())
+                zip_file.writestr("INFO_BACKUP_INCREMENTAL.txt", info_backup)
+                zip_file.writestr("marco.json", json.dumps({
+                    'tipo': 'incremental', 'origem': origem, 'cadeia': cadeia, 'sequencia': sequencia,
+                    'desde': desde.isoformat(), 'ate': ate.isoformat(), 'totais': totais
+                }))
+
+            cursor = conn.cursor()
+            _registrar_marco_backup(cursor, origem, cadeia, 'incremental', ate)
+            _limpar_registro_exclusoes(cursor)
+            conn.commit()
+
+            arquivo_zip.seek(0)
+            return arquivo_zip.read()
+    finally:
+        conn.close()
+
+# =============================================================================
+# RESTAURAÇÃO DE BACKUPS
+# =============================================================================
+
+RESTAURACAO_LOTE = 5000  # linhas por INSERT multi-linha na restauração
+
+# Membros do backup completo -> tabela de destino
+MEMBROS_BACKUP_COMPLETO = {
+    'backup_lancamentos_': 'lancamentos',
+    'backup_contas.csv': 'contas',
+    'backup_eventos.csv': 'eventos_calendario',
+    'backup_usuarios.csv': 'usuarios',
+    'backup_recorrentes.csv': 'lancamentos_recorrentes',
+    'backup_recorrencias_materializadas.csv': 'recorrencias_materializadas',
+}
+
+def _hash_linha(campos):
+    """Hash de 64 bits de uma linha já convertida para texto"""
+    return int.from_bytes(hashlib.blake2b('\x1f'.join(campos).encode('utf-8'), digest_size=8).digest(), 'big')
+
+def _texto_csv(valor):
+    """Mesmo texto que o csv.writer gravou para o valor vindo do banco"""
+    return '' if valor is None else str(valor)
+
+def _ler_lotes_csv(dados_zip, membros):
+    """
+    Lê membros CSV do ZIP em streaming e gera (colunas, lote de linhas).
+    Cada chamada abre seu próprio ZipFile, podendo rodar em threads paralelas.
+    """
+    with zipfile.ZipFile(io.BytesIO(dados_zip)) as zip_file:
+        for membro in membros:
+            with zip_file.open(membro) as arquivo:
+                leitor = csv.reader(io.TextIOWrapper(arquivo, encoding='utf-8', newline=''))
+                colunas = next(leitor, None)
+                if not colunas:
+                    continue
+                lote = []
+                for linha in leitor:
+                    lote.append(linha)
+                    if len(lote) >= RESTAURACAO_LOTE:
+                        yield colunas, lote
+                        lote = []
+                if lote:
+                    yield colunas, lote
+
+def _indices_secundarios(cursor, tabela):
+    """Índices não únicos da tabela, exceto os exigidos por foreign keys: {nome: 'col1, col2'}"""
+    cursor.execute('''
+        SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND REFERENCED_TABLE_NAME IS NOT NULL
+    ''', (tabela,))
+    colunas_fk = {linha[0] for linha in cursor.fetchall()}
+    cursor.execute(f'SHOW INDEX FROM {tabela}')
+    colunas_descricao = [descricao[0] for descricao in cursor.description]
+    indices = {}
+    for linha in cursor.fetchall():
+        info = dict(zip(colunas_descricao, linha))
+        if info['Key_name'] != 'PRIMARY' and int(info['Non_unique']) == 1:
+            indices.setdefault(info['Key_name'], []).append((int(info['Seq_in_index']), info['Column_name']))
+    return {nome: ', '.join(coluna for _, coluna in sorted(cols)) for nome, cols in indices.items()
+            if sorted(cols)[0][1] not in colunas_fk}
+
+def _preparar_linhas(tabela, colunas, lote):
+    """Ajusta colunas/valores do CSV para o schema atual (texto vazio vira NULL)"""
+    if tabela == 'lancamentos' and 'ano' not in colunas:
+        # Backups anteriores à dimensão ano: deriva da data (AAAA-MM-DD)
+        pos_data = colunas.index('data')
+        colunas = colunas + ['ano']
+        lote = [linha + [linha[pos_data][:4]] for linha in lote]
+    return colunas, [[campo if campo != '' else None for campo in linha] for linha in lote]
+
+# Cópias da restauração: o backup é carregado em <tabela>_restauracao e só
+# entra no lugar da tabela em uso depois de conferido, num RENAME atômico
+SUFIXO_RESTAURACAO = '_restauracao'
+SUFIXO_SUBSTITUIDA = '_substituida'
+
+def _carregar_tabela_restauracao(dados_zip, tabela, membros):
+    """
+    Carrega uma tabela do backup numa cópia vazia (<tabela>_restauracao, mesma
+    estrutura, sem foreign keys): remove índices secundários, insere em lotes
+    grandes, recria os índices de uma vez e confere contagem e checksum. A
+    tabela em uso não é tocada; contagem divergente aborta a restauração.
+    Retorna (relatório da tabela, colunas do CSV).
+    """
+    copia = tabela + SUFIXO_RESTAURACAO
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError(f"Erro de conexão com o banco ({tabela})")
+    inicio = monotonic()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'DROP TABLE IF EXISTS {copia}')
+        cursor.execute(f'CREATE TABLE {copia} LIKE {tabela}')
+        indices = _indices_secundarios(cursor, copia)
+        if indices:
+            cursor.execute(f'ALTER TABLE {copia} ' + ', '.join(f'DROP INDEX {nome}' for nome in indices))
+
+        total_csv = 0
+        checksum_csv = 0
+        colunas_csv = None
+        try:
+            for colunas, lote in _ler_lotes_csv(dados_zip, membros):
+                colunas_csv = colunas
+                colunas_finais, linhas = _preparar_linhas(tabela, colunas, lote)
+                for linha in lote:
+                    checksum_csv = (checksum_csv + _hash_linha(linha)) % 2**64
+                marcadores = ', '.join(['%s'] * len(colunas_finais))
+                if tabela == 'usuarios':
+                    # O backup não tem senhas: a mesclagem na troca gera as dos usuários novos
+                    sql = f'INSERT INTO {copia} ({", ".join(colunas_finais)}, password_hash) VALUES ({marcadores}, %s)'
+                    linhas = [linha + [''] for linha in linhas]
+                else:
+                    sql = f'INSERT INTO {copia} ({", ".join(colunas_finais)}) VALUES ({marcadores})'
+                cursor.executemany(sql, linhas)
+                conn.commit()
+                total_csv += len(lote)
+        finally:
+            if indices:
+                # Um único ALTER reconstrói todos os índices ordenando os dados uma vez
+                cursor.execute(f'ALTER TABLE {copia} ' + ', '.join(
+                    f'ADD INDEX {nome} ({colunas})' for nome, colunas in indices.items()))
+
+        # Verificação: relê as colunas carregadas e compara contagem e checksum
+        total_banco = 0
+        checksum_banco = 0
+        if colunas_csv:
+            cursor_stream = conn.cursor(pymysql.cursors.SSCursor)
+            try:
+                cursor_stream.execute(f'SELECT {", ".join(colunas_csv)} FROM {copia}')
+                while True:
+                    linhas = cursor_stream.fetchmany(RESTAURACAO_LOTE)
+                    if not linhas:
+                        break
+                    total_banco += len(linhas)
+                    for linha in linhas:
+                        checksum_banco = (checksum_banco + _hash_linha([_texto_csv(v) for v in linha])) % 2**64
+            finally:
+                cursor_stream.close()
+        if total_csv != total_banco:
+            raise RuntimeError(f"Contagem divergente em {tabela}: {total_csv} linha(s) no backup, "
+                               f"{total_banco} carregada(s). Nenhuma tabela foi substituída.")
+
+        return {
+            'Tabela': tabela,
+            'Linhas no backup': total_csv,
+            'Linhas no banco': total_banco,
+            'Contagem': '✅',
+            'Checksum': '✅' if checksum_csv == checksum_banco else '⚠️',
+            'Tempo (s)': round(monotonic() - inicio, 1)
+        }, colunas_csv
+    finally:
+        conn.close()
+
+def _fechar_reativando_fks(conn):
+    """
+    Reativa FOREIGN_KEY_CHECKS (variável de sessão) e devolve a conexão. Se o
+    reset falhar (conexão quebrada), a conexão é descartada sem mascarar o
+    erro original nem voltar ao pool com as checagens desligadas.
+    """
+    try:
+        conn.cursor().execute('SET FOREIGN_KEY_CHECKS = 1')
+    except Exception:
+        conn.descartar()
+    finally:
+        conn.close()
+
+def _descartar_copias_restauracao(tabelas):
+    """Remove as cópias de uma restauração abortada (as tabelas em uso ficam intactas)"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        conn.cursor().execute('DROP TABLE IF EXISTS ' + ', '.join(t + SUFIXO_RESTAURACAO for t in tabelas))
+    except Error:
+        # Sobras são removidas pela próxima restauração (DROP antes do CREATE)
+        pass
+    finally:
+        conn.close()
+
+def _mesclar_usuarios_restaurados(cursor, colunas):
+    """Upsert dos usuários da cópia por username: existentes mantêm a senha"""
+    copia = 'usuarios' + SUFIXO_RESTAURACAO
+    cursor.execute(f'SELECT {", ".join(colunas)} FROM {copia}')
+    # Usuário novo recebe senha aleatória: precisa ser redefinida pelo admin
+    linhas = [list(linha) + [hashlib.sha256(secrets.token_bytes(32)).hexdigest()] for linha in cursor.fetchall()]
+    if linhas:
+        cursor.executemany(
+            f'INSERT INTO usuarios ({", ".join(colunas)}, password_hash) '
+            f'VALUES ({", ".join(["%s"] * len(colunas))}, %s) ON DUPLICATE KEY UPDATE '
+            + ', '.join(f'{c} = VALUES({c})' for c in colunas if c != 'username'),
+            linhas
+        )
+    cursor.execute(f'DROP TABLE {copia}')
+
+def _ativar_tabelas_restauradas(colunas_por_tabela):
+    """
+    Põe as cópias conferidas no lugar das tabelas em uso com um único RENAME
+    TABLE: a troca é atômica e leitores veem os dados antigos ou os novos,
+    nunca uma tabela vazia ou pela metade. Usuários não são trocados, e sim
+    mesclados por username. A FK lançamentos -> contas é refeita no fim.
+    """
+    tabelas = [tabela for tabela in colunas_por_tabela if tabela != 'usuarios']
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        cursor = conn.cursor()
+        if 'usuarios' in colunas_por_tabela:
+            _mesclar_usuarios_restaurados(cursor, colunas_por_tabela['usuarios'])
+            conn.commit()
+        if tabelas:
+            # As tabelas substituídas ainda são referenciadas pela FK de lançamentos
+            cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+            cursor.execute('DROP TABLE IF EXISTS ' + ', '.join(t + SUFIXO_SUBSTITUIDA for t in tabelas))
+            cursor.execute('RENAME TABLE ' + ', '.join(
+                f'{t} TO {t}{SUFIXO_SUBSTITUIDA}, {t}{SUFIXO_RESTAURACAO} TO {t}' for t in tabelas))
+            cursor.execute('DROP TABLE ' + ', '.join(t + SUFIXO_SUBSTITUIDA for t in tabelas))
+            _garantir_fk_conta(cursor)
+            conn.commit()
+    finally:
+        _fechar_reativando_fks(conn)
+
+def _aplicar_incremental(dados_zip, membros):
+    """Aplica exclusões e, em seguida, as linhas alteradas (upsert por chave)"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        cursor = conn.cursor()
+        # Lançamentos podem chegar antes das contas que referenciam
+        cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+        resultados = {tabela: {'Tabela': tabela, 'Excluídas': 0, 'Incluídas/Alteradas': 0} for tabela in TABELAS_RASTREADAS}
+
+        # Exclusões primeiro: linhas excluídas nunca aparecem entre as alteradas
+        if 'exclusoes.csv' in membros:
+            for colunas, lote in _ler_lotes_csv(dados_zip, ['exclusoes.csv']):
+                por_tabela = {}
+                for linha in lote:
+                    registro = dict(zip(colunas, linha))
+                    por_tabela.setdefault(registro['tabela'], []).append(registro['chave'])
+                for tabela, chaves in por_tabela.items():
+                    if tabela not in TABELAS_RASTREADAS:
+                        continue
+                    marcadores = ', '.join(['%s'] * len(chaves))
+                    cursor.execute(f'DELETE FROM {tabela} WHERE {TABELAS_RASTREADAS[tabela]} IN ({marcadores})', chaves)
+                    resultados[tabela]['Excluídas'] += cursor.rowcount
+                conn.commit()
+
+        for tabela in TABELAS_RASTREADAS:
+            membro = f"incremental_{tabela}.csv"
+            if membro not in membros:
+                continue
+            for colunas, lote in _ler_lotes_csv(dados_zip, [membro]):
+                colunas, linhas = _preparar_linhas(tabela, colunas, lote)
+                marcadores = ', '.join(['%s'] * len(colunas))
+                atualizacoes = ', '.join(f'{c} = VALUES({c})' for c in colunas if c != TABELAS_RASTREADAS[tabela])
+                if tabela == 'usuarios':
+                    sql = (f'INSERT INTO usuarios ({", ".join(colunas)}, password_hash) VALUES ({marcadores}, %s) '
+                           f'ON DUPLICATE KEY UPDATE {atualizacoes}')
+                    linhas = [linha + [hashlib.sha256(secrets.token_bytes(32)).hexdigest()] for linha in linhas]
+                else:
+                    sql = f'INSERT INTO {tabela} ({", ".join(colunas)}) VALUES ({marcadores}) ON DUPLICATE KEY UPDATE {atualizacoes}'
+                cursor.executemany(sql, linhas)
+                conn.commit()
+                resultados[tabela]['Incluídas/Alteradas'] += len(linhas)
+        return list(resultados.values())
+    finally:
+        _fechar_reativando_fks(conn)
+
+def _cadeia_restauracao(marco):
+    """Identificação da cadeia de um arquivo de backup nos marcos de restauração"""
+    if not marco.get('cadeia'):
+        return f"sem_marco/{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    return f"{marco.get('origem', '')}/{marco['cadeia']}"
+
+def _registrar_marco_restauracao(cursor, marco, tipo):
+    """
+    Grava o marco do estado restaurado (cadeia e sequência do arquivo). Após
+    um completo, os marcos de restauração anteriores deixam de valer.
+    """
+    if tipo == 'completo':
+        cursor.execute('DELETE FROM backup_marcos WHERE origem = %s', (ORIGEM_BACKUP_RESTAURACAO,))
+    marca = datetime.fromisoformat(marco['ate']) if marco.get('ate') else _marca_atual(cursor)
+    cursor.execute(
+        'INSERT INTO backup_marcos (origem, cadeia, sequencia, tipo, marca) VALUES (%s, %s, %s, %s, %s)',
+        (ORIGEM_BACKUP_RESTAURACAO, _cadeia_restauracao(marco), marco.get('sequencia', 1), tipo, marca)
+    )
+
+def _conferir_cadeia_incremental(marco):
+    """
+    Um incremental só vale sobre o estado que ele continua: a última
+    restauração precisa ser da mesma cadeia e da sequência imediatamente
+    anterior. Caso contrário levanta ValueError sem alterar nada.
+    """
+    if not marco.get('cadeia') or not marco.get('sequencia'):
+        raise ValueError("Backup incremental sem marco.json: não é possível conferir a cadeia")
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        ultimo = _ultimo_marco_backup(conn.cursor(), ORIGEM_BACKUP_RESTAURACAO)
+    finally:
+        conn.close()
+
+    cadeia = _cadeia_restauracao(marco)
+    if not ultimo:
+        raise ValueError(f"Nenhum backup restaurado ainda: restaure primeiro o completo da cadeia {cadeia}")
+    cadeia_atual, sequencia_atual, _ = ultimo
+    if cadeia_atual != cadeia:
+        raise ValueError(f"O incremental é da cadeia {cadeia}, mas o último backup restaurado é da cadeia {cadeia_atual}")
+    if int(marco['sequencia']) != sequencia_atual + 1:
+        raise ValueError(f"Incremental fora de ordem: sequência {marco['sequencia']}, "
+                         f"esperada {sequencia_atual + 1} na cadeia {cadeia}")
+
+def restaurar_backup(dados_zip):
+    """
+    Restaura um ZIP gerado por criar_backup_completo (tabelas carregadas em
+    paralelo em cópias, conferidas e trocadas de uma vez) ou por
+    criar_backup_incremental (aplicado sobre o banco atual, só se continuar a
+    cadeia restaurada). Ao final grava o marco de restauração, reconstrói os
+    resumos e limpa o cache. Retorna
+    (tipo, DataFrame com o relatório por tabela). Propaga erros.
+    """
+    with zipfile.ZipFile(io.BytesIO(dados_zip)) as zip_file:
+        membros = zip_file.namelist()
+        marco = json.loads(zip_file.read('marco.json')) if 'marco.json' in membros else {}
+
+    if marco.get('tipo') == 'incremental' or any(m.startswith('incremental_') for m in membros):
+        tipo = 'incremental'
+        _conferir_cadeia_incremental(marco)
+        relatorio = _aplicar_incremental(dados_zip, membros)
+    elif 'INFO_BACKUP.txt' in membros:
+        tipo = 'completo'
+        membros_por_tabela = {}
+        for membro in sorted(membros):
+            for prefixo, tabela in MEMBROS_BACKUP_COMPLETO.items():
+                if membro.startswith(prefixo) and membro.endswith('.csv'):
+                    membros_por_tabela.setdefault(tabela, []).append(membro)
+        if not membros_por_tabela:
+            raise ValueError("O arquivo não contém tabelas de backup")
+        # Tabelas independentes carregam em paralelo, cada uma com sua conexão
+        try:
+            with ThreadPoolExecutor(max_workers=len(membros_por_tabela), thread_name_prefix='restauracao') as executor:
+                futures = {tabela: executor.submit(_carregar_tabela_restauracao, dados_zip, tabela, lista)
+                           for tabela, lista in membros_por_tabela.items()}
+                carregadas = {tabela: future.result() for tabela, future in futures.items()}
+        except Exception:
+            _descartar_copias_restauracao(membros_por_tabela)
+            raise
+        _ativar_tabelas_restauradas({tabela: colunas for tabela, (_, colunas) in carregadas.items()})
+        relatorio = [relatorio_tabela for relatorio_tabela, _ in carregadas.values()]
+    else:
+        raise ValueError("Arquivo não reconhecido como backup do sistema")
+
+    conn = get_db_connection()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            _registrar_marco_restauracao(cursor, marco, tipo)
+            _reconstruir_resumos(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+    invalidar_cache('lancamentos', 'contas', 'eventos_calendario', 'usuarios', 'lancamentos_recorrentes')
+    # Ocorrências reivindicadas mudaram: os períodos voltam a ser conferidos
+    _periodos_materializados().clear()
+    return tipo, pd.DataFrame(relatorio)
+
+# =============================================================================
+# BACKUPS AGENDADOS (THREAD EM SEGUNDO PLANO)
+# =============================================================================
+
+# Configuração opcional em secrets.toml:
+#   [backup_agendado]
+#   diretorio = "backups"
+#   completo = "0 3 * * 0"        # cron: minuto hora dia mês dia_semana (0 = domingo)
+#   incremental = "0 3 * * 1-6"
+#   manter_diarios = 7
+#   manter_semanais = 4
+# O Streamlit só executa o script numa sessão de navegador: depois de
+# reiniciar o processo, o agendador começa na primeira visita de qualquer
+# sessão (antes do login, em main()). Até lá nada é agendado, e requisições
+# HTTP simples (health checks) não contam como visita.
+AGENDADOR_INTERVALO = 30  # segundos entre verificações do agendamento
+AGENDA_HORIZONTE_DIAS = 8 * 366  # busca da próxima execução: alcança o próximo 29/02
+RE_ARQUIVO_BACKUP = re.compile(r'^backup_(\d{8}_\d{6})_(\d{4})_(completo|incremental)_(\d{8}_\d{6})\.zip$')
+
+def _campo_cron(expressao, minimo, maximo, nome):
+    """
+    Valores aceitos por um campo cron (*, listas, intervalos e passos).
+    Valores fora de [minimo, maximo], intervalos invertidos e passos menores
+    que 1 levantam ValueError.
+    """
+    valores = set()
+    for parte in expressao.split(','):
+        faixa, barra, passo = parte.partition('/')
+        try:
+            if faixa == '*':
+                inicio, fim = minimo, maximo
+            elif '-' in faixa:
+                inicio, fim = (int(v) for v in faixa.split('-', 1))
+            else:
+                # "5/15" vale de 5 até o máximo, de 15 em 15
+                inicio = int(faixa)
+                fim = maximo if barra else inicio
+            passo = int(passo) if barra else 1
+        except ValueError:
+            raise ValueError(f"{nome}: valor inválido {parte!r}") from None
+        if not minimo <= inicio <= fim <= maximo:
+            raise ValueError(f"{nome}: {parte!r} fora do intervalo {minimo}-{maximo}")
+        if passo < 1:
+            raise ValueError(f"{nome}: passo inválido em {parte!r}")
+        valores.update(range(inicio, fim + 1, passo))
+    return valores
+
+class AgendaCron:
+    """
+    Expressão cron de 5 campos. Como no cron, se dia do mês e dia da semana
+    forem ambos restritos (não começam com *), basta um deles coincidir.
+    """
+
+    def __init__(self, expressao):
+        campos = expressao.split()
+        if len(campos) != 5:
+            raise ValueError(f"Expressão cron inválida: {expressao!r}")
+        self.expressao = expressao
+        try:
+            self.minutos = _campo_cron(campos[0], 0, 59, "minuto")
+            self.horas = _campo_cron(campos[1], 0, 23, "hora")
+            self.dias = _campo_cron(campos[2], 1, 31, "dia do mês")
+            self.meses = _campo_cron(campos[3], 1, 12, "mês")
+            # cron usa 0 (ou 7) para domingo; weekday() usa 6
+            self.dias_semana = {(d - 1) % 7 for d in _campo_cron(campos[4], 0, 7, "dia da semana")}
+        except ValueError as e:
+            raise ValueError(f"Expressão cron inválida {expressao!r}: {e}") from None
+        self.dia_ou_semana = not campos[2].startswith('*') and not campos[4].startswith('*')
+        self._horas_ordenadas = sorted(self.horas)
+        self._minutos_ordenados = sorted(self.minutos)
+
+        # Sem o "ou", a agenda só dispara se algum dia existir num dos meses (29/02 conta)
+        if not self.dia_ou_semana and not any(dia <= calendar.monthrange(2000, mes)[1]
+                                              for mes in self.meses for dia in self.dias):
+            raise ValueError(f"Expressão cron nunca é satisfeita: {expressao!r}")
+
+    def corresponde_dia(self, dia):
+        if self.dia_ou_semana:
+            return dia.month in self.meses and (dia.day in self.dias or dia.weekday() in self.dias_semana)
+        return dia.month in self.meses and dia.day in self.dias and dia.weekday() in self.dias_semana
+
+    def corresponde(self, instante):
+        return instante.minute in self.minutos and instante.hour in self.horas and self.corresponde_dia(instante)
+
+    def proxima(self, apos):
+        """
+        Próximo minuto agendado depois de `apos`, campo a campo: pula os meses
+        fora da agenda, percorre os dias dos meses aceitos e, no primeiro dia
+        válido, pega a primeira hora e minuto que ainda não passaram. O
+        horizonte cobre um 29/02. None se nada disparar nele.
+        """
+        inicio = apos.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        dia = inicio.date()
+        limite = dia + timedelta(days=AGENDA_HORIZONTE_DIAS)
+        while dia <= limite:
+            if dia.month not in self.meses:
+                dia = date(dia.year + dia.month // 12, dia.month % 12 + 1, 1)
+                continue
+            if self.corresponde_dia(dia):
+                minimo = (inicio.hour, inicio.minute) if dia == inicio.date() else (0, 0)
+                for hora in self._horas_ordenadas:
+                    if hora < minimo[0]:
+                        continue
+                    for minuto in self._minutos_ordenados:
+                        if (hora, minuto) >= minimo:
+                            return datetime.combine(dia, time(hora, minuto))
+            dia += timedelta(days=1)
+        return None
+
+def _gravar_arquivo_atomico(caminho, dados):
+    """Grava com outro nome e renomeia: leitores nunca veem um arquivo pela metade"""
+    os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+    with open(caminho + '.parcial', 'wb') as arquivo:
+        arquivo.write(dados)
+    os.replace(caminho + '.parcial', caminho)
+
+def aplicar_retencao(diretorio, manter_diarios, manter_semanais):
+    """
+    Mantém o backup mais recente de cada um dos últimos N dias e de cada uma
+    das últimas M semanas, junto com o que ele depende na cadeia (o completo
+    e os incrementais anteriores). Remove os demais e retorna seus nomes.
+    """
+    arquivos = []
+    for nome in os.listdir(diretorio):
+        correspondencia = RE_ARQUIVO_BACKUP.match(nome)
+        if correspondencia:
+            cadeia, sequencia, _, criado = correspondencia.groups()
+            arquivos.append((datetime.strptime(criado, '%Y%m%d_%H%M%S'), cadeia, int(sequencia), nome))
+    arquivos.sort(reverse=True)
+
+    mantidos = set()
+    dias, semanas = set(), set()
+    for criado, cadeia, sequencia, nome in arquivos:
+        dia, semana = criado.date(), criado.isocalendar()[:2]
+        if dia not in dias and len(dias) < manter_diarios:
+            dias.add(dia)
+            mantidos.add((cadeia, sequencia))
+        if semana not in semanas and len(semanas) < manter_semanais:
+            semanas.add(semana)
+            mantidos.add((cadeia, sequencia))
+
+    # Um incremental só restaura sobre o completo e os incrementais anteriores
+    necessarios = {(cadeia, seq) for cadeia, ate in mantidos for seq in range(1, ate + 1)}
+    removidos = []
+    for _, cadeia, sequencia, nome in arquivos:
+        if (cadeia, sequencia) not in necessarios:
+            os.remove(os.path.join(diretorio, nome))
+            removidos.append(nome)
+    return removidos
+
+class AgendadorBackups:
+    """
+    Thread daemon (uma por processo) que grava backups completos e
+    incrementais no diretório configurado conforme as agendas cron e aplica
+    a retenção após cada execução. Roda fora do script do Streamlit, sem
+    bloquear reruns. A configuração vigente é trocada por configurar() e lida
+    a cada verificação: mudar [backup_agendado] não cria um segundo agendador.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chave = None
+        self._config = None
+        self._ultima_execucao = None
+        self._thread = None
+
+    def configurar(self, chave, config):
+        """
+        Aplica a configuração ({'diretorio', 'completo', 'incremental',
+        'manter_diarios', 'manter_semanais'}) ou pausa com None. `chave` são os
+        valores brutos: a mesma configuração não é reaplicada a cada rerun.
+        """
+        with self._lock:
+            if chave == self._chave:
+                return
+            self._chave = chave
+            self._config = config
+            if config and self._thread is None:
+                self._thread = threading.Thread(target=self._executar, name='agendador-backups', daemon=True)
+                self._thread.start()
+
+    def configuracao(self):
+        """Configuração vigente ou None (pausado)"""
+        with self._lock:
+            return self._config
+
+    def _gravar_backup(self, tipo, config):
+        inicio = datetime.now()
+        situacao = {'tipo': tipo, 'inicio': inicio, 'fim': None, 'arquivo': None, 'tamanho': 0, 'removidos': 0, 'erro': None}
+        try:
+            try:
+                if tipo == 'incremental':
+                    dados = criar_backup_incremental('agendador', origem=ORIGEM_BACKUP_AGENDADO)
+                else:
+                    dados = criar_backup_completo('agendador', 'admin', origem=ORIGEM_BACKUP_AGENDADO)
+            except RuntimeError:
+                if tipo != 'incremental':
+                    raise
+                # Sem cadeia própria iniciada: o primeiro backup agendado é completo
+                situacao['tipo'] = 'completo'
+                dados = criar_backup_completo('agendador', 'admin', origem=ORIGEM_BACKUP_AGENDADO)
+
+            with zipfile.ZipFile(io.BytesIO(dados)) as zip_file:
+                marco = json.loads(zip_file.read('marco.json'))
+            nome = f"backup_{marco['cadeia']}_{marco['sequencia']:04d}_{marco['tipo']}_{inicio.strftime('%Y%m%d_%H%M%S')}.zip"
+            _gravar_arquivo_atomico(os.path.join(config['diretorio'], nome), dados)
+
+            situacao.update(arquivo=nome, tamanho=len(dados))
+            situacao['removidos'] = len(aplicar_retencao(config['diretorio'], config['manter_diarios'], config['manter_semanais']))
+        except Exception as e:
+            situacao['erro'] = str(e)
+        situacao['fim'] = datetime.now()
+        with self._lock:
+            self._ultima_execucao = situacao
+
+    def _executar(self):
+        verificado_ate = datetime.now().replace(second=0, microsecond=0)
+        while True:
+            agora = datetime.now().replace(second=0, microsecond=0)
+            config = self.configuracao()
+            # Percorre os minutos desde a última verificação (inclusive atrasos)
+            tipo = None
+            instante = verificado_ate + timedelta(minutes=1)
+            while config and instante <= agora:
+                if config['completo'].corresponde(instante):
+                    tipo = 'completo'
+                elif config['incremental'] and config['incremental'].corresponde(instante) and tipo is None:
+                    tipo = 'incremental'
+                instante += timedelta(minutes=1)
+            verificado_ate = agora
+            if tipo:
+                self._gravar_backup(tipo, config)
+            sleep(AGENDADOR_INTERVALO)
+
+    def situacao(self):
+        """(última execução ou None, próximo completo, próximo incremental)"""
+        agora = datetime.now()
+        with self._lock:
+            config = self._config
+            ultima = dict(self._ultima_execucao) if self._ultima_execucao else None
+        if not config:
+            return ultima, None, None
+        proximo_incremental = config['incremental'].proxima(agora) if config['incremental'] else None
+        return ultima, config['completo'].proxima(agora), proximo_incremental
+
+@st.cache_resource(show_spinner=False)
+def get_agendador_backups():
+    """O agendador do processo; a configuração é aplicada por iniciar_agendador_backups"""
+    return AgendadorBackups()
+
+def iniciar_agendador_backups():
+    """
+    Aplica [backup_agendado] ao agendador do processo (pausado se a seção
+    faltar ou for inválida). Retorna o agendador ou None se não estiver ativo.
+    """
+    config = st.secrets.get("backup_agendado")
+    agendador = get_agendador_backups()
+    if not config:
+        agendador.configurar(None, None)
+        return None
+    chave = (config.get("diretorio", "backups"), config.get("completo", "0 3 * * 0"),
+             config.get("incremental", "0 3 * * 1-6"), config.get("manter_diarios", 7),
+             config.get("manter_semanais", 4))
+    try:
+        diretorio, completo, incremental, manter_diarios, manter_semanais = chave
+        agendador.configurar(chave, {
+            'diretorio': diretorio,
+            'completo': AgendaCron(completo),
+            'incremental': AgendaCron(incremental) if incremental else None,
+            'manter_diarios': int(manter_diarios),
+            'manter_semanais': int(manter_semanais),
+        })
+    except ValueError as e:
+        agendador.configurar(None, None)
+        st.error(f"❌ Configuração de backup agendado inválida: {e}")
+        return None
+    return agendador
+
+# =============================================================================
+# REPOSITÓRIO DE BACKUPS DEDUPLICADO (ENDEREÇADO POR CONTEÚDO)
+# =============================================================================
+
+# Layout do diretório:
+#   objetos/ab/abcd...gz   pedaço CSV (um período de lançamentos ou uma tabela), pelo SHA-256
+#   manifestos/AAAAMMDD_HHMMSS.json   lista de pedaços de cada backup
+REPOSITORIO_DIRETORIO_PADRAO = "repositorio_backups"
+
+# Pedaços fixos (tabela, colunas, membro); lançamentos geram um pedaço por período
+PEDACOS_REPOSITORIO = [
+    ('contas', '*', 'backup_contas.csv'),
+    ('eventos_calendario', '*', 'backup_eventos.csv'),
+    ('usuarios', COLUNAS_USUARIOS_BACKUP, 'backup_usuarios.csv'),
+    ('lancamentos_recorrentes', '*', 'backup_recorrentes.csv'),
+    ('recorrencias_materializadas', '*', 'backup_recorrencias_materializadas.csv'),
+]
+
+def _caminho_objeto(diretorio, hash_conteudo):
+    """Caminho do objeto (pedaço comprimido) de um hash"""
+    return os.path.join(diretorio, 'objetos', hash_conteudo[:2], f"{hash_conteudo}.gz")
+
+def _colunas_tabela(cursor, tabela, colunas):
+    """Lista de colunas de uma seleção ('*' consulta o schema)"""
+    if colunas != '*':
+        return [coluna.strip() for coluna in colunas.split(',')]
+    cursor.execute(f'SHOW COLUMNS FROM {tabela}')
+    return [linha[0] for linha in cursor.fetchall()]
+
+def _texto_linha_sql(colunas):
+    """
+    Expressão SQL com o texto de uma linha para impressões digitais. Cada valor
+    vai entre aspas (QUOTE) e NULL vira a palavra NULL: CONCAT_WS pularia os
+    nulos, e mover um valor de coluna ou trocar NULL por '' não mudaria o texto.
+    """
+    return "CONCAT_WS(',', " + ', '.join(f"COALESCE(QUOTE({coluna}), 'NULL')" for coluna in colunas) + ")"
+
+def _impressoes_pedacos(cursor):
+    """
+    Impressão digital de cada pedaço calculada no servidor (contagem e CRC32
+    das linhas), sem trafegar os dados: {membro: (consulta, parâmetros, impressão)}
+    """
+    pedacos = {}
+    linha = _texto_linha_sql(_colunas_tabela(cursor, 'lancamentos', '*'))
+    assinatura = f"COUNT(*), BIT_XOR(CRC32({linha})), SUM(CRC32({linha}))"
+    cursor.execute(f'SELECT ano, mes, {assinatura} FROM lancamentos GROUP BY ano, mes')
+    for ano, mes, *impressao in cursor.fetchall():
+        pedacos[f"backup_lancamentos_{ano}_{mes}.csv"] = (
+            'SELECT * FROM lancamentos WHERE ano = %s AND mes = %s ORDER BY data, id', (ano, mes),
+            ':'.join(str(v) for v in impressao)
+        )
+
+    for tabela, selecao, membro in PEDACOS_REPOSITORIO:
+        linha = _texto_linha_sql(_colunas_tabela(cursor, tabela, selecao))
+        cursor.execute(f"SELECT COUNT(*), BIT_XOR(CRC32({linha})), SUM(CRC32({linha})) FROM {tabela}")
+        pedacos[membro] = (f'SELECT {selecao} FROM {tabela}', (), ':'.join(str(v) for v in cursor.fetchone()))
+    return pedacos
+
+def _csv_pedaco(cursor, consulta, parametros):
+    """Conteúdo CSV de um pedaço, no mesmo formato dos membros do backup completo"""
+    cursor.execute(consulta, parametros)
+    saida = io.StringIO()
+    escritor = csv.writer(saida, lineterminator='\n')
+    escritor.writerow([descricao[0] for descricao in cursor.description])
+    escritor.writerows(cursor.fetchall())
+    return saida.getvalue().encode('utf-8')
+
+def listar_manifestos(diretorio):
+    """Nomes dos manifestos do repositório, do mais recente ao mais antigo"""
+    pasta = os.path.join(diretorio, 'manifestos')
+    if not os.path.isdir(pasta):
+        return []
+    return sorted((nome[:-5] for nome in os.listdir(pasta) if nome.endswith('.json')), reverse=True)
+
+def ler_manifesto(diretorio, nome):
+    """Conteúdo de um manifesto do repositório"""
+    with open(os.path.join(diretorio, 'manifestos', f"{nome}.json"), encoding='utf-8') as arquivo:
+        return json.load(arquivo)
+
+def criar_backup_repositorio(diretorio, usuario):
+    """
+    Backup completo no repositório deduplicado: compara a impressão de cada
+    pedaço com o último manifesto e só lê, serializa e grava os pedaços que
+    mudaram. Não grava marcos: as cadeias de incrementais são dos downloads
+    e do agendador, e o repositório não guarda os arquivos delas.
+    Não usa elementos do Streamlit: pode rodar em segundo plano e propaga erros.
+    """
+    inicio = monotonic()
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Erro de conexão com o banco")
+    try:
+        cursor = conn.cursor()
+        marca = _marca_atual(cursor)
+        cadeia = marca.strftime('%Y%m%d_%H%M%S')
+
+        manifestos = listar_manifestos(diretorio)
+        anteriores = {}
+        if manifestos:
+            anteriores = {pedaco['membro']: pedaco for pedaco in ler_manifesto(diretorio, manifestos[0])['pedacos']}
+
+        pedacos = []
+        novos = reaproveitados = bytes_gravados = 0
+        for membro, (consulta, parametros, impressao) in sorted(_impressoes_pedacos(cursor).items()):
+            anterior = anteriores.get(membro)
+            if anterior and anterior['impressao'] == impressao and os.path.exists(_caminho_objeto(diretorio, anterior['hash'])):
+                pedacos.append(anterior)
+                reaproveitados += 1
+                continue
+
+            dados = _csv_pedaco(cursor, consulta, parametros)
+            hash_conteudo = hashlib.sha256(dados).hexdigest()
+            caminho = _caminho_objeto(diretorio, hash_conteudo)
+            if not os.path.exists(caminho):
+                comprimido = gzip.compress(dados, compresslevel=NIVEL_COMPRESSAO_PADRAO, mtime=0)
+                _gravar_arquivo_atomico(caminho, comprimido)
+                novos += 1
+                bytes_gravados += len(comprimido)
+            else:
+                reaproveitados += 1
+            pedacos.append({'membro': membro, 'hash': hash_conteudo, 'tamanho': len(dados), 'impressao': impressao})
+
+        manifesto = {
+            'cadeia': cadeia, 'marca': marca.isoformat(), 'usuario': usuario,
+            'criado_em': datetime.now().isoformat(timespec='seconds'), 'pedacos': pedacos
+        }
+        _gravar_arquivo_atomico(os.path.join(diretorio, 'manifestos', f"{cadeia}.json"),
+                                json.dumps(manifesto, indent=1).encode('utf-8'))
+
+        return {
+            'manifesto': cadeia,
+            'pedacos': len(pedacos),
+            'novos': novos,
+            'reaproveitados': reaproveitados,
+            'bytes_gravados': bytes_gravados,
+            'segundos': round(monotonic() - inicio, 1)
+        }
+    finally:
+        conn.close()
+
+def montar_zip_manifesto(diretorio, nome):
+    """Remonta, a partir dos objetos, o ZIP no formato do backup completo"""
+    manifesto = ler_manifesto(diretorio, nome)
+    arquivo_zip = io.BytesIO()
+    with _abrir_zip(arquivo_zip) as zip_file:
+        for pedaco in manifesto['pedacos']:
+            with open(_caminho_objeto(diretorio, pedaco['hash']), 'rb') as arquivo:
+                dados = gzip.decompress(arquivo.read())
+            if hashlib.sha256(dados).hexdigest() != pedaco['hash']:
+                raise ValueError(f"Objeto corrompido no repositório: {pedaco['membro']}")
+            zip_file.writestr(pedaco['membro'], dados)
+        zip_file.writestr("INFO_BACKUP.txt", f"Backup remontado do manifesto {nome} ({manifesto['criado_em']})")
+        zip_file.writestr("marco.json", json.dumps({
+            'tipo': 'completo', 'cadeia': manifesto['cadeia'], 'sequencia': 1,
+            'desde': None, 'ate': manifesto['marca']
+        }))
+    return arquivo_zip.getvalue()
+
+def restaurar_manifesto(diretorio, nome):
+    """Restaura o backup descrito por um manifesto (mesmo fluxo do ZIP completo)"""
+    return restaurar_backup(montar_zip_manifesto(diretorio, nome))
+
+def limpar_repositorio(diretorio, manter):
+    """
+    Mantém os `manter` manifestos mais recentes e apaga os objetos que nenhum
+    deles referencia. Retorna (manifestos removidos, objetos removidos).
+    """
+    manifestos = listar_manifestos(diretorio)
+    for nome in manifestos[manter:]:
+        os.remove(os.path.join(diretorio, 'manifestos', f"{nome}.json"))
+
+    referenciados = {pedaco['hash'] for nome in manifestos[:manter] for pedaco in ler_manifesto(diretorio, nome)['pedacos']}
+    objetos_removidos = 0
+    pasta_objetos = os.path.join(diretorio, 'objetos')
+    if os.path.isdir(pasta_objetos):
+        for raiz, _, arquivos in os.walk(pasta_objetos):
+            for nome_arquivo in arquivos:
+                if nome_arquivo.endswith('.gz') and nome_arquivo[:-3] not in referenciados:
+                    os.remove(os.path.join(raiz, nome_arquivo))
+                    objetos_removidos += 1
+    return len(manifestos[manter:]), objetos_removidos
+
+# =============================================================================
+# IMPORTAÇÃO DE EXTRATOS BANCÁRIOS (CSV/OFX)
+# =============================================================================
+
+IMPORTACAO_LOTE = 1000  # linhas por bloco de leitura e por INSERT multi-linha
+
+# INSERT de lançamentos em lote. Só marcadores %s em VALUES: com um literal, o
+# executemany do pymysql não reconhece o formato e envia um INSERT por linha.
+# O saldo entra como 0 e é recalculado depois da carga.
+SQL_INSERIR_LANCAMENTOS = '''
+    INSERT INTO lancamentos (ano, mes, data, historico, complemento, entrada, saida, saldo)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+# Nomes de colunas aceitos no CSV (sem acento, minúsculos) -> coluna interna
+ALIASES_COLUNAS_EXTRATO = {
+    'data': 'data', 'date': 'data', 'dt': 'data',
+    'historico': 'historico', 'descricao': 'historico', 'memo': 'historico', 'lancamento': 'historico',
+    'complemento': 'complemento', 'detalhe': 'complemento',
+    'valor': 'valor', 'amount': 'valor',
+    'entrada': 'entrada', 'credito': 'entrada',
+    'saida': 'saida', 'debito': 'saida',
+}
+
+RE_CAMPO_OFX = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+def _normalizar_nome_coluna(nome):
+    nome = str(nome).strip().lower()
+    for de, para in (('á', 'a'), ('ã', 'a'), ('â', 'a'), ('é', 'e'), ('ê', 'e'),
+                     ('í', 'i'), ('ó', 'o'), ('õ', 'o'), ('ô', 'o'), ('ú', 'u'), ('ç', 'c')):
+        nome = nome.replace(de, para)
+    return ALIASES_COLUNAS_EXTRATO.get(nome, nome)
+
+def ler_extrato_csv(arquivo, separador=';', decimal=',', tamanho_bloco=IMPORTACAO_LOTE):
+    """Lê o CSV em blocos (DataFrames de texto), sem carregar o arquivo inteiro"""
+    leitor = pd.read_csv(arquivo, sep=separador, dtype=str, keep_default_na=False,
+                         chunksize=tamanho_bloco, encoding='utf-8-sig')
+    for bloco in leitor:
+        bloco = bloco.rename(columns=_normalizar_nome_coluna)
+        yield bloco, {'decimal': decimal, 'formato_data': None}
+
+def ler_extrato_ofx(arquivo, tamanho_bloco=IMPORTACAO_LOTE):
+    """
+    Lê as transações <STMTTRN> de um OFX (SGML ou XML) em blocos, varrendo o
+    arquivo em pedaços de 64 KB em vez de montar a árvore inteira.
+    """
+    texto = io.TextIOWrapper(arquivo, encoding='latin-1', errors='replace')
+    buffer = ''
+    linhas = []
+    while True:
+        pedaco = texto.read(64 * 1024)
+        buffer += pedaco
+        while True:
+            inicio = buffer.find('<STMTTRN>')
+            fim = buffer.find('</STMTTRN>', inicio + 1) if inicio >= 0 else -1
+            if fim < 0:
+                break
+            campos = dict(RE_CAMPO_OFX.findall(buffer[inicio + len('<STMTTRN>'):fim]))
+            memo = campos.get('MEMO', '').strip()
+            nome = campos.get('NAME', '').strip()
+            linhas.append({
+                'data': campos.get('DTPOSTED', '')[:8],
+                'historico': memo or nome,
+                'complemento': nome if memo else '',
+                'valor': campos.get('TRNAMT', '').strip(),
+            })
+            buffer = buffer[fim + len('</STMTTRN>'):]
+            if len(linhas) >= tamanho_bloco:
+                yield pd.DataFrame(linhas), {'decimal': '.', 'formato_data': '%Y%m%d'}
+                linhas = []
+        if not pedaco:
+            break
+        # Mantém só o necessário para uma tag que tenha ficado partida
+        inicio = buffer.find('<STMTTRN>')
+        buffer = buffer[inicio:] if inicio >= 0 else buffer[-len('<STMTTRN>'):]
+    if linhas:
+        yield pd.DataFrame(linhas), {'decimal': '.', 'formato_data': '%Y%m%d'}
+
+def _converter_valores(serie, decimal):
+    """Converte textos monetários ("R$ 1.234,56", "-10.5") para float, vetorizado"""
+    serie = serie.fillna('').astype(str).str.replace('R$', '', regex=False).str.replace(' ', '', regex=False)
+    if decimal == ',':
+        serie = serie.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    return pd.to_numeric(serie.where(serie != '', '0'), errors='coerce')
+
+def normalizar_extrato(bloco, formato):
+    """
+    Valida e normaliza um bloco em operações vetorizadas.
+    Retorna (válidos, rejeitados); rejeitados traz a coluna 'motivo'.
+    """
+    df = pd.DataFrame(index=bloco.index)
+    datas = bloco['data'] if 'data' in bloco else pd.Series('', index=bloco.index)
+    if formato['formato_data']:
+        df['data'] = pd.to_datetime(datas, format=formato['formato_data'], errors='coerce')
+    else:
+        df['data'] = pd.to_datetime(datas, dayfirst=True, errors='coerce')
+    df['historico'] = (bloco['historico'] if 'historico' in bloco else pd.Series('', index=bloco.index)).fillna('').astype(str).str.strip()
+    df['complemento'] = (bloco['complemento'] if 'complemento' in bloco else pd.Series('', index=bloco.index)).fillna('').astype(str).str.strip()
+
+    if 'valor' in bloco:
+        valor = _converter_valores(bloco['valor'], formato['decimal'])
+        df['entrada'] = valor.clip(lower=0)
+        df['saida'] = (-valor).clip(lower=0)
+    else:
+        zeros = pd.Series('', index=bloco.index)
+        df['entrada'] = _converter_valores(bloco['entrada'] if 'entrada' in bloco else zeros, formato['decimal']).abs()
+        df['saida'] = _converter_valores(bloco['saida'] if 'saida' in bloco else zeros, formato['decimal']).abs()
+    df['entrada'] = df['entrada'].round(2)
+    df['saida'] = df['saida'].round(2)
+
+    motivo = pd.Series('', index=bloco.index)
+    motivo = motivo.mask(df['data'].isna(), 'data inválida')
+    motivo = motivo.mask((motivo == '') & (df['historico'] == ''), 'histórico vazio')
+    motivo = motivo.mask((motivo == '') & (df['entrada'].isna() | df['saida'].isna()), 'valor inválido')
+    motivo = motivo.mask((motivo == '') & (df['entrada'] == 0) & (df['saida'] == 0), 'valor zerado')
+
+    rejeitados = bloco[motivo != ''].assign(motivo=motivo[motivo != ''])
+    return df[motivo == ''], rejeitados
+
+def importar_lancamentos(blocos):
+    """
+    Importa blocos (DataFrame, formato) de extrato em uma única transação:
+    INSERTs multi-linha por lote, resumo ajustado por período e um único
+    recálculo de saldo por período afetado, a partir da data mais antiga.
+    Retorna um relatório com quantidades, rejeitados e vazão.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    inicio = monotonic()
+    importados = 0
+    rejeitados = []
+    periodos = {}  # (ano, mes) -> [data_minima, entradas, saidas, quantidade]
+    try:
+        cursor = conn.cursor()
+        for bloco, formato in blocos:
+            validos, invalidos = normalizar_extrato(bloco, formato)
+            if not invalidos.empty:
+                rejeitados.append(invalidos)
+            if validos.empty:
+                continue
+
+            validos = validos.assign(
+                ano=validos['data'].dt.year,
+                mes=validos['data'].dt.month.map(lambda m: MESES[m - 1]),
+                data=validos['data'].dt.date
+            )
+            linhas = list(zip(
+                validos['ano'].astype(int), validos['mes'], validos['data'], validos['historico'],
+                validos['complemento'].where(validos['complemento'] != '', None),
+                validos['entrada'].map(_valor_decimal), validos['saida'].map(_valor_decimal),
+                [0] * len(validos)
+            ))
+            for inicio_lote in range(0, len(linhas), IMPORTACAO_LOTE):
+                cursor.executemany(SQL_INSERIR_LANCAMENTOS, linhas[inicio_lote:inicio_lote + IMPORTACAO_LOTE])
+            importados += len(linhas)
+
+            agregado = validos.groupby(['ano', 'mes']).agg(
+                data_minima=('data', 'min'), entradas=('entrada', 'sum'),
+                saidas=('saida', 'sum'), quantidade=('data', 'size')
+            )
+            for (ano, mes), linha in agregado.iterrows():
+                atual = periodos.setdefault((int(ano), mes), [linha['data_minima'], 0, 0, 0])
+                atual[0] = min(atual[0], linha['data_minima'])
+                atual[1] += linha['entradas']
+                atual[2] += linha['saidas']
+                atual[3] += int(linha['quantidade'])
+
+        for (ano, mes), (data_minima, entradas, saidas, quantidade) in periodos.items():
+            _ajustar_resumo(cursor, ano, mes, _valor_decimal(entradas), _valor_decimal(saidas), quantidade)
+            _recalcular_saldos_a_partir(cursor, ano, mes, data_minima, 0)
+            # Vínculo às contas em lote (o INSERT multi-linha não aceita subconsulta)
+            _vincular_contas(cursor, ano, mes)
+
+        conn.commit()
+        invalidar_cache('lancamentos')
+    except Exception as e:
+        conn.rollback()
+        st.error(f"❌ Erro na importação (nenhum lançamento foi gravado): {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    segundos = monotonic() - inicio
+    return {
+        'importados': importados,
+        'rejeitados': pd.concat(rejeitados) if rejeitados else pd.DataFrame(),
+        'periodos': sorted(periodos),
+        'segundos': segundos,
+        'linhas_por_segundo': importados / segundos if segundos > 0 else 0
+    }
+
+# =============================================================================
+# LANÇAMENTOS RECORRENTES E PREVISÃO DE SALDO
+# =============================================================================
+
+FREQUENCIAS_RECORRENCIA = ["Mensal", "Anual", "Personalizada (RRULE)"]
+
+def montar_regra_recorrencia(frequencia, inicio, regra_personalizada=''):
+    """
+    Regra RRULE da recorrência. Mensal no dia 29-31 cai no último dia dos
+    meses mais curtos (BYSETPOS=-1 sobre os dias 28..dia).
+    """
+    if frequencia == "Mensal":
+        if inicio.day > 28:
+            dias = ','.join(str(dia) for dia in range(28, inicio.day + 1))
+            return f"FREQ=MONTHLY;BYMONTHDAY={dias};BYSETPOS=-1"
+        return f"FREQ=MONTHLY;BYMONTHDAY={inicio.day}"
+    if frequencia == "Anual":
+        return "FREQ=YEARLY"
+    regra = regra_personalizada.strip()
+    return regra[len('RRULE:'):] if regra.upper().startswith('RRULE:') else regra
+
+# Lançamentos são diários: regras com mais de uma ocorrência por dia são recusadas
+RE_FREQ_SUBDIARIA = re.compile(r'(?:^|[;:])\s*FREQ\s*=\s*(?:HOURLY|MINUTELY|SECONDLY)\b', re.IGNORECASE | re.MULTILINE)
+
+def expandir_regra(regra, inicio, fim, de, ate):
+    """
+    Datas da regra (a partir de `inicio`, até `fim` se houver) dentro de
+    [de, ate], sem repetição: várias ocorrências no mesmo dia (BYHOUR, regras
+    antigas com frequência menor que diária) contam como uma.
+    """
+    regra_data = rrulestr(regra, dtstart=datetime.combine(inicio, time()))
+    limite = min(ate, fim) if fim else ate
+    if limite < de:
+        return []
+    return sorted({ocorrencia.date() for ocorrencia in regra_data.between(
+        datetime.combine(de, time()), datetime.combine(limite, time()), inc=True)})
+
+@st.cache_resource(show_spinner=False)
+def _periodos_materializados():
+    """Períodos já conferidos neste processo: evita consultar a cada rerun"""
+    return set()
+
+@cache_consulta('lancamentos_recorrentes')
+def get_lancamentos_recorrentes(somente_ativos=False):
     conn = get_db_connection()
     if not conn:
         return pd.DataFrame()
     try:
-        data_inicio = f"{ano}-{mes:02d}-01"
-        if mes == 12:
-            data_fim = f"{ano+1}-01-01"
-        else:
-            data_fim = f"{ano}-{mes+1:02d}-01"
-        query = '''
-            SELECT * FROM eventos_calendario 
-            WHERE data_evento >= %s AND data_evento < %s 
-            ORDER BY data_evento, hora_evento
-        '''
-        df = pd.read_sql(query, conn, params=[data_inicio, data_fim])
-        return df
+        query = 'SELECT * FROM lancamentos_recorrentes'
+        if somente_ativos:
+            query += ' WHERE ativo'
+        return pd.read_sql(query + ' ORDER BY historico', conn)
     except Exception as e:
-        st.error(f"Erro ao buscar eventos: {e}")
+        st.error(f"Erro ao buscar lançamentos recorrentes: {e}")
         return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
-def get_evento_by_id(evento_id):
-    """Busca um evento específico pelo ID"""
-    conn = get_db_connection()
-    if not conn:
-        return None
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM eventos_calendario WHERE id = %s', (evento_id,))
-        result = cursor.fetchone()
-        return result
-    except Error:
-        return None
-    finally:
-        if conn:
-            conn.close()
-
-def gerar_calendario(ano, mes):
-    cal = calendar.Calendar(firstweekday=6)  # Domingo como primeiro dia
-    return cal.monthdatescalendar(ano, mes)
-
-def salvar_evento(titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento):
+def salvar_lancamento_recorrente(historico, complemento, entrada, saida, regra, inicio, fim):
     conn = get_db_connection()
     if not conn:
         return False
     try:
+        # Valida a regra antes de gravar (RRULE mal formada levanta ValueError)
+        if RE_FREQ_SUBDIARIA.search(regra):
+            raise ValueError("a frequência mínima é diária (FREQ=DAILY)")
+        expandir_regra(regra, inicio, fim, inicio, inicio)
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO eventos_calendario (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, created_by)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, st.session_state.username))
+            INSERT INTO lancamentos_recorrentes (historico, complemento, entrada, saida, regra, inicio, fim, created_by)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (historico, complemento, _valor_decimal(entrada), _valor_decimal(saida), regra, inicio, fim,
+              st.session_state.username))
         conn.commit()
-        st.success("✅ Evento salvo com sucesso!")
+        invalidar_cache('lancamentos_recorrentes')
+        _periodos_materializados().clear()
+        st.success("✅ Lançamento recorrente salvo com sucesso!")
         return True
+    except ValueError as e:
+        st.error(f"❌ Regra de recorrência inválida: {e}")
+        return False
     except Error as e:
-        st.error(f"❌ Erro ao salvar evento: {e}")
+        st.error(f"❌ Erro ao salvar lançamento recorrente: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
-def atualizar_evento(evento_id, titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento):
+def alterar_lancamento_recorrente(recorrente_id, ativo=None, excluir=False):
+    """Ativa/desativa ou exclui uma recorrência (lançamentos já gerados permanecem)"""
     conn = get_db_connection()
     if not conn:
         return False
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE eventos_calendario 
-            SET titulo = %s, descricao = %s, data_evento = %s, hora_evento = %s, tipo_evento = %s, cor_evento = %s
-            WHERE id = %s
-        ''', (titulo, descricao, data_evento, hora_evento, tipo_evento, cor_evento, evento_id))
+        if excluir:
+            cursor.execute('SELECT id FROM recorrencias_materializadas WHERE recorrente_id = %s FOR UPDATE', (recorrente_id,))
+            _registrar_exclusao(cursor, 'recorrencias_materializadas', [linha[0] for linha in cursor.fetchall()])
+            cursor.execute('DELETE FROM recorrencias_materializadas WHERE recorrente_id = %s', (recorrente_id,))
+            cursor.execute('DELETE FROM lancamentos_recorrentes WHERE id = %s', (recorrente_id,))
+            _registrar_exclusao(cursor, 'lancamentos_recorrentes', [recorrente_id])
+        else:
+            cursor.execute('UPDATE lancamentos_recorrentes SET ativo = %s WHERE id = %s', (ativo, recorrente_id))
         conn.commit()
-        st.success("✅ Evento atualizado com sucesso!")
+        invalidar_cache('lancamentos_recorrentes')
+        _periodos_materializados().clear()
         return True
     except Error as e:
-        st.error(f"❌ Erro ao atualizar evento: {e}")
+        conn.rollback()
+        st.error(f"❌ Erro ao alterar lançamento recorrente: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
-def excluir_evento(evento_id):
+# Reivindicação das ocorrências; só marcadores em VALUES para o executemany
+# mandar todas as datas num único INSERT IGNORE multi-linha
+SQL_REIVINDICAR_RECORRENCIAS = '''
+    INSERT IGNORE INTO recorrencias_materializadas (recorrente_id, data, lote)
+    VALUES (%s, %s, %s)
+'''
+
+def materializar_recorrencias(ano, mes):
+    """
+    Gera, na primeira abertura do período, os lançamentos das recorrências
+    ativas que caem nele, numa transação: um INSERT IGNORE multi-linha em
+    recorrencias_materializadas reivindica todas as datas com um lote novo,
+    só as datas que ficaram com esse lote viram lançamentos (INSERT
+    multi-linha) e o saldo é recalculado uma vez a partir da data mais antiga. Meses futuros ficam para a previsão.
+    Retorna a quantidade de lançamentos gerados.
+    """
+    conferidos = _periodos_materializados()
+    if (ano, mes) in conferidos or mes not in MESES:
+        return 0
+    primeiro_dia = date(ano, MESES.index(mes) + 1, 1)
+    if primeiro_dia > date.today().replace(day=1):
+        return 0
+    ultimo_dia = primeiro_dia + relativedelta(months=1, days=-1)
+
+    df_recorrentes = get_lancamentos_recorrentes(somente_ativos=True)
+    ocorrencias = []
+    for recorrente in df_recorrentes.itertuples():
+        if recorrente.inicio > ultimo_dia:
+            continue
+        fim = recorrente.fim if pd.notna(recorrente.fim) else None
+        for data_ocorrencia in expandir_regra(recorrente.regra, recorrente.inicio, fim, primeiro_dia, ultimo_dia):
+            ocorrencias.append((recorrente, data_ocorrencia))
+    if not ocorrencias:
+        conferidos.add((ano, mes))
+        return 0
+
     conn = get_db_connection()
     if not conn:
-        return False
+        return 0
     try:
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM eventos_calendario WHERE id = %s', (evento_id,))
+        # Datas já reivindicadas (outra sessão ou execução anterior) ficam com o
+        # lote antigo: só as deste lote geram lançamentos
+        lote = secrets.token_hex(16)
+        cursor.executemany(SQL_REIVINDICAR_RECORRENCIAS,
+                           [(int(recorrente.id), data_ocorrencia, lote) for recorrente, data_ocorrencia in ocorrencias])
+        cursor.execute('SELECT recorrente_id, data FROM recorrencias_materializadas WHERE lote = %s', (lote,))
+        reivindicadas = set(cursor.fetchall())
+        linhas = [(ano, mes, data_ocorrencia, recorrente.historico, recorrente.complemento or None,
+                   _valor_decimal(recorrente.entrada), _valor_decimal(recorrente.saida), 0)
+                  for recorrente, data_ocorrencia in ocorrencias
+                  if (int(recorrente.id), data_ocorrencia) in reivindicadas]
+
+        if linhas:
+            cursor.executemany(SQL_INSERIR_LANCAMENTOS, linhas)
+            _ajustar_resumo(cursor, ano, mes, sum(linha[5] for linha in linhas),
+                            sum(linha[6] for linha in linhas), len(linhas))
+            _recalcular_saldos_a_partir(cursor, ano, mes, min(linha[2] for linha in linhas), 0)
+            _vincular_contas(cursor, ano, mes)
         conn.commit()
-        st.success("✅ Evento excluído com sucesso!")
-        return True
+        if linhas:
+            invalidar_cache('lancamentos')
+        conferidos.add((ano, mes))
+        return len(linhas)
     except Error as e:
-        st.error(f"❌ Erro ao excluir: {e}")
-        return False
+        conn.rollback()
+        st.error(f"❌ Erro ao gerar lançamentos recorrentes: {e}")
+        return 0
     finally:
         if conn:
             conn.close()
 
-def download_csv_mes(mes):
-    df = get_lancamentos_mes(mes)
-    if df.empty:
-        return None
-    return df.to_csv(index=False, encoding='utf-8')
-
-def exportar_para_csv():
-    try:
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-                    "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-            for mes in meses:
-                df_mes = get_lancamentos_mes(mes)
-                if not df_mes.empty:
-                    csv_data = df_mes.to_csv(index=False, encoding='utf-8')
-                    zip_file.writestr(f"lancamentos_{mes}.csv", csv_data)
-            conn = get_db_connection()
-            if conn:
-                try:
-                    df_contas = pd.read_sql("SELECT * FROM contas", conn)
-                    if not df_contas.empty:
-                        zip_file.writestr("contas.csv", df_contas.to_csv(index=False, encoding='utf-8'))
-                    df_eventos = pd.read_sql("SELECT * FROM eventos_calendario", conn)
-                    if not df_eventos.empty:
-                        zip_file.writestr("eventos.csv", df_eventos.to_csv(index=False, encoding='utf-8'))
-                    df_usuarios = pd.read_sql("SELECT username, email, permissao, nome_completo, telefone, endereco, data_aniversario, data_iniciacao, data_elevacao, data_exaltacao, data_instalacao_posse, observacoes, redes_sociais, created_at FROM usuarios", conn)
-                    if not df_usuarios.empty:
-                        zip_file.writestr("usuarios.csv", df_usuarios.to_csv(index=False, encoding='utf-8'))
-                finally:
-                    conn.close()
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue()
-    except Exception as e:
-        st.error(f"❌ Erro na exportação: {e}")
-        return None
+def projetar_saldo(meses=12, saldo_abertura=0.0):
+    """
+    Projeta as recorrências ativas no restante do mês atual (depois de hoje)
+    e nos `meses` seguintes. O saldo do livro caixa recomeça em cada período,
+    então não há saldo corrido para partir: a projeção soma o resultado
+    acumulado a um saldo de abertura informado. Cada regra é expandida uma vez
+    no horizonte; as somas por mês (np.bincount) e o acumulado (np.cumsum)
+    são vetorizados.
+    """
+    hoje = date.today()
+    primeiro_mes = hoje.replace(day=1)
+    ultimo_dia = primeiro_mes + relativedelta(months=meses + 1, days=-1)
+    periodos = meses + 1  # o mês atual (restante) é a primeira linha
 
-# =============================================================================
-# FUNÇÕES DE BACKUP
-# =============================================================================
+    df_recorrentes = get_lancamentos_recorrentes(somente_ativos=True)
+    datas = []
+    contagens = np.zeros(len(df_recorrentes), dtype=np.int64)
+    for posicao, recorrente in enumerate(df_recorrentes.itertuples()):
+        fim = recorrente.fim if pd.notna(recorrente.fim) else None
+        ocorrencias = expandir_regra(recorrente.regra, recorrente.inicio, fim, hoje + timedelta(days=1), ultimo_dia)
+        datas.extend(ocorrencias)
+        contagens[posicao] = len(ocorrencias)
 
-def criar_backup_completo():
-    """Cria um backup completo de todos os dados do sistema"""
-    try:
-        # Criar arquivo ZIP em memória
-        zip_buffer = io.BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            # Backup de lançamentos por mês
-            meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-                    "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-            
-            for mes in meses:
-                df_mes = get_lancamentos_mes(mes)
-                if not df_mes.empty:
-                    csv_data = df_mes.to_csv(index=False, encoding='utf-8')
-                    zip_file.writestr(f"backup_lancamentos_{mes}.csv", csv_data)
-            
-            # Backup de todas as tabelas
-            conn = get_db_connection()
-            if conn:
-                try:
-                    # Backup de contas
-                    df_contas = pd.read_sql("SELECT * FROM contas", conn)
-                    if not df_contas.empty:
-                        zip_file.writestr("backup_contas.csv", df_contas.to_csv(index=False, encoding='utf-8'))
-                    
-                    # Backup de eventos
-                    df_eventos = pd.read_sql("SELECT * FROM eventos_calendario", conn)
-                    if not df_eventos.empty:
-                        zip_file.writestr("backup_eventos.csv", df_eventos.to_csv(index=False, encoding='utf-8'))
-                    
-                    # Backup de usuários (sem senha)
-                    df_usuarios = pd.read_sql('''
-                        SELECT username, email, permissao, nome_completo, telefone, endereco, 
-                               data_aniversario, data_iniciacao, data_elevacao, data_exaltacao, 
-                               data_instalacao_posse, observacoes, redes_sociais, created_at 
-                        FROM usuarios
-                    ''', conn)
-                    if not df_usuarios.empty:
-                        zip_file.writestr("backup_usuarios.csv", df_usuarios.to_csv(index=False, encoding='utf-8'))
-                    
-                    # Backup de estrutura das tabelas
-                    cursor = conn.cursor()
-                    cursor.execute("SHOW TABLES")
-                    tables = cursor.fetchall()
-                    
-                    estrutura_sql = ""
-                    for table in tables:
-                        table_name = table[0]
-                        cursor.execute(f"SHOW CREATE TABLE {table_name}")
-                        create_table = cursor.fetchone()
-                        if create_table:
-                            estrutura_sql += f"-- Estrutura da tabela {table_name}\n"
-                            estrutura_sql += create_table[1] + ";\n\n"
-                    
-                    zip_file.writestr("estrutura_tabelas.sql", estrutura_sql)
-                    
-                finally:
-                    conn.close()
-            
-            # Adicionar informações do backup
-            info_backup = f"""
-            BACKUP DO SISTEMA LIVRO CAIXA
-            Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
-            Usuário: {st.session_state.username}
-            Permissão: {st.session_state.permissao}
-            
-            Conteúdo do backup:
-            - Lançamentos mensais
-            - Contas cadastradas
-            - Eventos do calendário
-            - Usuários (sem senhas)
-            - Estrutura das tabelas
-            
-            Este arquivo contém todos os dados do sistema para restauração.
-            """
-            zip_file.writestr("INFO_BACKUP.txt", info_backup)
-        
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue()
-        
-    except Exception as e:
-        st.error(f"❌ Erro ao criar backup: {e}")
-        return None
+    # Mês (0..periodos-1) de cada ocorrência e valores repetidos por ocorrência
+    indice_mes = (np.array(datas, dtype='datetime64[M]') - np.datetime64(primeiro_mes, 'M')).astype(np.int64)
+    entradas = np.bincount(indice_mes, minlength=periodos,
+                           weights=np.repeat(df_recorrentes['entrada'].to_numpy(dtype=float), contagens) if datas else None)
+    saidas = np.bincount(indice_mes, minlength=periodos,
+                         weights=np.repeat(df_recorrentes['saida'].to_numpy(dtype=float), contagens) if datas else None)
+    resultado = entradas - saidas
+    resultado_acumulado = np.cumsum(resultado)
 
-def criar_backup_incremental():
-    """Cria backup apenas dos dados recentes (últimos 30 dias)"""
-    try:
-        zip_buffer = io.BytesIO()
-        data_limite = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            conn = get_db_connection()
-            if conn:
-                try:
-                    # Backup de lançamentos recentes
-                    query_lancamentos = f"""
-                        SELECT * FROM lancamentos 
-                        WHERE created_at >= '{data_limite}' 
-                        ORDER BY data, id
-                    """
-                    df_lancamentos = pd.read_sql(query_lancamentos, conn)
-                    if not df_lancamentos.empty:
-                        zip_file.writestr("backup_incremental_lancamentos.csv", df_lancamentos.to_csv(index=False, encoding='utf-8'))
-                    
-                    # Backup de eventos recentes
-                    query_eventos = f"""
-                        SELECT * FROM eventos_calendario 
-                        WHERE created_at >= '{data_limite}' 
-                        ORDER BY data_evento, hora_evento
-                    """
-                    df_eventos = pd.read_sql(query_eventos, conn)
-                    if not df_eventos.empty:
-                        zip_file.writestr("backup_incremental_eventos.csv", df_eventos.to_csv(index=False, encoding='utf-8'))
-                    
-                finally:
-                    conn.close()
-            
-            # Informações do backup incremental
-            info_backup = f"""
-            BACKUP INCREMENTAL - SISTEMA LIVRO CAIXA
-            Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
-            Período: Últimos 30 dias (a partir de {data_limite})
-            Usuário: {st.session_state.username}
-            
-            Conteúdo:
-            - Lançamentos recentes
-            - Eventos recentes
-            """
-            zip_file.writestr("INFO_BACKUP_INCREMENTAL.txt", info_backup)
-        
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue()
-        
-    except Exception as e:
-        st.error(f"❌ Erro ao criar backup incremental: {e}")
-        return None
+    meses_projetados = pd.date_range(primeiro_mes, periods=periodos, freq='MS')
+    rotulos = [f"{MESES[m.month - 1]}/{m.year}" for m in meses_projetados]
+    rotulos[0] += " (restante)"
+    return pd.DataFrame({
+        'competencia': meses_projetados,
+        'mes': rotulos,
+        'entradas': entradas,
+        'saidas': saidas,
+        'resultado': resultado,
+        'resultado_acumulado': resultado_acumulado,
+        'saldo_projetado': saldo_abertura + resultado_acumulado
+    })
 
 # =============================================================================
 # FUNÇÕES PARA EDIÇÃO DE LANÇAMENTOS E EVENTOS - CORRIGIDAS
 # =============================================================================
 
-def show_editar_lancamento(lancamento_id, mes):
+def show_editar_lancamento(lancamento_id):
     """Interface para editar um lançamento existente"""
     lancamento = get_lancamento_by_id(lancamento_id)
     
@@ -1159,7 +4172,7 @@ def show_editar_lancamento(lancamento_id, mes):
                 st.error("❌ Pelo menos um valor (entrada ou saída) deve ser diferente de zero")
                 return
             
-            if atualizar_lancamento(lancamento_id, mes, data, historico, complemento, entrada, saida):
+            if atualizar_lancamento(lancamento_id, data, historico, complemento, entrada, saida):
                 st.session_state.editing_lancamento = None
                 st.rerun()
 
@@ -1472,6 +4485,7 @@ def visualizar_agenda_contatos():
     
     # Botão de atualização
     if st.button("🔄 Atualizar", use_container_width=True):
+        invalidar_cache('usuarios')
         st.rerun()
     
     # Opções de exportação (apenas para admin)
@@ -1610,9 +4624,12 @@ def main():
     # Inicializar session state
     init_session_state()
     
-    # Inicializar banco de dados
-    init_auth_db()
-    init_db()
+    # Garantir schema do banco de dados (migrações rodam uma vez por processo)
+    garantir_schema()
+    
+    # Backups agendados rodam em thread própria (uma por processo). Fica antes
+    # do login: qualquer visita após reiniciar o processo já inicia o agendador
+    iniciar_agendador_backups()
     
     # Logo e cabeçalho - LAYOUT MELHORADO
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -1680,7 +4697,7 @@ def show_main_application():
         st.markdown("---")
         
         # Menu de navegação - INCLUINDO CONVITES
-        menu_options = ["📊 Livro Caixa", "📅 Calendário"]
+        menu_options = ["📊 Livro Caixa", "📈 Relatórios Anuais", "📅 Calendário"]
         
         if user_can_edit():
             menu_options.append("⚙️ Configurações")
@@ -1723,6 +4740,8 @@ def show_main_application():
     # Navegação principal - INCLUINDO CONVITES
     if selected_menu == "📊 Livro Caixa":
         show_livro_caixa()
+    elif selected_menu == "📈 Relatórios Anuais":
+        show_relatorios_anuais()
     elif selected_menu == "📅 Calendário":
         show_calendario()
     elif selected_menu == "⚙️ Configurações" and user_can_edit():
@@ -1774,62 +4793,74 @@ def show_livro_caixa():
     
     # Verificar se está editando um lançamento
     if hasattr(st.session_state, 'editing_lancamento') and st.session_state.editing_lancamento:
-        # Buscar o mês atual para passar como parâmetro
-        meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-                 "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-        mes_atual = meses[datetime.now().month-1]
-        show_editar_lancamento(st.session_state.editing_lancamento, mes_atual)
+        # O período (ano/mês) é lido do próprio lançamento
+        show_editar_lancamento(st.session_state.editing_lancamento)
         return
     
-    # Seleção do mês
-    meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-             "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-    
+    # Seleção do período (mês/ano)
     col1, col2, col3 = st.columns([2, 1, 1])
     with col1:
-        mes_selecionado = st.selectbox("Selecione o mês:", meses, index=datetime.now().month-1)
-    
-    # Buscar lançamentos do mês
-    df_lancamentos = get_lancamentos_mes(mes_selecionado)
+        mes_selecionado = st.selectbox("Selecione o mês:", MESES, index=datetime.now().month-1)
+    with col2:
+        ano_selecionado = st.number_input("Ano:", min_value=1900, max_value=2100, value=datetime.now().year, key="ano_livro_caixa")
     
-    # Estatísticas rápidas
-    if not df_lancamentos.empty:
-        total_entrada = df_lancamentos['entrada'].sum()
-        total_saida = df_lancamentos['saida'].sum()
-        saldo_final = df_lancamentos['saldo'].iloc[-1] if len(df_lancamentos) > 0 else 0
-        
+    # Recorrências do período são geradas na primeira abertura
+    gerados = materializar_recorrencias(ano_selecionado, mes_selecionado)
+    if gerados:
+        st.info(f"🔁 {gerados} lançamento(s) recorrente(s) gerado(s) para {mes_selecionado}/{ano_selecionado}")
+
+    # Estatísticas rápidas (uma linha da tabela de resumo)
+    resumo = get_resumo_mes(ano_selecionado, mes_selecionado)
+    if resumo and resumo['quantidade'] > 0:
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Total Entradas", f"R$ {total_entrada:,.2f}")
+            st.metric("Total Entradas", formatar_moeda(resumo['total_entradas']))
         with col2:
-            st.metric("Total Saídas", f"R$ {total_saida:,.2f}")
+            st.metric("Total Saídas", formatar_moeda(resumo['total_saidas']))
         with col3:
-            st.metric("Saldo Final", f"R$ {saldo_final:,.2f}")
+            st.metric("Saldo Final", formatar_moeda(resumo['saldo_final']))
         with col4:
-            st.metric("Qtde Lançamentos", len(df_lancamentos))
+            st.metric("Qtde Lançamentos", resumo['quantidade'])
+    
+    # Visão dos meses do ano, também a partir do resumo
+    with st.expander(f"📅 Resumo de {ano_selecionado}"):
+        df_resumo_ano = get_resumo_ano(ano_selecionado)
+        if df_resumo_ano.empty:
+            st.info("📭 Nenhum lançamento registrado neste ano")
+        else:
+            for coluna in ['total_entradas', 'total_saidas', 'saldo_final']:
+                df_resumo_ano[coluna] = formatar_moeda(df_resumo_ano[coluna])
+            st.dataframe(df_resumo_ano, use_container_width=True, hide_index=True)
     
     # Abas para diferentes funcionalidades
-    tab1, tab2, tab3, tab4 = st.tabs(["📝 Novo Lançamento", "📋 Lançamentos do Mês", "📈 Relatórios", "⚙️ Configurações"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📝 Novo Lançamento", "📋 Lançamentos do Mês", "📈 Relatórios", "🔁 Recorrentes", "⚙️ Configurações"])
     
     with tab1:
         if user_can_edit():
-            show_novo_lancamento(mes_selecionado)
+            show_novo_lancamento(ano_selecionado, mes_selecionado)
         else:
             st.warning("⚠️ Você possui permissão apenas para visualização")
     
     with tab2:
-        show_lancamentos_mes(mes_selecionado, df_lancamentos)
+        show_lancamentos_mes(ano_selecionado, mes_selecionado)
     
     with tab3:
-        show_relatorios(mes_selecionado, df_lancamentos)
+        df_lancamentos = get_lancamentos_mes(ano_selecionado, mes_selecionado)
+        show_relatorios(ano_selecionado, mes_selecionado, df_lancamentos)
+        if not df_lancamentos.empty:
+            st.markdown("---")
+            show_relatorio_pdf(ano_selecionado, mes_selecionado)
     
     with tab4:
+        show_lancamentos_recorrentes()
+
+    with tab5:
         if user_is_admin():
-            show_configuracoes_mes(mes_selecionado)
+            show_configuracoes_mes(ano_selecionado, mes_selecionado)
         else:
             st.warning("⚠️ Apenas administradores podem acessar as configurações")
 
-def show_novo_lancamento(mes):
+def show_novo_lancamento(ano, mes):
     """Formulário para novo lançamento"""
     with st.form("novo_lancamento", clear_on_submit=True):
         col1, col2 = st.columns(2)
@@ -1854,36 +4885,136 @@ def show_novo_lancamento(mes):
                 st.error("❌ Pelo menos um valor (entrada ou saída) deve ser diferente de zero")
                 return
             
-            # Calcular saldo
-            df_existente = get_lancamentos_mes(mes)
-            saldo_anterior = df_existente['saldo'].iloc[-1] if not df_existente.empty else 0
-            saldo_atual = saldo_anterior + entrada - saida
-            
-            if salvar_lancamento(mes, data, historico, complemento, entrada, saida, saldo_atual):
+            # O saldo é calculado no banco, na mesma transação da inclusão
+            if salvar_lancamento(ano, mes, data, historico, complemento, entrada, saida):
                 st.rerun()
 
-def show_lancamentos_mes(mes, df_lancamentos):
-    """Exibe os lançamentos do mês"""
-    if df_lancamentos.empty:
+def show_lancamentos_recorrentes():
+    """Cadastro de lançamentos recorrentes e previsão de saldo"""
+    if user_can_edit():
+        with st.expander("➕ Novo Lançamento Recorrente"):
+            with st.form("novo_recorrente", clear_on_submit=True):
+                col1, col2 = st.columns(2)
+                with col1:
+                    historico = st.text_input("Histórico:")
+                    complemento = st.text_area("Complemento:")
+                    frequencia = st.selectbox("Frequência:", FREQUENCIAS_RECORRENCIA)
+                    regra_personalizada = st.text_input("Regra RRULE (personalizada):",
+                                                        placeholder="FREQ=WEEKLY;BYDAY=MO ou FREQ=MONTHLY;INTERVAL=3")
+                with col2:
+                    entrada = st.number_input("Valor de Entrada (R$):", min_value=0.0, value=0.0, step=0.01)
+                    saida = st.number_input("Valor de Saída (R$):", min_value=0.0, value=0.0, step=0.01)
+                    inicio = st.date_input("Primeira ocorrência:", value=date.today())
+                    sem_fim = st.checkbox("Sem data final", value=True)
+                    fim = st.date_input("Última ocorrência:", value=date.today() + relativedelta(years=1))
+
+                if st.form_submit_button("💾 Salvar Recorrência"):
+                    if not historico:
+                        st.error("❌ O histórico é obrigatório")
+                    elif entrada == 0 and saida == 0:
+                        st.error("❌ Informe um valor de entrada ou saída")
+                    elif frequencia == FREQUENCIAS_RECORRENCIA[2] and not regra_personalizada.strip():
+                        st.error("❌ Informe a regra RRULE")
+                    else:
+                        regra = montar_regra_recorrencia(frequencia, inicio, regra_personalizada)
+                        if salvar_lancamento_recorrente(historico, complemento, entrada, saida, regra,
+                                                        inicio, None if sem_fim else fim):
+                            st.rerun()
+
+    df_recorrentes = get_lancamentos_recorrentes()
+    if df_recorrentes.empty:
+        st.info("📭 Nenhum lançamento recorrente cadastrado")
+    else:
+        for _, recorrente in df_recorrentes.iterrows():
+            col1, col2, col3 = st.columns([3, 2, 1])
+            with col1:
+                situacao = "🟢" if recorrente['ativo'] else "⏸️"
+                st.write(f"{situacao} **{recorrente['historico']}** | `{recorrente['regra']}`")
+                st.caption(f"Desde {pd.to_datetime(recorrente['inicio']).strftime('%d/%m/%Y')}"
+                           + (f" até {pd.to_datetime(recorrente['fim']).strftime('%d/%m/%Y')}" if pd.notna(recorrente['fim']) else ""))
+            with col2:
+                if recorrente['entrada'] > 0:
+                    st.success(f"↗️ {formatar_moeda(recorrente['entrada'])}")
+                if recorrente['saida'] > 0:
+                    st.error(f"↘️ {formatar_moeda(recorrente['saida'])}")
+            with col3:
+                if user_can_edit():
+                    rotulo = "⏸️" if recorrente['ativo'] else "▶️"
+                    if st.button(rotulo, key=f"alternar_recorrente_{recorrente['id']}"):
+                        if alterar_lancamento_recorrente(int(recorrente['id']), ativo=not recorrente['ativo']):
+                            st.rerun()
+                    if st.button("🗑️", key=f"excluir_recorrente_{recorrente['id']}"):
+                        if alterar_lancamento_recorrente(int(recorrente['id']), excluir=True):
+                            st.rerun()
+
+    st.markdown("---")
+    st.subheader("🔮 Previsão de Saldo")
+    col1, col2 = st.columns(2)
+    with col1:
+        meses = st.slider("Meses à frente:", min_value=12, max_value=24, value=12, key="meses_previsao")
+    with col2:
+        saldo_abertura = st.number_input("Saldo de abertura (hoje):", value=0.0, step=100.0, format="%.2f",
+                                         key="saldo_abertura_previsao")
+    df_previsao = projetar_saldo(meses, saldo_abertura)
+    st.line_chart(df_previsao, x='competencia', y='saldo_projetado')
+    df_exibicao = df_previsao.drop(columns='competencia')
+    for coluna in ['entradas', 'saidas', 'resultado', 'resultado_acumulado', 'saldo_projetado']:
+        df_exibicao[coluna] = formatar_moeda(df_previsao[coluna])
+    st.dataframe(df_exibicao, use_container_width=True, hide_index=True)
+    st.caption("Só os lançamentos recorrentes ativos, a partir de amanhã. O saldo do livro caixa recomeça "
+               "em cada mês, então o saldo projetado parte do saldo de abertura informado.")
+
+def show_lancamentos_mes(ano, mes):
+    """Exibe os lançamentos do mês, buscando e renderizando só a página visível"""
+    resumo = get_resumo_mes(ano, mes)
+    total = resumo['quantidade'] if resumo else 0
+    if total == 0:
         st.info("📭 Nenhum lançamento registrado para este mês")
         return
     
     # Opções de visualização
-    col1, col2 = st.columns([3, 1])
+    col1, col2, col3 = st.columns([2, 1, 1])
     with col2:
+        tamanho_pagina = st.selectbox("Por página:", TAMANHOS_PAGINA, index=1, key="tamanho_pagina_lancamentos")
+    with col3:
         formato = st.radio("Formato:", ["Tabela", "Cards"], horizontal=True)
     
+    # Pilha de posições (data, id) de início de cada página já visitada
+    paginacao = st.session_state.pagina_lancamentos
+    if paginacao['periodo'] != (ano, mes, tamanho_pagina):
+        paginacao = {'periodo': (ano, mes, tamanho_pagina), 'pilha': [None]}
+        st.session_state.pagina_lancamentos = paginacao
+    
+    df_pagina = get_pagina_lancamentos_formatada(ano, mes, tamanho_pagina, paginacao['pilha'][-1])
+    if df_pagina.empty and len(paginacao['pilha']) > 1:
+        # Linhas da página foram excluídas: volta para o início
+        paginacao['pilha'] = [None]
+        df_pagina = get_pagina_lancamentos_formatada(ano, mes, tamanho_pagina)
+    tem_proxima = len(df_pagina) > tamanho_pagina
+    df_lancamentos = df_pagina.iloc[:tamanho_pagina]
+    
+    # Navegação entre páginas
+    total_paginas = -(-total // tamanho_pagina)
+    col_ant, col_info, col_prox = st.columns([1, 2, 1])
+    with col_ant:
+        if st.button("⬅️ Anterior", disabled=len(paginacao['pilha']) == 1, use_container_width=True, key="pagina_anterior"):
+            paginacao['pilha'].pop()
+            st.rerun()
+    with col_info:
+        st.caption(f"Página {len(paginacao['pilha'])} de {total_paginas} | {total} lançamentos")
+    with col_prox:
+        if st.button("Próxima ➡️", disabled=not tem_proxima, use_container_width=True, key="pagina_proxima"):
+            ultima = df_lancamentos.iloc[-1]
+            paginacao['pilha'].append((ultima['data'], int(ultima['id'])))
+            st.rerun()
+    
     if formato == "Tabela":
-        # Preparar dados para exibição
-        df_display = df_lancamentos.copy()
-        df_display['data'] = pd.to_datetime(df_display['data']).dt.strftime('%d/%m/%Y')
-        df_display['entrada'] = df_display['entrada'].apply(lambda x: f"R$ {x:,.2f}" if x > 0 else "")
-        df_display['saida'] = df_display['saida'].apply(lambda x: f"R$ {x:,.2f}" if x > 0 else "")
-        df_display['saldo'] = df_display['saldo'].apply(lambda x: f"R$ {x:,.2f}")
+        # Colunas já formatadas (em cache enquanto os lançamentos não mudam)
+        df_display = df_lancamentos[['data_fmt', 'historico', 'entrada_fmt', 'saida_fmt', 'saldo_fmt']]
+        df_display.columns = ['data', 'historico', 'entrada', 'saida', 'saldo']
         
         # Exibir tabela simplificada
-        st.dataframe(df_display[['data', 'historico', 'entrada', 'saida', 'saldo']], 
-                    use_container_width=True, hide_index=True)
+        st.dataframe(df_display, use_container_width=True, hide_index=True)
         
     else:
         # Visualização em cards
@@ -1895,16 +5026,16 @@ def show_lancamentos_mes(mes, df_lancamentos):
                     st.write(f"**{lancamento['historico']}**")
                     if lancamento['complemento']:
                         st.write(f"_{lancamento['complemento']}_")
-                    st.write(f"📅 {pd.to_datetime(lancamento['data']).strftime('%d/%m/%Y')}")
+                    st.write(f"📅 {lancamento['data_fmt']}")
                 
                 with col2:
                     if lancamento['entrada'] > 0:
-                        st.success(f"↗️ R$ {lancamento['entrada']:,.2f}")
+                        st.success(f"↗️ {lancamento['entrada_fmt']}")
                     if lancamento['saida'] > 0:
-                        st.error(f"↘️ R$ {lancamento['saida']:,.2f}")
+                        st.error(f"↘️ {lancamento['saida_fmt']}")
                 
                 with col3:
-                    st.info(f"💰 R$ {lancamento['saldo']:,.2f}")
+                    st.info(f"💰 {lancamento['saldo_fmt']}")
                 
                 with col4:
                     if user_can_edit():
@@ -1915,12 +5046,12 @@ def show_lancamentos_mes(mes, df_lancamentos):
                                 st.rerun()
                         with col_del:
                             if st.button("🗑️", key=f"del_card_{lancamento['id']}"):
-                                if excluir_lancamento(lancamento['id'], mes):
+                                if excluir_lancamento(int(lancamento['id'])):
                                     st.rerun()
                 
                 st.markdown("---")
 
-def show_relatorios(mes, df_lancamentos):
+def show_relatorios(ano, mes, df_lancamentos):
     """Exibe relatórios e gráficos"""
     if df_lancamentos.empty:
         st.info("📭 Nenhum dado para exibir relatórios")
@@ -1948,22 +5079,127 @@ def show_relatorios(mes, df_lancamentos):
         st.line_chart(chart_data, x='Data', y=['Entradas', 'Saídas'])
     
     with col2:
-        st.subheader("🥧 Distribuição por Categoria")
-        
-        # Agrupar por histórico (simplificado)
-        df_categorias = df_lancamentos.groupby('historico').agg({
-            'entrada': 'sum',
-            'saida': 'sum'
-        }).reset_index()
+        st.subheader("🥧 Distribuição por Conta")
         
-        # Criar gráfico de pizza para saídas
-        saidas_por_categoria = df_categorias[df_categorias['saida'] > 0]
-        if not saidas_por_categoria.empty:
-            st.bar_chart(saidas_por_categoria.set_index('historico')['saida'])
+        # Agrupado no banco pela conta do lançamento
+        df_contas = get_totais_por_conta(ano, ano, mes)
+        saidas_por_conta = df_contas[df_contas['saidas'] > 0] if not df_contas.empty else df_contas
+        if not saidas_por_conta.empty:
+            st.bar_chart(saidas_por_conta.set_index('conta')['saidas'])
+            if (saidas_por_conta['conta'] == '(sem conta)').any():
+                st.caption("Lançamentos sem conta: vincule-os em Configurações > Sistema")
+        else:
+            st.info("Não há saídas para exibir")
+
+def show_relatorio_pdf(ano, mes):
+    """Relatório do mês em PDF e geração em lote de todos os meses do ano"""
+    st.subheader("📄 Relatório em PDF")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("📄 Gerar PDF do Mês", use_container_width=True):
+            try:
+                st.session_state.relatorio_pdf_mes = ((ano, mes), gerar_relatorios_pdf(ano, [mes])[mes])
+            except Exception as e:
+                st.error(f"❌ Erro ao gerar o relatório: {e}")
+        relatorio = st.session_state.get('relatorio_pdf_mes')
+        if relatorio and relatorio[0] == (ano, mes):
+            st.download_button(
+                label="📥 Download PDF do Mês",
+                data=relatorio[1],
+                file_name=f"livro_caixa_{ano}_{MESES.index(mes) + 1:02d}_{mes}.pdf",
+                mime="application/pdf",
+                use_container_width=True
+            )
+
+    with col2:
+        if st.button(f"📚 Gerar PDFs de {ano}", use_container_width=True):
+            iniciar_tarefa('relatorios_pdf_ano', gerar_relatorios_pdf_ano, ano)
+        zip_data = show_andamento_tarefa('relatorios_pdf_ano', "Geração dos relatórios do ano")
+        if zip_data:
+            st.download_button(
+                label="📥 Download PDFs do Ano",
+                data=zip_data,
+                file_name=f"relatorios_pdf_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
+
+def show_relatorios_anuais():
+    """Relatórios de um ou vários anos, agregados no banco"""
+    st.header("📈 Relatórios Anuais")
+    
+    ano_atual = datetime.now().year
+    col1, col2 = st.columns(2)
+    with col1:
+        ano_inicio = st.number_input("Ano inicial:", min_value=1900, max_value=2100, value=ano_atual - 2, key="relatorio_ano_inicio")
+    with col2:
+        ano_fim = st.number_input("Ano final:", min_value=1900, max_value=2100, value=ano_atual, key="relatorio_ano_fim")
+    if ano_inicio > ano_fim:
+        st.warning("⚠️ O ano inicial deve ser menor ou igual ao ano final")
+        return
+    
+    df_anual = get_totais_anuais(ano_inicio, ano_fim)
+    if df_anual.empty:
+        st.info("📭 Nenhum lançamento no período selecionado")
+        return
+    
+    # Totais por ano, com variação em relação ao ano anterior. Anos sem
+    # lançamentos entram zerados para a variação comparar anos consecutivos;
+    # sem saídas no ano anterior, a célula fica vazia (em vez de infinito)
+    st.subheader("📊 Totais por Ano")
+    df_anual = (df_anual.set_index('ano').reindex(range(int(ano_inicio), int(ano_fim) + 1), fill_value=0)
+                .rename_axis('ano').reset_index())
+    saidas_anterior = df_anual['saidas'].shift().replace(0, np.nan)
+    df_exibicao = df_anual.copy()
+    df_exibicao['variacao_saidas'] = ((df_anual['saidas'] / saidas_anterior - 1) * 100).round(1)
+    for coluna in ['entradas', 'saidas', 'resultado']:
+        df_exibicao[coluna] = formatar_moeda(df_anual[coluna])
+    st.dataframe(df_exibicao, use_container_width=True, hide_index=True, column_config={
+        'variacao_saidas': st.column_config.NumberColumn("Saídas vs ano anterior (%)", format="%.1f%%")
+    })
+    
+    tab1, tab2, tab3 = st.tabs(["📅 Comparativo Mensal", "📈 Movimento Diário", "🏷️ Maiores Saídas"])
+    
+    with tab1:
+        # Comparativo ano a ano: meses nas linhas, anos nas colunas
+        df_mensal = get_totais_mensais(ano_inicio, ano_fim)
+        tipo = st.radio("Valores:", ["saidas", "entradas", "saldo_final"], horizontal=True, key="relatorio_tipo_mensal",
+                        format_func=lambda x: {'saidas': "Saídas", 'entradas': "Entradas", 'saldo_final': "Saldo final"}[x])
+        comparativo = df_mensal.pivot_table(index='numero_mes', columns='ano', values=tipo, aggfunc='sum')
+        comparativo.index = [MESES[numero - 1] for numero in comparativo.index]
+        comparativo.columns = [str(ano) for ano in comparativo.columns]
+        st.bar_chart(comparativo)
+        st.dataframe(comparativo.apply(formatar_moeda), use_container_width=True)
+    
+    with tab2:
+        df_diario = get_totais_diarios(ano_inicio, ano_fim)
+        if not df_diario.empty:
+            df_diario['data'] = pd.to_datetime(df_diario['data'])
+            st.line_chart(df_diario.rename(columns={'entradas': 'Entradas', 'saidas': 'Saídas'}),
+                          x='data', y=['Entradas', 'Saídas'])
+            st.caption(f"{len(df_diario)} dias com movimento")
+    
+    with tab3:
+        col1, col2 = st.columns(2)
+        with col1:
+            agrupamento = st.radio("Agrupar por:", ["Conta", "Histórico"], horizontal=True, key="relatorio_agrupamento")
+        with col2:
+            limite = st.selectbox("Quantidade:", [10, 20, 50], key="relatorio_limite_saidas")
+        if agrupamento == "Conta":
+            df_saidas = get_totais_por_conta(ano_inicio, ano_fim)
+            if not df_saidas.empty:
+                df_saidas = df_saidas[df_saidas['saidas'] > 0].head(limite)[['conta', 'saidas', 'quantidade']]
         else:
+            df_saidas = get_maiores_saidas(ano_inicio, ano_fim, limite)
+        if df_saidas.empty:
             st.info("Não há saídas para exibir")
+        else:
+            st.bar_chart(df_saidas.set_index(df_saidas.columns[0])['saidas'])
+            df_saidas['saidas'] = formatar_moeda(df_saidas['saidas'])
+            st.dataframe(df_saidas, use_container_width=True, hide_index=True)
 
-def show_configuracoes_mes(mes):
+def show_configuracoes_mes(ano, mes):
     """Configurações administrativas do mês"""
     st.subheader("⚙️ Configurações do Mês")
     
@@ -1971,12 +5207,12 @@ def show_configuracoes_mes(mes):
     
     with col1:
         if st.button("📥 Exportar CSV do Mês", use_container_width=True):
-            csv_data = download_csv_mes(mes)
+            csv_data = download_csv_mes(ano, mes)
             if csv_data:
                 st.download_button(
                     label="💾 Download CSV",
                     data=csv_data,
-                    file_name=f"lancamentos_{mes}_{datetime.now().strftime('%Y%m%d')}.csv",
+                    file_name=f"lancamentos_{ano}_{mes}_{datetime.now().strftime('%Y%m%d')}.csv",
                     mime="text/csv",
                     use_container_width=True
                 )
@@ -1984,7 +5220,7 @@ def show_configuracoes_mes(mes):
     with col2:
         if st.button("🗑️ Limpar Todos os Lançamentos", use_container_width=True):
             if st.checkbox("⚠️ Confirmar exclusão de TODOS os lançamentos deste mês"):
-                if limpar_lancamentos_mes(mes):
+                if limpar_lancamentos_mes(ano, mes):
                     st.rerun()
 
 def show_calendario():
@@ -2002,10 +5238,7 @@ def show_calendario():
         ano_atual = datetime.now().year
         mes_atual = datetime.now().month
         ano = st.number_input("Ano:", min_value=1900, max_value=2100, value=ano_atual)
-        mes = st.selectbox("Mês:", list(range(1, 13)), format_func=lambda x: [
-            "Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-            "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"
-        ][x-1], index=mes_atual-1)
+        mes = st.selectbox("Mês:", list(range(1, 13)), format_func=lambda x: MESES[x-1], index=mes_atual-1)
     
     # Buscar eventos do mês
     df_eventos = get_eventos_mes(ano, mes)
@@ -2014,7 +5247,7 @@ def show_calendario():
     tab1, tab2, tab3 = st.tabs(["📅 Visualização Mensal", "📋 Lista de Eventos", "➕ Novo Evento"])
     
     with tab1:
-        show_calendario_mensal(ano, mes, df_eventos)
+        show_calendario_mensal(ano, mes)
     
     with tab2:
         show_lista_eventos(df_eventos)
@@ -2025,9 +5258,10 @@ def show_calendario():
         else:
             st.warning("⚠️ Você possui permissão apenas para visualização")
 
-def show_calendario_mensal(ano, mes, df_eventos):
+def show_calendario_mensal(ano, mes):
     """Exibe calendário mensal"""
     calendario = gerar_calendario(ano, mes)
+    eventos_por_dia = get_indice_eventos_mes(ano, mes)
     nomes_dias = ["Dom", "Seg", "Ter", "Qua", "Qui", "Sex", "Sáb"]
     
     # Cabeçalho dos dias
@@ -2042,10 +5276,8 @@ def show_calendario_mensal(ano, mes, df_eventos):
             with cols[i]:
                 # Verificar se o dia é do mês atual
                 if dia.month == mes:
-                    # Verificar se há eventos neste dia
-                    eventos_dia = df_eventos[
-                        pd.to_datetime(df_eventos['data_evento']).dt.date == dia
-                    ] if not df_eventos.empty else []
+                    # Eventos do dia pelo índice por data
+                    eventos_dia = eventos_por_dia.get(dia, [])
                     
                     num_eventos = len(eventos_dia)
                     estilo = "🔴" if num_eventos > 0 else ""
@@ -2054,7 +5286,7 @@ def show_calendario_mensal(ano, mes, df_eventos):
                     
                     if num_eventos > 0:
                         with st.expander(f"{num_eventos} evento(s)"):
-                            for _, evento in eventos_dia.iterrows():
+                            for evento in eventos_dia:
                                 st.write(f"• {evento['titulo']}")
                                 if evento['hora_evento']:
                                     st.write(f"  ⏰ {evento['hora_evento']}")
@@ -2132,7 +5364,7 @@ def show_configuracoes():
         st.warning("⚠️ Apenas administradores podem acessar as configurações do sistema")
         return
     
-    tab1, tab2, tab3 = st.tabs(["💾 Backup", "📤 Exportação", "🔧 Sistema"])
+    tab1, tab2, tab3, tab4 = st.tabs(["💾 Backup", "📤 Exportação", "📥 Importação", "🔧 Sistema"])
     
     with tab1:
         show_backup_section()
@@ -2141,63 +5373,240 @@ def show_configuracoes():
         show_export_section()
     
     with tab3:
+        show_import_section()
+    
+    with tab4:
         show_system_info()
 
+def _selecionar_compressao(chave):
+    """Seletores de codec e nível de compressão; retorna (método, nível)"""
+    col1, col2 = st.columns(2)
+    with col1:
+        codec = st.selectbox("Compressão:", list(CODECS_COMPRESSAO), key=f"codec_{chave}")
+    with col2:
+        nivel = st.slider("Nível de compressão:", 1, 9, NIVEL_COMPRESSAO_PADRAO, key=f"nivel_{chave}",
+                          disabled=codec in ('LZMA', 'Sem compressão'),
+                          help="1 = mais rápido, 9 = menor arquivo (não se aplica a LZMA)")
+    return CODECS_COMPRESSAO[codec], nivel
+
+def _formatar_tamanho(num_bytes):
+    for unidade in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024 or unidade == 'GB':
+            return f"{num_bytes:,.1f} {unidade}" if unidade != 'B' else f"{num_bytes} B"
+        num_bytes /= 1024
+
+def show_relatorio_compressao(dados_zip):
+    """Mostra tamanho original, compactado e razão de compressão"""
+    relatorio = relatorio_compressao(dados_zip)
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Tamanho Original", _formatar_tamanho(relatorio['tamanho_original']))
+    with col2:
+        st.metric("Tamanho Compactado", _formatar_tamanho(relatorio['tamanho_compactado']))
+    with col3:
+        st.metric("Razão", f"{relatorio['razao']:.1f}x")
+
 def show_backup_section():
     """Seção de backup"""
     st.subheader("💾 Backup do Sistema")
     
+    compressao, nivel = _selecionar_compressao("backup")
+    linhas_por_insert = st.number_input("Linhas por INSERT no dump SQL:", min_value=1, max_value=10000,
+                                        value=DUMP_LINHAS_POR_INSERT, step=100, key="linhas_por_insert_dump")
+    
     col1, col2 = st.columns(2)
     
     with col1:
         if st.button("🔄 Criar Backup Completo", use_container_width=True):
-            with st.spinner("Criando backup completo..."):
-                backup_data = criar_backup_completo()
-                if backup_data:
-                    st.success("✅ Backup completo criado com sucesso!")
-                    st.download_button(
-                        label="📥 Download Backup Completo",
-                        data=backup_data,
-                        file_name=f"backup_completo_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
+            iniciar_tarefa('backup_completo', criar_backup_completo,
+                           st.session_state.username, st.session_state.permissao, compressao, nivel,
+                           int(linhas_por_insert))
+        backup_data = show_andamento_tarefa('backup_completo', "Backup completo")
+        if backup_data:
+            st.success("✅ Backup completo criado com sucesso!")
+            show_relatorio_compressao(backup_data)
+            st.download_button(
+                label="📥 Download Backup Completo",
+                data=backup_data,
+                file_name=f"backup_completo_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
     
     with col2:
         if st.button("📈 Backup Incremental", use_container_width=True):
-            with st.spinner("Criando backup incremental..."):
-                backup_data = criar_backup_incremental()
-                if backup_data:
-                    st.success("✅ Backup incremental criado com sucesso!")
-                    st.download_button(
-                        label="📥 Download Backup Incremental",
-                        data=backup_data,
-                        file_name=f"backup_incremental_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
+            iniciar_tarefa('backup_incremental', criar_backup_incremental,
+                           st.session_state.username, compressao, nivel)
+        backup_data = show_andamento_tarefa('backup_incremental', "Backup incremental")
+        if backup_data:
+            st.success("✅ Backup incremental criado com sucesso!")
+            show_relatorio_compressao(backup_data)
+            st.download_button(
+                label="📥 Download Backup Incremental",
+                data=backup_data,
+                file_name=f"backup_incremental_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
+    
+    show_restauracao_section()
+    show_repositorio_backup_section()
     
     st.info("""
     **💡 Sobre os backups:**
-    - **Backup Completo:** Contém todos os dados do sistema
-    - **Backup Incremental:** Contém apenas dados dos últimos 30 dias
+    - **Backup Completo:** Contém todos os dados do sistema, em CSV e em um dump SQL (dump_completo.sql)
+    - **Backup Incremental:** Contém apenas o que foi incluído, alterado ou excluído desde o backup anterior da cadeia
+    - Os backups são gerados em segundo plano; a página continua utilizável
     - Recomendamos fazer backups regulares para garantir a segurança dos dados
     """)
 
+def show_restauracao_section():
+    """Restauração de um backup completo ou incremental"""
+    st.markdown("---")
+    st.write("**♻️ Restaurar Backup**")
+    
+    uploaded_file = st.file_uploader("Arquivo de backup (.zip):", type=['zip'], key="restauracao_upload")
+    confirmar = st.checkbox("⚠️ Confirmo: o backup completo substitui lançamentos, contas e eventos atuais", key="confirmar_restauracao")
+    
+    if uploaded_file is not None and st.button("♻️ Restaurar", use_container_width=True, disabled=not confirmar):
+        iniciar_tarefa('restauracao', restaurar_backup, uploaded_file.getvalue())
+    
+    show_resultado_restauracao(show_andamento_tarefa('restauracao', "Restauração"))
+
+def show_resultado_restauracao(resultado):
+    """Relatório por tabela de uma restauração concluída"""
+    if resultado:
+        tipo, df_relatorio = resultado
+        st.success(f"✅ Backup {tipo} restaurado!")
+        st.dataframe(df_relatorio, use_container_width=True, hide_index=True)
+        if 'Contagem' in df_relatorio and (df_relatorio['Contagem'] != '✅').any():
+            st.error("❌ A contagem de linhas não confere em alguma tabela")
+        if 'Checksum' in df_relatorio and (df_relatorio['Checksum'] != '✅').any():
+            st.warning("⚠️ Checksum divergente (esperado em backups gerados antes da exportação em streaming)")
+        st.caption("Usuários novos restaurados recebem senha aleatória e precisam ter a senha redefinida.")
+
+def show_repositorio_backup_section():
+    """Backups completos deduplicados no repositório local"""
+    st.markdown("---")
+    st.write("**🗄️ Repositório de Backups (deduplicado)**")
+    
+    diretorio = st.secrets.get("repositorio_backup", {}).get("diretorio", REPOSITORIO_DIRETORIO_PADRAO)
+    st.caption(f"Cada backup grava só os períodos e tabelas que mudaram em '{diretorio}'.")
+    
+    if st.button("🗄️ Backup no Repositório", use_container_width=True):
+        iniciar_tarefa('backup_repositorio', criar_backup_repositorio, diretorio, st.session_state.username)
+    relatorio = show_andamento_tarefa('backup_repositorio', "Backup no repositório")
+    if relatorio:
+        st.success(f"✅ Manifesto {relatorio['manifesto']} criado em {relatorio['segundos']}s: "
+                   f"{relatorio['novos']} pedaço(s) novo(s), {relatorio['reaproveitados']} reaproveitado(s), "
+                   f"{_formatar_tamanho(relatorio['bytes_gravados'])} gravados")
+    
+    manifestos = listar_manifestos(diretorio)
+    if not manifestos:
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        nome = st.selectbox("Manifesto:", manifestos, key="manifesto_repositorio")
+        confirmar = st.checkbox("⚠️ Confirmo a substituição dos dados atuais", key="confirmar_restauracao_repositorio")
+        if st.button("♻️ Restaurar Manifesto", use_container_width=True, disabled=not confirmar):
+            iniciar_tarefa('restauracao_repositorio', restaurar_manifesto, diretorio, nome)
+        if st.button("📥 Preparar Download do Manifesto", use_container_width=True):
+            iniciar_tarefa('zip_manifesto', montar_zip_manifesto, diretorio, nome)
+        zip_data = show_andamento_tarefa('zip_manifesto', "Montagem do backup")
+        if zip_data:
+            st.download_button(
+                label="📥 Download Backup Completo",
+                data=zip_data,
+                file_name=f"backup_completo_{nome}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
+    with col2:
+        manter = st.number_input("Manter últimos manifestos:", min_value=1, value=30, step=1, key="manter_manifestos")
+        if st.button("🧹 Limpar Repositório", use_container_width=True):
+            manifestos_removidos, objetos_removidos = limpar_repositorio(diretorio, int(manter))
+            st.success(f"✅ {manifestos_removidos} manifesto(s) e {objetos_removidos} objeto(s) removidos")
+    
+    show_resultado_restauracao(show_andamento_tarefa('restauracao_repositorio', "Restauração do manifesto"))
+
 def show_export_section():
     """Seção de exportação"""
     st.subheader("📤 Exportação de Dados")
     
+    compressao, nivel = _selecionar_compressao("exportacao")
+    
     if st.button("📊 Exportar Todos os Dados para CSV", use_container_width=True):
-        with st.spinner("Exportando dados..."):
-            zip_data = exportar_para_csv()
-            if zip_data:
-                st.success("✅ Exportação concluída com sucesso!")
+        iniciar_tarefa('exportacao', exportar_para_csv, compressao, nivel)
+    zip_data = show_andamento_tarefa('exportacao', "Exportação")
+    if zip_data:
+        st.success("✅ Exportação concluída com sucesso!")
+        show_relatorio_compressao(zip_data)
+        st.download_button(
+            label="📥 Download Exportação Completa",
+            data=zip_data,
+            file_name=f"exportacao_completa_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+            mime="application/zip",
+            use_container_width=True
+        )
+    
+    st.markdown("---")
+    st.write("**📐 Exportação para Análise (Parquet)**")
+    st.caption("Lançamentos, eventos e contas com tipos preservados (decimal, data, hora), particionados por ano/mês.")
+    if st.button("📐 Exportar em Parquet", use_container_width=True):
+        iniciar_tarefa('exportacao_parquet', exportar_para_parquet)
+    parquet_data = show_andamento_tarefa('exportacao_parquet', "Exportação Parquet")
+    if parquet_data:
+        st.success(f"✅ Exportação Parquet concluída ({_formatar_tamanho(len(parquet_data))})")
+        st.download_button(
+            label="📥 Download Exportação Parquet",
+            data=parquet_data,
+            file_name=f"exportacao_parquet_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+            mime="application/zip",
+            use_container_width=True
+        )
+
+def show_import_section():
+    """Seção de importação de extratos bancários"""
+    st.subheader("📥 Importação de Extratos")
+    
+    uploaded_file = st.file_uploader(
+        "Arquivo do extrato (CSV ou OFX):",
+        type=['csv', 'ofx'],
+        key="extrato_upload"
+    )
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        separador = st.selectbox("Separador do CSV:", [";", ",", "\t"], format_func=lambda x: "TAB" if x == "\t" else x)
+    with col2:
+        decimal = st.selectbox("Separador decimal do CSV:", [",", "."])
+    
+    st.caption("CSV: colunas data, historico, complemento (opcional) e valor (negativo = saída) ou entrada/saida. "
+               "Cada linha vai para o período (ano/mês) da sua data.")
+    
+    if uploaded_file is not None and st.button("🚀 Importar Lançamentos", use_container_width=True):
+        with st.spinner("Importando lançamentos..."):
+            if uploaded_file.name.lower().endswith('.ofx'):
+                blocos = ler_extrato_ofx(uploaded_file)
+            else:
+                blocos = ler_extrato_csv(uploaded_file, separador=separador, decimal=decimal)
+            relatorio = importar_lancamentos(blocos)
+        
+        if relatorio:
+            st.success(f"✅ {relatorio['importados']} lançamentos importados em {relatorio['segundos']:.1f}s "
+                       f"({relatorio['linhas_por_segundo']:,.0f} linhas/s)")
+            if relatorio['periodos']:
+                st.write("**Períodos afetados:** " + ", ".join(f"{mes}/{ano}" for ano, mes in relatorio['periodos']))
+            df_rejeitados = relatorio['rejeitados']
+            if not df_rejeitados.empty:
+                st.warning(f"⚠️ {len(df_rejeitados)} linhas rejeitadas")
+                st.dataframe(df_rejeitados, use_container_width=True)
                 st.download_button(
-                    label="📥 Download Exportação Completa",
-                    data=zip_data,
-                    file_name=f"exportacao_completa_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
-                    mime="application/zip",
+                    label="📥 Download Linhas Rejeitadas",
+                    data=df_rejeitados.to_csv(index=False, encoding='utf-8'),
+                    file_name=f"rejeitados_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                    mime="text/csv",
                     use_container_width=True
                 )
 
@@ -2233,12 +5642,80 @@ def show_system_info():
                 st.metric("Total de Eventos", total_eventos)
             with col4:
                 st.metric("Total de Contas", total_contas)
+            
+            # Situação do pool de conexões
+            secrets = st.secrets["planetscale"]
+            pool = get_pool_conexoes(secrets["host"], secrets["user"], secrets["password"], secrets["database"])
+            abertas, livres, em_uso = pool.estatisticas()
+            st.caption(f"🔌 Pool de conexões: {abertas} abertas | {em_uso} em uso | {livres} livres (máx. {POOL_TAMANHO_MAXIMO})")
+            entradas_cache, memoria_cache = get_cache_consultas().estatisticas()
+            st.caption(f"🗃️ Cache de consultas: {entradas_cache} resultados | {memoria_cache / 1024 / 1024:.1f} MB (máx. {CACHE_MEMORIA_MAXIMA // 1024 // 1024} MB)")
+            
+            show_situacao_agendador()
+            
+            # Reparo da tabela de resumo por período
+            if st.button("🧮 Reconstruir Resumos do Livro Caixa", use_container_width=True):
+                reconstruir_resumos()
+
+            # Conferência do saldo corrido de todos os períodos
+            reparar_saldos = st.checkbox("Corrigir saldos divergentes", key="reparar_saldos")
+            if st.button("⚖️ Reconciliar Saldos", use_container_width=True):
+                iniciar_tarefa('reconciliacao_saldos', reconciliar_saldos, reparar_saldos)
+            resultado = show_andamento_tarefa('reconciliacao_saldos', "Reconciliação de saldos")
+            if resultado:
+                conferidos, df_divergencias = resultado
+                if df_divergencias.empty:
+                    st.success(f"✅ {conferidos} lançamento(s) conferidos: todos os saldos estão corretos")
+                else:
+                    situacao = "corrigidos" if df_divergencias['corrigido'].iloc[0] else "não corrigidos"
+                    st.warning(f"⚠️ {int(df_divergencias['divergentes'].sum())} saldo(s) divergente(s) em "
+                               f"{len(df_divergencias)} período(s) ({situacao}) | {conferidos} lançamento(s) conferidos")
+                    df_divergencias['maior_diferenca'] = formatar_moeda(df_divergencias['maior_diferenca'])
+                    st.dataframe(df_divergencias, use_container_width=True, hide_index=True)
+            
+            # Vínculo em massa dos lançamentos às contas pelo histórico
+            criar_contas = st.checkbox("Criar contas para históricos sem conta correspondente", key="criar_contas_vinculo")
+            if st.button("🔗 Vincular Lançamentos às Contas", use_container_width=True):
+                resultado = vincular_lancamentos_contas(criar_contas)
+                if resultado:
+                    contas_criadas, vinculados = resultado
+                    st.success(f"✅ {vinculados} lançamento(s) vinculados | {contas_criadas} conta(s) criada(s)")
+            
+            # Verificação dos índices das consultas críticas
+            if st.button("🔍 Verificar Uso de Índices", use_container_width=True):
+                df_indices = verificar_uso_indices()
+                if not df_indices.empty:
+                    st.dataframe(df_indices, use_container_width=True, hide_index=True)
+                    if (df_indices['OK'] != '✅').any():
+                        st.warning("⚠️ Alguma consulta não está usando o índice esperado (tabelas muito pequenas podem preferir full scan)")
                 
         except Error as e:
             st.error(f"❌ Erro ao buscar estatísticas: {e}")
         finally:
             conn.close()
 
+def show_situacao_agendador():
+    """Última execução e próximas execuções dos backups agendados"""
+    agendador = iniciar_agendador_backups()
+    if not agendador:
+        st.caption("🕒 Backups agendados: não configurados (seção [backup_agendado] em secrets.toml)")
+        return
+    
+    ultima, proximo_completo, proximo_incremental = agendador.situacao()
+    proximos = f"próximo completo {proximo_completo.strftime('%d/%m/%Y %H:%M') if proximo_completo else '-'}"
+    if proximo_incremental:
+        proximos += f" | próximo incremental {proximo_incremental.strftime('%d/%m/%Y %H:%M')}"
+    st.caption(f"🕒 Backups agendados em '{agendador.configuracao()['diretorio']}': {proximos}")
+    
+    if not ultima:
+        st.caption("Nenhuma execução desde o início do servidor")
+    elif ultima['erro']:
+        st.error(f"❌ Último backup agendado ({ultima['tipo']}, {ultima['inicio'].strftime('%d/%m/%Y %H:%M')}) falhou: {ultima['erro']}")
+    else:
+        duracao = (ultima['fim'] - ultima['inicio']).total_seconds()
+        st.caption(f"✅ Último backup agendado: {ultima['arquivo']} ({_formatar_tamanho(ultima['tamanho'])}, {duracao:.0f}s) | "
+                   f"{ultima['removidos']} arquivo(s) antigo(s) removido(s) pela retenção")
+
 def show_gerenciar_usuarios():
     """Interface para gerenciamento de usuários"""
     st.header("👥 Gerenciamento de Usuários")
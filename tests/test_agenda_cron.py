@@ -0,0 +1,72 @@
+"""
+Agenda cron dos backups agendados. As definições são extraídas do app.py
+sem importá-lo (o módulo depende do Streamlit) e executadas isoladamente.
+"""
+import ast
+import calendar
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+import pytest
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def _carregar(*nomes):
+    arvore = ast.parse(APP.read_text(encoding="utf-8"))
+    def nome(no):
+        if isinstance(no, ast.Assign):
+            return getattr(no.targets[0], "id", None)
+        return getattr(no, "name", None)
+    modulo = ast.Module(body=[no for no in arvore.body if nome(no) in nomes], type_ignores=[])
+    espaco = {"calendar": calendar, "date": date, "datetime": datetime, "time": time, "timedelta": timedelta}
+    exec(compile(modulo, str(APP), "exec"), espaco)
+    return espaco
+
+
+AgendaCron = _carregar("_campo_cron", "AgendaCron", "AGENDA_HORIZONTE_DIAS")["AgendaCron"]
+
+
+@pytest.mark.parametrize("expressao", ["99 3 * * *", "0 24 * * *", "0 3 0 * *", "0 3 * 13 *",
+                                       "0 3 * * 8", "*/0 3 * * *", "0 5-2 * * *", "x 3 * * *"])
+def test_campos_invalidos_levantam_value_error(expressao):
+    with pytest.raises(ValueError, match="Expressão cron inválida"):
+        AgendaCron(expressao)
+
+
+def test_expressao_que_nunca_dispara_e_recusada():
+    with pytest.raises(ValueError, match="nunca"):
+        AgendaCron("0 3 31 2 *")
+    AgendaCron("0 3 29 2 *")  # só em anos bissextos, mas dispara
+
+
+def test_dia_do_mes_ou_dia_da_semana_quando_ambos_restritos():
+    agenda = AgendaCron("0 3 1 * 1")
+    assert agenda.corresponde(datetime(2026, 10, 19, 3, 0))  # segunda-feira
+    assert agenda.corresponde(datetime(2026, 11, 1, 3, 0))   # dia 1 (domingo)
+    assert not agenda.corresponde(datetime(2026, 10, 20, 3, 0))
+
+
+def test_dia_da_semana_com_dia_do_mes_livre():
+    agenda = AgendaCron("0 3 * * 1-6")
+    assert agenda.corresponde(datetime(2026, 10, 17, 3, 0))      # sábado
+    assert not agenda.corresponde(datetime(2026, 10, 18, 3, 0))  # domingo
+
+
+def _proxima_minuto_a_minuto(agenda, apos, minutos):
+    instante = apos.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    for _ in range(minutos):
+        if agenda.corresponde(instante):
+            return instante
+        instante += timedelta(minutes=1)
+    return None
+
+
+def test_proxima_calculada_campo_a_campo():
+    apos = datetime(2026, 10, 17, 14, 37, 12)
+    assert AgendaCron("0 3 1 * 1").proxima(apos) == datetime(2026, 10, 19, 3, 0)
+    assert AgendaCron("0 3 29 2 *").proxima(apos) == datetime(2028, 2, 29, 3, 0)
+    assert AgendaCron("37 14 * * *").proxima(apos) == datetime(2026, 10, 18, 14, 37)
+    for expressao in ["*/15 * * * *", "0 3 * * 0", "30 2,14 1-7 * 5", "0 0 31 * *", "5/20 9-17 * 3,6 1-5"]:
+        agenda = AgendaCron(expressao)
+        assert agenda.proxima(apos) == _proxima_minuto_a_minuto(agenda, apos, 366 * 24 * 60), expressao
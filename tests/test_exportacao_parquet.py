@@ -0,0 +1,72 @@
+"""
+Exportação Parquet particionada. As definições são extraídas do app.py sem
+importá-lo (o módulo depende do Streamlit) e recebem um cursor em memória.
+"""
+import ast
+import io
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+pymysql = pytest.importorskip("pymysql")
+from pymysql.constants import FIELD_TYPE  # noqa: E402
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def _carregar(*nomes):
+    arvore = ast.parse(APP.read_text(encoding="utf-8"))
+    def nome(no):
+        if isinstance(no, ast.Assign):
+            return getattr(no.targets[0], "id", None)
+        return getattr(no, "name", None)
+    modulo = ast.Module(body=[no for no in arvore.body if nome(no) in nomes], type_ignores=[])
+    espaco = {"FIELD_TYPE": FIELD_TYPE, "datetime": datetime, "zipfile": zipfile}
+    exec(compile(modulo, str(APP), "exec"), espaco)
+    return espaco
+
+
+app = _carregar("MESES", "EXPORTACAO_BLOCO", "PARQUET_GRUPO_LINHAS", "_tipo_arrow", "_numero_mes",
+                "_tabela_arrow", "_stream_parquet_para_zip")
+
+
+class CursorEmMemoria:
+    description = [("ano", FIELD_TYPE.LONG, None, 11, 11, 0, False),
+                   ("mes", FIELD_TYPE.VAR_STRING, None, 20, 20, 0, False),
+                   ("data", FIELD_TYPE.DATE, None, 10, 10, 0, False),
+                   ("entrada", FIELD_TYPE.NEWDECIMAL, None, 10, 10, 2, False)]
+
+    def __init__(self, linhas):
+        self.linhas = list(linhas)
+
+    def fetchmany(self, tamanho):
+        bloco, self.linhas = self.linhas[:tamanho], self.linhas[tamanho:]
+        return bloco
+
+
+def test_particao_que_reaparece_nao_repete_membro_no_zip():
+    # ORDER BY ano, mes: 'Fevereiro' fica entre 'FEVEREIRO' e 'Janeiro', mas os
+    # dois primeiros caem na mesma partição (mes=02)
+    linhas = [(2024, "FEVEREIRO", date(2024, 2, 3), Decimal("1.00")),
+              (2024, "Janeiro", date(2024, 1, 5), Decimal("2.00")),
+              (2024, "Fevereiro", date(2024, 2, 9), Decimal("3.00"))]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        total = app["_stream_parquet_para_zip"](
+            pa, pq, zip_file, CursorEmMemoria(linhas),
+            lambda linha: f"ano={linha[0]}/mes={app['_numero_mes'](linha[1], linha[2]):02d}",
+            descartar=("ano", "mes"))
+    assert total == 3
+    with zipfile.ZipFile(buffer) as zip_file:
+        nomes = zip_file.namelist()
+        assert len(nomes) == len(set(nomes))
+        assert sorted(nomes) == ["ano=2024/mes=01/part-0.parquet",
+                                 "ano=2024/mes=02/part-0.parquet", "ano=2024/mes=02/part-1.parquet"]
+        fevereiro = [pq.read_table(io.BytesIO(zip_file.read(nome))) for nome in nomes if "mes=02" in nome]
+    assert sum(tabela.num_rows for tabela in fevereiro) == 2
+    assert fevereiro[0].column_names == ["data", "entrada"]
@@ -0,0 +1,74 @@
+"""
+O executemany do pymysql só agrupa o lote num INSERT multi-linha quando o SQL
+casa com RE_INSERT_VALUES (apenas marcadores em VALUES). Os testes leem as
+constantes SQL do app.py sem importá-lo (o módulo depende do Streamlit) e
+contam os comandos enviados por um cursor sem servidor.
+"""
+import ast
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+
+pymysql = pytest.importorskip("pymysql")
+from pymysql.converters import escape_item  # noqa: E402
+from pymysql.cursors import RE_INSERT_VALUES, Cursor  # noqa: E402
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def _constante(nome):
+    for no in ast.parse(APP.read_text(encoding="utf-8")).body:
+        if isinstance(no, ast.Assign) and any(getattr(alvo, "id", None) == nome for alvo in no.targets):
+            return ast.literal_eval(no.value)
+    raise AssertionError(f"{nome} não encontrada em app.py")
+
+
+class ConexaoFalsa:
+    """O mínimo que o Cursor usa para montar o SQL, sem servidor"""
+    encoding = "utf-8"
+
+    def literal(self, valor):
+        return escape_item(valor, "utf8mb4")
+
+    def escape(self, valor):
+        return escape_item(valor, "utf8mb4")
+
+
+class CursorContador(Cursor):
+    """Guarda cada comando em vez de enviá-lo"""
+
+    def __init__(self):
+        super().__init__(ConexaoFalsa())
+        self.comandos = []
+
+    def execute(self, query, args=None):
+        self.comandos.append(query if args is None else self.mogrify(query, args))
+        self.rowcount = 1
+        return 1
+
+
+def _lancamentos(quantidade):
+    return [(2024, "Janeiro", date(2024, 1, 1 + i % 28), f"Histórico {i}", None,
+             Decimal("10.00"), Decimal("0.00"), 0) for i in range(quantidade)]
+
+
+def test_insert_de_lancamentos_usa_so_marcadores():
+    assert RE_INSERT_VALUES.match(_constante("SQL_INSERIR_LANCAMENTOS"))
+
+
+def test_lote_de_lancamentos_vira_um_unico_insert():
+    cursor = CursorContador()
+    cursor.executemany(_constante("SQL_INSERIR_LANCAMENTOS"), _lancamentos(1000))
+    assert len(cursor.comandos) == 1
+    assert cursor.comandos[0].decode("utf-8").count("'Histórico ") == 1000
+
+
+def test_reivindicacao_de_recorrencias_vira_um_unico_insert():
+    sql = _constante("SQL_REIVINDICAR_RECORRENCIAS")
+    assert RE_INSERT_VALUES.match(sql)
+    cursor = CursorContador()
+    cursor.executemany(sql, [(7, date(2024, 1, dia), "a" * 32) for dia in range(1, 32)])
+    assert len(cursor.comandos) == 1
+    assert cursor.comandos[0].decode("utf-8").lstrip().startswith("INSERT IGNORE")